@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+#
+# Measure how parallel block compression of dump streams scales with workers.
+#
+# Usage: python benchmarks/bench_compress.py [-c CODEC] [-s MB] [-w 1,2,4,8]
+#
+
+import os
+import sys
+import time
+import zlib
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'zfsbackup'))
+import pipeline
+
+
+def make_data(size):
+    """Return size bytes of moderately compressible data, like a typical send stream."""
+    block = os.urandom(64 * 1024) + '\0' * (64 * 1024) + 'zfsbackup ' * 6554
+    return (block * (size / len(block) + 1))[:size]
+
+
+def run(codec, workers, blocksize, data, chunksize=1024 * 1024):
+    if workers:
+        stage = pipeline.ParallelCodecStage(codec, workers, blocksize)
+    else:
+        stage = pipeline.CodecStage(codec)
+    out = []
+    started = time.time()
+    for offset in xrange(0, len(data), chunksize):
+        out.append(stage.process(buffer(data, offset, chunksize)))
+    out.append(stage.finish())
+    elapsed = time.time() - started
+    stage.close()
+    return elapsed, ''.join(out)
+
+
+def check_gzip(compressed, expected_len):
+    """Decompress a multi-member gzip stream as gzip(1) would."""
+    total = 0
+    while compressed:
+        d = zlib.decompressobj(31)
+        total += len(d.decompress(compressed))
+        compressed = d.unused_data
+    assert total == expected_len, 'decompressed %d bytes, expected %d' % (total, expected_len)
+
+
+def main():
+    opars = OptionParser()
+    opars.add_option('-c', '--codec', dest='codec', default='gzip')
+    opars.add_option('-s', '--size', type='int', dest='size', metavar='MB', default=256)
+    opars.add_option('-b', '--blocksize', type='int', dest='blocksize', metavar='MB', default=4)
+    opars.add_option('-w', '--workers', dest='workers', default='1,2,4,8,16')
+    opts, args = opars.parse_args()
+    codec = pipeline.get_codec(opts.codec)
+    data = make_data(opts.size * 1024 * 1024)
+    print "%d MB of data, codec %s, %d MB blocks, %d cpus" % (opts.size, codec.name, opts.blocksize, os.sysconf('SC_NPROCESSORS_ONLN'))
+    elapsed, out = run(codec, 0, 0, data)
+    base = opts.size / elapsed
+    print "%-10s %8.1f MB/s  ratio %.2f" % ('serial', base, float(len(data)) / len(out))
+    for workers in [int(w) for w in opts.workers.split(',')]:
+        elapsed, out = run(codec, workers, opts.blocksize * 1024 * 1024, data)
+        if codec.name == 'gzip':
+            check_gzip(out, len(data))
+        print "%-10s %8.1f MB/s  ratio %.2f  speedup %.2fx" % ('%d workers' % workers, opts.size / elapsed, float(len(data)) / len(out), opts.size / elapsed / base)
+
+
+if __name__ == '__main__':
+    main()
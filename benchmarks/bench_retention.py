@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+#
+# Time snapshot retention over a large inventory.
+#
+# Compares parsing names with datetime.strptime, as each scan of a context
+# used to, with the parse-once retention.Snapshot records, then times a
+# grandfather-father-son evaluation over the whole inventory.
+#
+# Usage: python benchmarks/bench_retention.py [-n 100000] [-i MINUTES]
+#
+
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'zfsbackup'))
+import retention
+import zsnapman
+
+
+def make_names(count, interval):
+    """Return count snapshot names of one context, interval minutes apart, newest now."""
+    now = datetime.now().replace(microsecond=0)
+    snapctx = zsnapman.SnapshotContext('bench')
+    return [snapctx.make_snap_name(now - timedelta(minutes=interval * k)) for k in xrange(count - 1, -1, -1)]
+
+
+def timed(function, *args):
+    started = time.time()
+    result = function(*args)
+    return time.time() - started, result
+
+
+def parse_strptime(names):
+    timed = [(datetime.strptime(name.split('-')[2], zsnapman.DEFAULT_TIMESTRFORMAT), name) for name in names]
+    timed.sort()
+    return timed
+
+
+def parse_records(names):
+    snaps = [retention.parse_snapshot(name, zsnapman.DEFAULT_SNAP_PREFIX, zsnapman.DEFAULT_TIMESTRFORMAT) for name in names]
+    snaps.sort(key=lambda snap: (snap.stamp, snap.name))
+    return snaps
+
+
+def main():
+    opars = OptionParser()
+    opars.add_option('-n', '--snapshots', type='int', dest='count', default=100000)
+    opars.add_option('-i', '--interval', type='int', dest='interval', metavar='MINUTES', default=5)
+    opts, args = opars.parse_args()
+    names = make_names(opts.count, opts.interval)
+    print "%d snapshots, one every %d minutes" % (len(names), opts.interval)
+    elapsed, pairs = timed(parse_strptime, names)
+    print "%-28s %8.3f sec" % ('parse with strptime', elapsed)
+    elapsed, snaps = timed(parse_records, names)
+    print "%-28s %8.3f sec" % ('parse into records', elapsed)
+    assert [name for snaptime, name in pairs] == [snap.name for snap in snaps]
+    policies = [
+        ('last 1000', retention.Policy(last=1000)),
+        ('max age 30 days', retention.Policy(minutes=30 * 24 * 60)),
+        ('gfs 24h/30d/8w/12m', retention.Policy(hourly=24, daily=30, weekly=8, monthly=12)),
+        ('gfs + last 100', retention.Policy(last=100, hourly=48, daily=60, weekly=52, monthly=120)),
+    ]
+    for title, policy in policies:
+        elapsed, (kept, dropped) = timed(policy.evaluate, snaps)
+        print "%-28s %8.3f sec  %d kept, %d dropped" % (title, elapsed, len(kept), len(dropped))
+
+
+if __name__ == '__main__':
+    main()
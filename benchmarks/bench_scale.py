@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+#
+# Time zfsbackup end to end against simulated pools of growing size.
+#
+# A scripted zfs/zpool stand-in (fakezfs/fakezfs.py) is put first on PATH, so
+# the whole of zfs.py, zsnapman.py and zfsbackup.py runs as in production.
+# For each scenario and pool size, the report shows the wall time of the run
+# and how many zfs/zpool processes it spawned.
+#
+# Usage: python benchmarks/bench_scale.py [-d 10,100,400] [-m 10,100] [-s scenario,...]
+#
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+FAKEZFS = os.path.join(HERE, 'fakezfs', 'fakezfs.py')
+SOURCES = os.path.join(HERE, '..', 'zfsbackup')
+
+# name -> function(snapshots) returning the zfsbackup command line arguments
+SCENARIOS = [
+    ('list', lambda m: ['-l', '-c', '*']),
+    ('prune', lambda m: ['--prune-exceeding', str(m * 30)]),
+    ('snapshot-exclude', lambda m: ['-x', '/ds0', '-x', '/ds10/sub11']),
+    ('sequential', lambda m: ['-s', '-b', str(m + 2)]),
+    ('alternate', lambda m: ['-s', '-t', '-b', str(m + 2)]),
+    ('send-raw', lambda m: ['-s', '-0']),
+    ('send-gzip', lambda m: ['-s', '-0', '-k']),
+]
+
+
+def make_bin(tmpdir):
+    """Create zfs and zpool wrappers running the stand-in with this interpreter."""
+    bindir = os.path.join(tmpdir, 'bin')
+    os.mkdir(bindir)
+    for prog in ('zfs', 'zpool'):
+        path = os.path.join(bindir, prog)
+        f = open(path, 'w')
+        f.write('#!/bin/sh\nexec "%s" "%s" %s "$@"\n' % (sys.executable, FAKEZFS, prog))
+        f.close()
+        os.chmod(path, 0755)
+    return bindir
+
+
+def run_scenario(tmpdir, bindir, args, datasets, snapshots, env_extra):
+    state = os.path.join(tmpdir, 'state.json')
+    log = os.path.join(tmpdir, 'spawns.log')
+    output = os.path.join(tmpdir, 'out')
+    metrics = os.path.join(tmpdir, 'metrics.json')
+    for path in (log, metrics):
+        if os.path.exists(path): os.unlink(path)
+    if os.path.exists(output): shutil.rmtree(output)
+    os.mkdir(output)
+    env = dict(os.environ, PATH=bindir + os.pathsep + os.environ['PATH'], FAKEZFS_STATE=state, FAKEZFS_LOG=log, **env_extra)
+    subprocess.check_call([sys.executable, FAKEZFS, 'init', '--datasets', str(datasets), '--snapshots', str(snapshots)], env=dict(env, FAKEZFS_LOG=''))
+    argv = ['zfsbackup', '-o', output, '--metrics-json', metrics] + args
+    code = 'import sys; sys.path.insert(0, %r); sys.argv = %r; import zfsbackup; zfsbackup.main()' % (SOURCES, argv)
+    started = time.time()
+    devnull = open(os.devnull, 'w')
+    returncode = subprocess.call([sys.executable, '-c', code], env=env, stdout=devnull)
+    devnull.close()
+    elapsed = time.time() - started
+    spawns = {}
+    if os.path.exists(log):
+        for line in open(log):
+            command = ' '.join(line.split()[:2])
+            spawns[command] = spawns.get(command, 0) + 1
+    mbps = None
+    if os.path.exists(metrics):
+        dumps = json.load(open(metrics))['dumps']
+        if dumps:
+            mbps = sum([d['mbps'] for d in dumps]) / len(dumps)
+    return returncode, elapsed, spawns, mbps
+
+
+def main():
+    opars = OptionParser()
+    opars.add_option('-d', '--datasets', dest='datasets', default='10,100,400', help='pool sizes to simulate')
+    opars.add_option('-m', '--snapshots', dest='snapshots', default='10,100', help='snapshots per context to simulate')
+    opars.add_option('-s', '--scenarios', dest='scenarios', default=','.join([name for name, args in SCENARIOS]))
+    opars.add_option('--send-mb', type='int', dest='send_mb', default=64, help='size of simulated full send streams')
+    opars.add_option('--send-rate', type='int', dest='send_rate', default=0, help='MB/s of simulated send streams (0 = unlimited)')
+    opts, args = opars.parse_args()
+    env_extra = {'FAKEZFS_SEND_BYTES': str(opts.send_mb * 1024 * 1024), 'FAKEZFS_SEND_RATE': str(opts.send_rate * 1024 * 1024)}
+    wanted = opts.scenarios.split(',')
+    tmpdir = tempfile.mkdtemp(prefix='zfsbackup-bench-')
+    try:
+        bindir = make_bin(tmpdir)
+        print '%-18s %8s %8s %9s %7s %8s  %s' % ('scenario', 'datasets', 'snaps', 'wall s', 'spawns', 'MB/s', 'commands')
+        for name, make_args in SCENARIOS:
+            if name not in wanted: continue
+            for datasets in [int(x) for x in opts.datasets.split(',')]:
+                for snapshots in [int(x) for x in opts.snapshots.split(',')]:
+                    returncode, elapsed, spawns, mbps = run_scenario(tmpdir, bindir, make_args(snapshots), datasets, snapshots, env_extra)
+                    detail = ', '.join(['%s: %d' % (c, n) for c, n in sorted(spawns.items())])
+                    if returncode: detail = 'FAILED (%d) %s' % (returncode, detail)
+                    print '%-18s %8d %8d %9.2f %7d %8s  %s' % (name, datasets, snapshots, elapsed, sum(spawns.values()), mbps is None and '-' or '%.1f' % mbps, detail)
+                    sys.stdout.flush()
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+#
+# Compare writing dump files through a plain redirect with the page cache
+# friendly dumpsink.DumpSink.
+#
+# A data file is streamed with cat(1) through a SendPipeline into each sink.
+# For each, report the time to write the file and to have it on disk, and how
+# much of it is left in the page cache afterwards (as mincore(2) sees it).
+#
+# Usage: python benchmarks/bench_sink.py [-s MB] [-d DIRECTORY]
+#
+
+import ctypes
+import ctypes.util
+import mmap
+import os
+import sys
+import time
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'zfsbackup'))
+import dumpsink
+import pipeline
+
+libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+libc.mincore.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_char_p]
+
+
+def resident(path):
+    """Return how many bytes of a file are in the page cache."""
+    size = os.path.getsize(path)
+    if not size: return 0
+    f = open(path, 'rb')
+    try:
+        m = mmap.mmap(f.fileno(), size, prot=mmap.PROT_READ)
+    finally:
+        f.close()
+    pages = (size + mmap.PAGESIZE - 1) / mmap.PAGESIZE
+    vec = ctypes.create_string_buffer(pages)
+    # the address of the read-only mapping
+    addr = ctypes.c_void_p()
+    length = ctypes.c_ssize_t()
+    ctypes.pythonapi.PyObject_AsReadBuffer(ctypes.py_object(m), ctypes.byref(addr), ctypes.byref(length))
+    try:
+        if libc.mincore(addr, size, vec) != 0:
+            raise OSError(ctypes.get_errno(), 'mincore')
+    finally:
+        m.close()
+    return sum([ord(c) & 1 for c in vec.raw]) * mmap.PAGESIZE
+
+
+def make_source(path, size):
+    """Write size bytes of incompressible data to stream from."""
+    f = open(path, 'wb')
+    chunk = os.urandom(1024 * 1024)
+    for i in xrange(size / len(chunk)):
+        f.write(chunk)
+    f.close()
+
+
+def run(source, sink, path):
+    started = time.time()
+    pipeline.SendPipeline(['cat', source], sink).run()
+    written = time.time() - started
+    f = open(path, 'rb')
+    os.fsync(f.fileno())
+    f.close()
+    return written, time.time() - started, resident(path)
+
+
+def main():
+    opars = OptionParser()
+    opars.add_option('-s', '--size', type='int', dest='size', metavar='MB', default=1024)
+    opars.add_option('-d', '--directory', dest='directory', default='.')
+    opts, args = opars.parse_args()
+    source = os.path.join(opts.directory, 'bench_sink.source')
+    target = os.path.join(opts.directory, 'bench_sink.zfsdump')
+    make_source(source, opts.size * 1024 * 1024)
+    sinks = [
+        ('redirect', lambda: pipeline.FileSink(target)),
+        ('dumpsink', lambda: dumpsink.DumpSink(target, size=opts.size * 1024 * 1024)),
+        ('dumpsink no O_DIRECT', lambda: dumpsink.DumpSink(target, size=opts.size * 1024 * 1024, direct=False)),
+    ]
+    print "%d MB into %s" % (opts.size, os.path.abspath(opts.directory))
+    try:
+        for title, make_sink in sinks:
+            sink = make_sink()
+            written, durable, cached = run(source, sink, target)
+            print "%-22s %8.1f MB/s written  %8.1f MB/s on disk  %6d MB left in page cache%s" % (title, opts.size / written, opts.size / durable,
+                    cached / (1024 * 1024), sink.stats().get('direct') and ' (O_DIRECT)' or '')
+            os.unlink(target)
+    finally:
+        os.unlink(source)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,399 @@
+#!/usr/bin/env python
+#
+# Scripted stand-in for the zfs and zpool commands, for benchmarks.
+#
+# Install it first on PATH under the names 'zfs' and 'zpool' (see bench_scale.py).
+# The simulated system lives in the JSON file named by $FAKEZFS_STATE:
+#
+#   python fakezfs.py init --datasets N --snapshots M [--contexts a,b] [--pools p1,p2]
+#
+# creates pools with N datasets each and M snapshots per context, all recursive.
+# Every invocation is appended to $FAKEZFS_LOG, if set, to count process spawns.
+# 'zfs send' emits a send stream of about $FAKEZFS_SEND_BYTES bytes (default 1 MB) at
+# $FAKEZFS_SEND_RATE bytes/s (default unlimited); incrementals send a tenth of it per
+# snapshot of distance, and -c or -w streams do not compress any further. The stream
+# is made of valid records with their checksums, one substream per dataset with -R.
+#
+
+import array
+import fcntl
+import hashlib
+import json
+import os
+import random
+import struct
+import sys
+import time
+from datetime import datetime
+from optparse import OptionParser
+
+STATE = os.environ.get('FAKEZFS_STATE', 'fakezfs.json')
+
+# as in zsnapman
+SNAP_TIMEFORMAT = '%d_%m_%Y__%H_%M_%S'
+
+
+def load():
+    f = open(STATE)
+    try:
+        return json.load(f)
+    finally:
+        f.close()
+
+
+def save(state):
+    tmp = STATE + '.tmp'
+    f = open(tmp, 'w')
+    try:
+        json.dump(state, f)
+    finally:
+        f.close()
+    os.rename(tmp, STATE)
+
+
+def init(args):
+    opars = OptionParser()
+    opars.add_option('--pools', default='zroot')
+    opars.add_option('--datasets', type='int', default=10)
+    opars.add_option('--snapshots', type='int', default=10)
+    opars.add_option('--contexts', default='default')
+    opars.add_option('--interval', type='int', default=3600, help='seconds between snapshots')
+    opts, rest = opars.parse_args(args)
+    now = int(time.time())
+    state = {'pools': opts.pools.split(','), 'datasets': [], 'snapshots': [], 'props': {}}
+    for pool in state['pools']:
+        state['datasets'].append(pool)
+        for i in range(opts.datasets):
+            # a few levels of nesting, like usr/local/...
+            if i % 10 == 0:
+                state['datasets'].append('%s/ds%d' % (pool, i))
+            else:
+                state['datasets'].append('%s/ds%d/sub%d' % (pool, i - i % 10, i))
+    for context in opts.contexts.split(','):
+        for j in range(opts.snapshots):
+            creation = now - opts.interval * (opts.snapshots - j)
+            name = 'zbk-%s-%s' % (context, datetime.fromtimestamp(creation).strftime(SNAP_TIMEFORMAT))
+            for pool in state['pools']:
+                state['snapshots'].append([pool, name, creation, True])
+    state['snapshots'].sort(key=lambda x: x[2])
+    save(state)
+    return 0
+
+
+def _datasets_of(state, snap):
+    """Return the datasets a snapshot [root, name, creation, recursive] exists in."""
+    root, recursive = snap[0], snap[3]
+    return [ds for ds in state['datasets'] if ds == root or (recursive and ds.startswith(root + '/'))]
+
+
+def _option(args, flag, default=None):
+    if flag in args:
+        return args[args.index(flag) + 1]
+    return default
+
+
+def _operands(args, valued=('-o', '-t', '-s')):
+    """Return the non-option arguments."""
+    operands, skip = [], False
+    for arg in args:
+        if skip:
+            skip = False
+        elif arg in valued:
+            skip = True
+        elif not arg.startswith('-'):
+            operands.append(arg)
+    return operands
+
+
+def zpool(args):
+    state = load()
+    if args[0] == 'list':
+        for pool in state['pools']:
+            print pool
+        return 0
+    if args[0] == 'iostat':
+        # pool, alloc, free, rops, wops, rbw, wbw, total_wait read, total_wait write
+        for pool in state['pools']:
+            print '\t'.join([pool, '0', '0', '100', '100', '1000000', '1000000', os.environ.get('FAKEZFS_LATENCY', '1000000'), '1000000'])
+        return 0
+    return 2
+
+
+def zfs_list(state, args):
+    types = _option(args, '-t', 'filesystem')
+    columns = _option(args, '-o', 'name,used,avail,refer,mountpoint').split(',')
+    out = []
+    if 'snapshot' in types:
+        for snap in state['snapshots']:
+            for ds in _datasets_of(state, snap):
+                row = {'name': '%s@%s' % (ds, snap[1]), 'creation': str(snap[2]), 'used': '1024', 'type': 'snapshot'}
+                out.append('\t'.join([row.get(c, '-') for c in columns]))
+    if 'filesystem' in types:
+        for ds in state['datasets']:
+            mountpoint = '/' + ds.partition('/')[2]
+            row = {'name': ds, 'type': 'filesystem', 'used': '1073741824', 'avail': '1073741824', 'refer': '1048576', 'mountpoint': mountpoint}
+            out.append('\t'.join([row.get(c, '-') for c in columns]))
+    if out:
+        print '\n'.join(out)
+    return 0
+
+
+def zfs_get(state, args):
+    columns = _option(args, '-o', 'name,property,value,source').split(',')
+    operands = _operands(args)
+    props, targets = operands[0].split(','), operands[1:]
+    if '-r' in args:
+        # datasets recurse into their children; snapshots are reported once
+        targets = [ds for target in targets for ds in state['datasets']
+                if '@' not in target and (ds == target or ds.startswith(target + '/'))] + [target for target in targets if '@' in target]
+    for target in targets:
+        for prop in props:
+            value = state['props'].get('%s %s' % (target, prop), '-')
+            if prop.startswith('written@'): value = '1048576'
+            if prop in ('compression', 'encryption') and value == '-': value = 'off'
+            row = {'name': target, 'property': prop, 'value': value, 'source': '-'}
+            print '\t'.join([row[c] for c in columns])
+    return 0
+
+
+def zfs_set(state, args):
+    prop, value = args[0].split('=', 1)
+    state['props']['%s %s' % (args[1], prop)] = value
+    save(state)
+    return 0
+
+
+def zfs_snapshot(state, args):
+    recursive = '-r' in args
+    now = int(time.time())
+    for operand in _operands(args):
+        ds, name = operand.split('@')
+        if ds not in state['datasets']:
+            sys.stderr.write("cannot open '%s': dataset does not exist\n" % ds)
+            return 1
+        state['snapshots'].append([ds, name, now, recursive])
+    save(state)
+    return 0
+
+
+def zfs_destroy(state, args):
+    recursive = '-r' in args
+    ds, snaplist = _operands(args)[0].split('@')
+    targets = [d for d in state['datasets'] if d == ds or (recursive and d.startswith(ds + '/'))]
+    # resolve the list in each dataset's own snapshot order, as zfs does for ranges
+    doomed = {}
+    for target in targets:
+        names = [snap[1] for snap in state['snapshots'] if target in _datasets_of(state, snap)]
+        doomed[target] = set()
+        for part in snaplist.split(','):
+            if '%' in part:
+                first, last = part.split('%')
+                if first in names and last in names:
+                    doomed[target].update(names[names.index(first):names.index(last) + 1])
+            elif part in names:
+                doomed[target].add(part)
+    destroyed = 0
+    for snap in list(state['snapshots']):
+        members = _datasets_of(state, snap)
+        killed = [m for m in members if snap[1] in doomed.get(m, ())]
+        if not killed: continue
+        destroyed += len(killed)
+        state['snapshots'].remove(snap)
+        # what survives of a recursive snapshot stays as single snapshots
+        for member in members:
+            if member not in killed:
+                state['snapshots'].append([member, snap[1], snap[2], False])
+    state['snapshots'].sort(key=lambda x: x[2])
+    save(state)
+    if not destroyed:
+        sys.stderr.write("could not find any snapshots to destroy\n")
+        return 1
+    return 0
+
+
+# send stream records, as in sendstream
+DRR_BEGIN, DRR_OBJECT, DRR_FREEOBJECTS, DRR_WRITE, DRR_END = 0, 1, 2, 3, 5
+DMU_BACKUP_MAGIC = 0x2F5BACBAC
+DMU_SUBSTREAM, DMU_COMPOUNDSTREAM = 1, 2
+BLOCKSIZE = 32768
+# blocks per file object
+OBJECT_BLOCKS = 32
+MASK64 = (1 << 64) - 1
+
+
+def _fletcher4(data, state=(0, 0, 0, 0)):
+    a, b, c, d = state
+    words = array.array('I', data)
+    if sys.byteorder == 'big': words.byteswap()
+    for word in words:
+        a += word
+        b += a
+        c += b
+        d += c
+    return a & MASK64, b & MASK64, c & MASK64, d & MASK64
+
+
+def _fletcher4_combine(state, block, count):
+    """Add to state the sums of a block of count words checksummed from zero."""
+    a, b, c, d = state
+    n2 = count * (count + 1) / 2
+    n3 = count * (count + 1) * (count + 2) / 6
+    return ((a + block[0]) & MASK64, (b + count * a + block[1]) & MASK64,
+            (c + count * b + n2 * a + block[2]) & MASK64, (d + count * c + n2 * b + n3 * a + block[3]) & MASK64)
+
+
+def _guid(snapshot):
+    return int(hashlib.md5(str(snapshot)).hexdigest()[:16], 16)
+
+
+class SendStream(object):
+    """Write send stream records, keeping their running checksum."""
+    def __init__(self, out, rate):
+        self.out = out
+        self.rate = rate
+        self.started = time.time()
+        self.sent = 0
+        self.checksum = (0, 0, 0, 0)
+        self._sums = {}
+
+    def record(self, rectype, fields, payload=''):
+        header = struct.pack('<II', rectype, rectype == DRR_BEGIN and len(payload) or 0) + fields
+        header += '\0' * (312 - len(header))
+        self.checksum = _fletcher4(header[:280], self.checksum)
+        if rectype != DRR_BEGIN:
+            # the checksum of the stream so far closes the record, but for BEGIN whose name takes its place
+            header = header[:280] + struct.pack('<4Q', *self.checksum)
+        self.checksum = _fletcher4(header[280:], self.checksum)
+        if payload:
+            # the same blocks come again and again: checksum each once
+            if payload not in self._sums:
+                self._sums[payload] = _fletcher4(payload)
+            self.checksum = _fletcher4_combine(self.checksum, self._sums[payload], len(payload) / 4)
+        self.write(header + payload)
+
+    def begin(self, toname, toguid, fromguid, hdrtype, creation, payload=''):
+        self.checksum = (0, 0, 0, 0)
+        toname = str(toname)
+        self.record(DRR_BEGIN, struct.pack('<QQQIIQQ', DMU_BACKUP_MAGIC, (4 << 2) | hdrtype, creation, 2, 0, toguid, fromguid) +
+                toname[:255] + '\0' * (256 - len(toname[:255])), payload)
+
+    def end(self, toguid):
+        self.record(DRR_END, struct.pack('<4QQ', *(self.checksum + (toguid,))))
+
+    def write(self, data):
+        self.out.write(data)
+        self.sent += len(data)
+        if self.rate and self.sent / self.rate > time.time() - self.started:
+            time.sleep(self.sent / self.rate - (time.time() - self.started))
+
+
+def zfs_send(state, args):
+    size = int(os.environ.get('FAKEZFS_SEND_BYTES', '1048576'))
+    rate = float(os.environ.get('FAKEZFS_SEND_RATE', '0'))
+    incremental = _option(args, '-i')
+    operands = _operands(args, valued=('-i', '-t'))
+    if incremental and operands:
+        ds, name = operands[-1].split('@')
+        names = [snap[1] for snap in state['snapshots'] if ds in _datasets_of(state, snap)]
+        base = incremental.lstrip('@')
+        if base in names and name in names:
+            size = size * (names.index(name) - names.index(base)) / 10
+    if '-n' in args:
+        print 'size\t%d' % size
+        return 0
+    out = getattr(sys.stdout, 'buffer', sys.stdout)
+    # compressible but not trivial, like real streams; and the same every
+    # time the same snapshots are sent, so that dumps can be resumed
+    rand = random.Random(' '.join(operands + [incremental or '']))
+    compressed = '-c' in args or '-w' in args
+    if compressed:
+        # blocks as compressed or encrypted on disk
+        block = ''.join([chr(rand.randint(0, 255)) for i in xrange(BLOCKSIZE)])
+    else:
+        block = ''.join([chr(rand.randint(0, 255)) for i in xrange(4096)]) + '\0' * (BLOCKSIZE - 4096)
+    stream = SendStream(out, rate)
+    if operands:
+        ds, name = operands[-1].split('@')
+    else:
+        # resuming from a token
+        ds, name = '', ''
+    datasets = [ds]
+    creation = ([snap[2] for snap in state['snapshots'] if snap[1] == name] or [0])[0]
+    if '-R' in args:
+        datasets = [d for d in state['datasets'] if d == ds or d.startswith(ds + '/')]
+        nvlist = json.dumps({'fromsnap': incremental and incremental.lstrip('@') or '', 'tosnap': name, 'fss': datasets})
+        stream.begin('%s@%s' % (ds, name), _guid('%s@%s' % (ds, name)), 0, DMU_COMPOUNDSTREAM, 0,
+                nvlist + ' ' * (-len(nvlist) % 8))
+        stream.end(0)
+    writes = max(len(datasets), size / (312 + BLOCKSIZE))
+    for k, dataset in enumerate(datasets):
+        snapshot = '%s@%s' % (dataset, name)
+        fromguid = incremental and _guid('%s@%s' % (dataset, incremental.lstrip('@'))) or 0
+        stream.begin(snapshot, _guid(snapshot), fromguid, DMU_SUBSTREAM, creation)
+        obj = None
+        for i in xrange(writes * k / len(datasets), writes * (k + 1) / len(datasets)):
+            if i / OBJECT_BLOCKS + 128 != obj:
+                obj = i / OBJECT_BLOCKS + 128
+                # a plain file of BLOCKSIZE blocks, without bonus buffer
+                stream.record(DRR_OBJECT, struct.pack('<QIIII', obj, 19, 44, BLOCKSIZE, 0))
+            stream.record(DRR_WRITE, struct.pack('<QIIQQQBBB5x32sQQ', obj, 19, 0, (i % OBJECT_BLOCKS) * BLOCKSIZE, BLOCKSIZE,
+                    _guid(snapshot), 0, 0, compressed and 15 or 0, '', 0, compressed and BLOCKSIZE or 0), block)
+        stream.record(DRR_FREEOBJECTS, struct.pack('<QQ', (obj or 127) + 1, 64))
+        stream.end(_guid(snapshot))
+    if '-R' in args:
+        stream.write(struct.pack('<II', DRR_END, 0) + '\0' * 304)
+    out.flush()
+    return 0
+
+
+def zfs_receive(state, args):
+    data = sys.stdin.read(1024 * 1024)
+    while data:
+        data = sys.stdin.read(1024 * 1024)
+    target = _operands(args)[-1].split('@')[0]
+    if target not in state['datasets']:
+        state['datasets'].append(target)
+        save(state)
+    return 0
+
+
+ZFS_COMMANDS = {
+    'list': zfs_list,
+    'get': zfs_get,
+    'set': zfs_set,
+    'snapshot': zfs_snapshot,
+    'destroy': zfs_destroy,
+    'send': zfs_send,
+    'receive': zfs_receive,
+    'recv': zfs_receive,
+}
+
+# commands changing the state, serialized so concurrent ones do not lose updates
+LOCKED_COMMANDS = ('set', 'snapshot', 'destroy')
+
+
+def main():
+    prog = os.path.basename(sys.argv[0])
+    args = sys.argv[1:]
+    if args and args[0] in ('zfs', 'zpool'):
+        # invoked through a wrapper as 'fakezfs.py zfs ...'
+        prog = args.pop(0)
+    if args and args[0] == 'init':
+        return init(args[1:])
+    if os.environ.get('FAKEZFS_LOG'):
+        f = open(os.environ['FAKEZFS_LOG'], 'a')
+        f.write(' '.join([prog] + args) + '\n')
+        f.close()
+    if prog == 'zpool':
+        return zpool(args)
+    if not args or args[0] not in ZFS_COMMANDS:
+        sys.stderr.write('fakezfs: unsupported command %s\n' % ' '.join([prog] + args))
+        return 2
+    if args[0] in LOCKED_COMMANDS:
+        lock = open(STATE + '.lock', 'a')
+        fcntl.flock(lock, fcntl.LOCK_EX)
+    return ZFS_COMMANDS[args[0]](load(), args[1:])
+
+
+if __name__ == '__main__':
+    sys.exit(main())
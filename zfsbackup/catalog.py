@@ -0,0 +1,204 @@
+#
+# Copyright (c) 2010, Mij <mij@sshguard.net>
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and
+#   the following disclaimer in the documentation and/or other materials provided
+#   with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+# 
+
+#
+# See http://mij.oltrelinux.com/devel/zfsbackup/
+# Bitch to mij@sshguard.net
+#
+
+
+# module catalog
+import json
+import os
+import sqlite3
+import threading
+
+import manifest
+import restore
+
+# name of the catalog database, in the output directory
+CATALOG_FILENAME = 'zfsbackup-catalog.sqlite'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS dumps (
+    file TEXT PRIMARY KEY,
+    host TEXT NOT NULL,
+    context TEXT NOT NULL,
+    dataset TEXT NOT NULL,
+    seqno INTEGER NOT NULL,
+    time TEXT NOT NULL,
+    taken REAL NOT NULL,
+    snap_from TEXT,
+    snap_to TEXT,
+    codec TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    raw_size INTEGER,
+    checksum TEXT,
+    digests TEXT,
+    raw_digests TEXT
+);
+CREATE INDEX IF NOT EXISTS dumps_set ON dumps (host, context, dataset, taken);
+"""
+
+_COLUMNS = ('file', 'host', 'context', 'dataset', 'seqno', 'time', 'taken', 'snap_from', 'snap_to',
+        'codec', 'size', 'raw_size', 'checksum', 'digests', 'raw_digests')
+
+
+class Catalog(object):
+    """Index of the dumps in an output directory, kept in an SQLite database there.
+
+    Dumps are recorded as they complete, each in a transaction of its own, so
+    the catalog never lists half-written dumps. The catalog of a directory
+    holding dumps made before it existed is built by scanning the directory.
+    Threads dumping concurrently share one catalog."""
+    def __init__(self, directory):
+        self.directory = directory
+        self.path = os.path.join(directory, CATALOG_FILENAME)
+        created = not os.path.exists(self.path)
+        self._lock = threading.Lock()
+        # other processes may be writing to the catalog: wait for their transactions
+        self._db = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+        self._db.executescript(_SCHEMA)
+        if created: self.rebuild()
+
+    def close(self):
+        self._db.close()
+
+    def _row(self, dump):
+        values = {
+            'file': os.path.basename(dump.path), 'host': dump.host, 'context': dump.tag,
+            'dataset': dump.dataset, 'seqno': dump.seqno, 'time': dump.time, 'taken': dump.taken(),
+            'snap_from': None, 'snap_to': None, 'codec': dump.codec, 'size': dump.size,
+            'raw_size': None, 'checksum': None, 'digests': None, 'raw_digests': None,
+        }
+        if dump.manifest:
+            m = dump.manifest
+            values.update({'snap_from': m.snap_from, 'snap_to': m.snap_to, 'raw_size': m.raw_size,
+                'digests': json.dumps(m.digests), 'raw_digests': json.dumps(m.raw_digests)})
+            if m.digests:
+                name = 'sha256' in m.digests and 'sha256' or sorted(m.digests.keys())[0]
+                values['checksum'] = '%s:%s' % (name, m.digests[name])
+        return [values[column] for column in _COLUMNS]
+
+    def _insert(self, dumps):
+        self._db.executemany('INSERT OR REPLACE INTO dumps (%s) VALUES (%s)' % (', '.join(_COLUMNS), ', '.join(['?'] * len(_COLUMNS))),
+                [self._row(dump) for dump in dumps])
+
+    def add(self, path):
+        """Record a completed dump file, with its manifest if it has one."""
+        dump = restore.parse_dump_filename(path)
+        if dump is None:
+            raise Exception("Cannot catalog '%s': not named as a dump" % path)
+        if os.path.exists(path + manifest.MANIFEST_SUFFIX):
+            dump.manifest = manifest.Manifest.load(path + manifest.MANIFEST_SUFFIX)
+            dump.codec = dump.manifest.codec
+            dump.send_mode = dump.manifest.send_mode
+        with self._lock:
+            with self._db:
+                self._insert([dump])
+
+    def remove(self, path):
+        """Forget a dump file."""
+        with self._lock:
+            with self._db:
+                self._db.execute('DELETE FROM dumps WHERE file = ?', (os.path.basename(path),))
+
+    def rebuild(self):
+        """Replace the content of the catalog with the dumps found in the directory.
+
+        Return how many dumps were found."""
+        dumps = restore.scan_dumps(self.directory)
+        with self._lock:
+            with self._db:
+                self._db.execute('DELETE FROM dumps')
+                self._insert(dumps)
+        return len(dumps)
+
+    def _dump(self, row):
+        """Return the restore.DumpFile a row describes."""
+        values = dict(zip(_COLUMNS, row))
+        path = os.path.join(self.directory, values['file'])
+        # the send mode is part of the file name
+        send_mode = restore.dump_send_mode(path)
+        dump = restore.DumpFile(path, values['host'], values['context'], values['seqno'], values['time'],
+                values['dataset'], values['codec'], size=values['size'], send_mode=send_mode)
+        if values['digests'] is not None:
+            m = manifest.Manifest(path, values['snap_from'], values['snap_to'], values['seqno'], values['dataset'], values['codec'],
+                    send_mode=send_mode)
+            m.size, m.raw_size = values['size'], values['raw_size']
+            m.digests, m.raw_digests = json.loads(values['digests']), json.loads(values['raw_digests'])
+            dump.manifest = m
+        return dump
+
+    def _query(self, where='', args=()):
+        with self._lock:
+            rows = self._db.execute('SELECT %s FROM dumps %s ORDER BY taken, seqno' % (', '.join(_COLUMNS), where), args).fetchall()
+        return [self._dump(row) for row in rows]
+
+    def dumps(self, host, context, dataset):
+        """Return the dumps of a host, context and dataset (as in dump file names), in the order they were taken."""
+        return self._query('WHERE host = ? AND context = ? AND dataset = ?', (host, context, dataset))
+
+    def summary(self):
+        """Return (host, context, dataset, dumps, bytes, latest full time, latest dump time) for each set of dumps."""
+        with self._lock:
+            return self._db.execute("""SELECT host, context, dataset, COUNT(*), SUM(size),
+                    MAX(CASE WHEN seqno = 0 THEN taken END), MAX(taken)
+                    FROM dumps GROUP BY host, context, dataset ORDER BY host, context, dataset""").fetchall()
+
+    def obsolete_dumps(self, host, context, dataset, keep, alternate=False):
+        """Return the dumps of a set that no chain restoring its keep most recent snapshots needs."""
+        dumps = self.dumps(host, context, dataset)
+        restore.link_dumps(dumps, alternate)
+        needed = set()
+        targets = []
+        oldest = len(dumps)
+        for i in xrange(len(dumps) - 1, -1, -1):
+            if len(targets) >= keep: break
+            if dumps[i].node in targets: continue
+            try:
+                chain = restore.resolve_chain(dumps, dumps[i].node)
+            except Exception:
+                # not restorable: leave it to whoever looks into it
+                continue
+            targets.append(dumps[i].node)
+            needed.update([d.path for d in chain])
+            oldest = i
+        # never drop anything taken after the oldest snapshot kept
+        return [dump for dump in dumps[:oldest] if dump.path not in needed]
+
+
+_catalogs = {}
+_catalogs_lock = threading.Lock()
+
+def get_catalog(directory):
+    """Return the catalog of an output directory, opening it the first time."""
+    directory = os.path.abspath(directory)
+    with _catalogs_lock:
+        if directory not in _catalogs:
+            _catalogs[directory] = Catalog(directory)
+        return _catalogs[directory]
@@ -0,0 +1,123 @@
+#
+# Copyright (c) 2010, Mij <mij@sshguard.net>
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and
+#   the following disclaimer in the documentation and/or other materials provided
+#   with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+# 
+
+#
+# See http://mij.oltrelinux.com/devel/zfsbackup/
+# Bitch to mij@sshguard.net
+#
+
+
+# module checkpoint
+import glob
+import json
+import os
+import time
+
+import dumpsink
+
+CHECKPOINT_SUFFIX = '.ckpt'
+
+
+class Checkpoint(object):
+    """Progress of a dump, saved next to its output file so it can be resumed.
+
+    Records the send command, the snapshot pair and the codec of the dump, and
+    how far it got: the offset in the raw send stream, its crc32 and the offset
+    in the output file up to which data is durable."""
+    def __init__(self, output, command, snap_from=None, snap_to=None, dataset=None, codec='none'):
+        self.output = output
+        self.command = command
+        self.snap_from = snap_from
+        self.snap_to = snap_to
+        self.dataset = dataset
+        self.codec = codec
+        self.raw_offset = 0
+        self.raw_crc = 0
+        self.file_offset = 0
+        self.updated = None
+
+    def path(self):
+        return self.output + CHECKPOINT_SUFFIX
+
+    def matches(self, command, codec):
+        """Return whether this checkpoint belongs to the dump of command with codec."""
+        if self.command != command or self.codec != codec: return False
+        # the file is still partially named if written with --direct-io
+        return os.path.exists(self.output) or os.path.exists(dumpsink.partial_path(self.output))
+
+    def update(self, raw_offset, raw_crc, file_offset):
+        """Record new progress, atomically replacing the saved checkpoint."""
+        self.raw_offset = raw_offset
+        self.raw_crc = raw_crc
+        self.file_offset = file_offset
+        self.updated = time.time()
+        self.save()
+
+    def save(self):
+        tmppath = self.path() + '.tmp'
+        f = open(tmppath, 'w')
+        try:
+            json.dump(self.__dict__, f)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        os.rename(tmppath, self.path())
+
+    def remove(self):
+        if os.path.exists(self.path()):
+            os.unlink(self.path())
+
+    @classmethod
+    def load(cls, path):
+        f = open(path)
+        try:
+            values = json.load(f)
+        finally:
+            f.close()
+        ckpt = cls(values['output'], values['command'])
+        ckpt.__dict__.update(values)
+        return ckpt
+
+
+def list_checkpoints(directory):
+    """Return the checkpoints of the interrupted dumps in a directory."""
+    checkpoints = []
+    for path in sorted(glob.glob(os.path.join(directory, '*' + CHECKPOINT_SUFFIX))):
+        try:
+            checkpoints.append(Checkpoint.load(path))
+        except (IOError, ValueError, KeyError):
+            print "Ignoring unreadable checkpoint '%s'" % path
+    return checkpoints
+
+
+def find_checkpoint(directory, command, codec):
+    """Return the checkpoint of an interrupted dump of command in directory, or None."""
+    for ckpt in list_checkpoints(directory):
+        if ckpt.matches(command, codec):
+            return ckpt
+    return None
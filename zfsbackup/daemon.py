@@ -0,0 +1,240 @@
+#
+# Copyright (c) 2010, Mij <mij@sshguard.net>
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and
+#   the following disclaimer in the documentation and/or other materials provided
+#   with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+# 
+
+#
+# See http://mij.oltrelinux.com/devel/zfsbackup/
+# Bitch to mij@sshguard.net
+#
+
+
+# module daemon
+import calendar
+import ConfigParser
+import Queue
+import threading
+import time
+import traceback
+
+import zfs
+
+# seconds between two looks at which contexts are due
+DEFAULT_TICK = 60
+
+# seconds after which topology and snapshots are listed again, to see changes
+# made by others
+DEFAULT_REFRESH = 3600
+
+# the section of the configuration with the settings of the daemon itself
+DAEMON_SECTION = 'daemon'
+
+
+class Context(object):
+    """A context run by the daemon: its options and when it fires.
+
+    It fires every `every` minutes, counted from midnight plus `at` (HH:MM,
+    default 00:00), local time. Periods longer than a day are counted from
+    the epoch, a Thursday, and at may then include days too: '3 03:00' is
+    Sundays at 3 for a weekly context."""
+    def __init__(self, name, opts, every, at=0):
+        self.name = name
+        self.opts = opts
+        self.every = every
+        self.at = at
+
+    def due(self, when):
+        """Return whether the context fires in the minute of time.struct_time when."""
+        minutes = when.tm_hour * 60 + when.tm_min
+        if self.every > 24 * 60:
+            # the days since the epoch of the local date, whatever the DST offset
+            minutes += calendar.timegm(when) // 86400 * 24 * 60
+        return (minutes - self.at) % self.every == 0
+
+    def selection(self):
+        """Return what the snapshots of the context cover, to group contexts which can share them."""
+        ids = self.opts.only_datasets or self.opts.individual_dump_ds or []
+        pools = self.opts.all_pools and ['*'] or self.opts.pools or []
+        return (tuple(sorted(pools)), tuple(sorted(ids)), tuple(sorted(self.opts.exclude_datasets or [])))
+
+
+def _option_value(option, value):
+    """Convert a configuration value to the type of an optparse option."""
+    if option.action in ('store_true', 'store_false'):
+        value = value.strip().lower() in ('1', 'yes', 'true', 'on')
+        if option.action == 'store_false': value = not value
+        return value
+    if option.action == 'append':
+        return [option.check_value(option.dest, v) for v in value.replace(',', ' ').split()]
+    return option.check_value(option.dest, value.strip())
+
+
+def load_config(path, parser):
+    """Return the daemon settings and the contexts of a configuration file.
+
+    The configuration is an INI file: the daemon section holds tick and
+    refresh (seconds), every other section is a context named after it, with
+    every and at to schedule it and any command line option, by long name
+    (backlog, dump-individually, ...) or destination (backlog_num, ...).
+    Options in the DEFAULT section apply to all contexts."""
+    config = ConfigParser.RawConfigParser()
+    if not config.read(path):
+        raise Exception("Cannot read configuration '%s'" % path)
+    options = {}
+    for option in parser.option_list:
+        if not option.dest: continue
+        options[option.dest] = option
+        for name in option._long_opts:
+            options[name.lstrip('-')] = option
+    settings = {'tick': DEFAULT_TICK, 'refresh': DEFAULT_REFRESH}
+    if config.has_section(DAEMON_SECTION):
+        for key in settings:
+            if config.has_option(DAEMON_SECTION, key):
+                settings[key] = config.getint(DAEMON_SECTION, key)
+    contexts = []
+    for section in config.sections():
+        if section == DAEMON_SECTION: continue
+        opts = parser.get_default_values()
+        opts.context = section
+        every, at = None, 0
+        for key, value in config.items(section):
+            if key == 'every':
+                every = int(value)
+            elif key == 'at':
+                days, sep, hhmm = value.strip().rpartition(' ')
+                hours, sep, minutes = hhmm.partition(':')
+                at = int(days or 0) * 24 * 60 + int(hours) * 60 + int(minutes or 0)
+            elif key in options:
+                try:
+                    setattr(opts, options[key].dest, _option_value(options[key], value))
+                except Exception as e:
+                    raise Exception("Bad value for '%s' in context '%s': %s" % (key, section, e))
+            else:
+                raise Exception("Unknown setting '%s' in context '%s'" % (key, section))
+        if not every:
+            raise Exception("Context '%s' has no 'every' schedule" % section)
+        contexts.append(Context(section, opts, every, at))
+    if not contexts:
+        raise Exception("No contexts in configuration '%s'" % path)
+    return settings, contexts
+
+
+class Daemon(object):
+    """Run contexts on schedule in one long-running process.
+
+    Topology and snapshot inventory stay loaded between runs, kept up to date
+    by the operations of the daemon itself and listed again every refresh
+    seconds. Contexts firing in the same minute with the same datasets get
+    their snapshots in a single atomic 'zfs snapshot' call, taken on time;
+    pruning and dumping are then queued and done one context at a time by a
+    single worker, so they never compete for the pool. Contexts due while
+    snapshots took longer than a minute are fired late, not skipped.
+
+    snapshot(contexts) takes the snapshots of a group of contexts and returns
+    their names, None for a context taking none; run(context, snapname)
+    prunes and dumps a context."""
+    def __init__(self, contexts, snapshot, run, tick=DEFAULT_TICK, refresh=DEFAULT_REFRESH):
+        self.contexts = contexts
+        self.snapshot = snapshot
+        self.run = run
+        self.tick = tick
+        self.refresh = refresh
+        self.queue = Queue.Queue()
+        self._refreshed = time.time()
+        self._last_minute = None
+
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            try:
+                job()
+            except Exception:
+                traceback.print_exc()
+            finally:
+                self.queue.task_done()
+
+    def _refresh(self):
+        print "Refreshing topology and snapshots"
+        zfs.invalidate_topology()
+        zfs.invalidate_snapshot_inventory()
+
+    def fire(self, contexts):
+        """Snapshot a set of contexts now, and queue their pruning and dumping."""
+        groups = {}
+        for context in contexts:
+            groups.setdefault(context.selection(), []).append(context)
+        for group in groups.values():
+            print "Firing context%s %s" % (len(group) > 1 and 's' or '', ', '.join([c.name for c in group]))
+            try:
+                snapnames = self.snapshot(group)
+            except Exception:
+                traceback.print_exc()
+                continue
+            for context, snapname in zip(group, snapnames):
+                self.queue.put(lambda context=context, snapname=snapname: self.run(context, snapname))
+
+    def step(self, now=None):
+        """Fire the contexts due in the current minute, once, and those due in
+        the minutes since the last step if it is late."""
+        now = time.localtime(now)
+        minute = int(time.mktime(now) // 60)
+        if minute == self._last_minute: return
+        last, self._last_minute = self._last_minute, minute
+        if time.time() - self._refreshed >= self.refresh:
+            self._refreshed = time.time()
+            self.queue.put(self._refresh)
+        due = [c for c in self.contexts if c.due(now)]
+        if last is not None and minute - last > 1:
+            due.extend(self._missed(last, minute, due))
+        if due: self.fire(due)
+
+    def _missed(self, last, minute, due):
+        """Return the contexts not in due which were due after minute last and before minute."""
+        # a context is due once in any of its periods: looking further back tells nothing new
+        start = max(last + 1, minute - max([c.every for c in self.contexts]))
+        missed = []
+        for context in self.contexts:
+            if context in due: continue
+            for m in xrange(minute - 1, start - 1, -1):
+                if context.due(time.localtime(m * 60)):
+                    print "Context %s was due at %s, %d min ago: running it late" % (context.name,
+                            time.strftime('%H:%M', time.localtime(m * 60)), minute - m)
+                    missed.append(context)
+                    break
+        return missed
+
+    def start(self):
+        worker = threading.Thread(target=self._work)
+        worker.daemon = True
+        worker.start()
+
+    def serve(self):
+        """Run forever."""
+        self.start()
+        print "Running contexts: %s" % ', '.join(['%s (every %d min)' % (c.name, c.every) for c in self.contexts])
+        while True:
+            self.step()
+            # wake up early in the next minute
+            time.sleep(min(self.tick, 60 - time.time() % 60 + 1))
@@ -0,0 +1,243 @@
+#
+# Copyright (c) 2010, Mij <mij@sshguard.net>
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and
+#   the following disclaimer in the documentation and/or other materials provided
+#   with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+# 
+
+#
+# See http://mij.oltrelinux.com/devel/zfsbackup/
+# Bitch to mij@sshguard.net
+#
+
+
+# module dumpsink
+import ctypes
+import ctypes.util
+import errno
+import mmap
+import os
+
+import pipeline
+
+# suffix of a dump file while it is being written
+PARTIAL_SUFFIX = '.part'
+
+# writes go to the file in blocks of this size, aligned as O_DIRECT needs
+DEFAULT_BLOCKSIZE = 4 * 1024 * 1024
+ALIGNMENT = 4096
+
+# without O_DIRECT, data is flushed and dropped from the page cache every this many bytes
+DEFAULT_WRITEBEHIND = 16 * 1024 * 1024
+
+SYNC_FILE_RANGE_WAIT_BEFORE = 1
+SYNC_FILE_RANGE_WRITE = 2
+SYNC_FILE_RANGE_WAIT_AFTER = 4
+POSIX_FADV_DONTNEED = 4
+
+# the C library calls Python 2 lacks, with their argument types
+_PROTOTYPES = {
+    'fallocate': [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64],
+    'sync_file_range': [ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_uint],
+    'posix_fadvise': [ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_int],
+}
+
+
+def _load_libc():
+    """Return the C library with the calls of _PROTOTYPES set up, or None."""
+    name = ctypes.util.find_library('c')
+    if name is None: return None
+    try:
+        libc = ctypes.CDLL(name, use_errno=True)
+    except OSError:
+        return None
+    for funcname, argtypes in _PROTOTYPES.items():
+        func = getattr(libc, funcname, None)
+        if func is None: continue
+        func.argtypes = argtypes
+        func.restype = ctypes.c_int
+    return libc
+
+_libc = _load_libc()
+
+
+def _libc_call(funcname, *args):
+    """Call a file function of the C library. Return False if it is missing or fails."""
+    func = _libc and getattr(_libc, funcname, None)
+    if func is None: return False
+    # posix_fadvise returns the error, the others -1 and errno: both succeed with 0
+    return func(*args) == 0
+
+
+def fallocate(fd, size):
+    """Reserve size bytes of disk for a file, so it is laid out contiguously. Return whether it worked."""
+    return _libc_call('fallocate', fd, 0, 0, size)
+
+
+def write_behind(fd, offset, length):
+    """Start writing back a range of a file, without waiting for it."""
+    return _libc_call('sync_file_range', fd, offset, length, SYNC_FILE_RANGE_WRITE)
+
+
+def drop_cache(fd, offset, length):
+    """Wait for a range of a file to be on disk, then drop it from the page cache."""
+    _libc_call('sync_file_range', fd, offset, length,
+            SYNC_FILE_RANGE_WAIT_BEFORE | SYNC_FILE_RANGE_WRITE | SYNC_FILE_RANGE_WAIT_AFTER)
+    return _libc_call('posix_fadvise', fd, offset, length, POSIX_FADV_DONTNEED)
+
+
+def partial_path(path):
+    """Return the name a dump file has until it is complete."""
+    return path + PARTIAL_SUFFIX
+
+
+class DumpSink(pipeline.Stage):
+    """Write the stream into a dump file, keeping it out of the page cache.
+
+    The file is written as partial_path(path) and renamed to path once the
+    stream is complete, so a dump file that exists is whole. If size is
+    given, that much disk is reserved up front. Data is gathered in aligned
+    blocks written with O_DIRECT where the file system allows it; otherwise
+    written data is flushed behind the writes and dropped from the cache.
+
+    If offset is given, the partial file (or a complete-named one, as left by
+    FileSink) is truncated there and written on from that point. If the dump
+    fails, the partial file is removed, unless resumable."""
+    name = 'write'
+
+    def __init__(self, path, size=None, offset=None, resumable=False, direct=True, blocksize=DEFAULT_BLOCKSIZE, writebehind=DEFAULT_WRITEBEHIND):
+        pipeline.Stage.__init__(self)
+        self.path = path
+        self.partial = partial_path(path)
+        self.resumable = resumable
+        self.start_offset = offset or 0
+        self.blocksize = blocksize
+        self.writebehind = writebehind
+        self.preallocated = False
+        self._fd = None
+        self._block = mmap.mmap(-1, blocksize)
+        # position in the file the block goes to, and data in it
+        self._block_offset = self.start_offset - self.start_offset % ALIGNMENT
+        self._block_fill = 0
+        # start of the data not yet dropped from the cache
+        self._cached = self._block_offset
+        if offset is None:
+            flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+        else:
+            if not os.path.exists(self.partial) and os.path.exists(path):
+                os.rename(path, self.partial)
+            # O_DIRECT writes whole blocks: start with the unaligned tail already in the file
+            f = open(self.partial, 'r+b')
+            try:
+                f.truncate(offset)
+                f.seek(self._block_offset)
+                self._block.write(f.read(offset - self._block_offset))
+                self._block_fill = offset - self._block_offset
+            finally:
+                f.close()
+            flags = os.O_WRONLY
+        self.direct = False
+        if direct and hasattr(os, 'O_DIRECT'):
+            try:
+                self._fd = os.open(self.partial, flags | os.O_DIRECT, 0644)
+                self.direct = True
+            except OSError as e:
+                # not supported by this file system
+                if e.errno != errno.EINVAL: raise
+        if self._fd is None:
+            self._fd = os.open(self.partial, flags, 0644)
+        if size and offset is None:
+            self.preallocated = fallocate(self._fd, size)
+
+    def offset(self):
+        """Return the position in the file written so far."""
+        return self.start_offset + self.bytes_in
+
+    def _write_block(self):
+        """Write the block at its place in the file, padded to the alignment if partial."""
+        length = self._block_fill
+        if length % ALIGNMENT:
+            self._block.seek(length)
+            self._block.write('\0' * (ALIGNMENT - length % ALIGNMENT))
+            length += ALIGNMENT - length % ALIGNMENT
+        os.lseek(self._fd, self._block_offset, os.SEEK_SET)
+        written = 0
+        while written < length:
+            written += os.write(self._fd, buffer(self._block, written, length - written))
+
+    def _flush(self):
+        """Write out the full block and start a new one."""
+        self._write_block()
+        self._block_offset += self._block_fill
+        self._block_fill = 0
+        self._block.seek(0)
+        if not self.direct and self._block_offset - self._cached >= self.writebehind:
+            # keep one window in flight: start it, and drop the one before it once on disk
+            write_behind(self._fd, self._cached, self._block_offset - self._cached)
+            if self._cached >= self.writebehind:
+                drop_cache(self._fd, self._cached - self.writebehind, self.writebehind)
+            self._cached = self._block_offset
+
+    def process(self, data):
+        pos = 0
+        while pos < len(data):
+            count = min(len(data) - pos, self.blocksize - self._block_fill)
+            self._block.seek(self._block_fill)
+            self._block.write(buffer(data, pos, count))
+            self._block_fill += count
+            pos += count
+            if self._block_fill == self.blocksize:
+                self._flush()
+        return ''
+
+    def sync(self):
+        # the partial block goes out padded, and again in full once complete
+        if self._block_fill: self._write_block()
+        os.fsync(self._fd)
+        return ''
+
+    def finish(self):
+        """Complete the file and move it into place."""
+        if self._block_fill: self._write_block()
+        # drop the padding and what preallocation reserved beyond the stream
+        os.ftruncate(self._fd, self.offset())
+        os.fsync(self._fd)
+        if not self.direct:
+            drop_cache(self._fd, 0, 0)
+        os.close(self._fd)
+        self._fd = None
+        os.rename(self.partial, self.path)
+        return ''
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+            if not self.resumable:
+                os.unlink(self.partial)
+        if self._block is not None:
+            self._block.close()
+            self._block = None
+
+    def stats(self):
+        return {'direct': self.direct, 'preallocated': self.preallocated}
@@ -0,0 +1,341 @@
+#
+# Copyright (c) 2010, Mij <mij@sshguard.net>
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and
+#   the following disclaimer in the documentation and/or other materials provided
+#   with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+# 
+
+#
+# See http://mij.oltrelinux.com/devel/zfsbackup/
+# Bitch to mij@sshguard.net
+#
+
+
+# module engine
+import errno
+import os
+import Queue
+import signal
+import subprocess
+import threading
+import time
+
+# commands and tasks run in the background at once
+DEFAULT_WORKERS = 4
+
+# seconds a stopped command has to exit on SIGTERM before it gets SIGKILL
+DEFAULT_GRACE = 5
+
+
+class CommandTimeout(Exception):
+    """A command ran longer than allowed and was stopped."""
+    pass
+
+
+class CommandCancelled(Exception):
+    """A command or task was cancelled before it completed."""
+    pass
+
+
+def _signal(p, signum):
+    """Send a signal to a child process, unless it is gone already."""
+    if p.returncode is not None: return
+    try:
+        os.kill(p.pid, signum)
+    except OSError as e:
+        if e.errno != errno.ESRCH: raise
+
+def stop(p, grace=DEFAULT_GRACE):
+    """Stop a child process and reap it: SIGTERM first, SIGKILL if it is still
+    there after grace seconds. Only the thread owning p may call this."""
+    if p.poll() is not None:
+        return p.returncode
+    _signal(p, signal.SIGTERM)
+    deadline = time.time() + grace
+    while p.poll() is None and time.time() < deadline:
+        time.sleep(0.05)
+    if p.poll() is None:
+        _signal(p, signal.SIGKILL)
+    p.wait()
+    return p.returncode
+
+def interrupt(p, grace=DEFAULT_GRACE):
+    """Stop a child process owned by another thread, which reaps it.
+
+    Reaping from here as well would race with the owner's waitpid(), and could
+    make a killed command look successful to it. The owner should disarm(p)
+    once it has reaped it."""
+    _signal(p, signal.SIGTERM)
+    timer = threading.Timer(grace, _signal, (p, signal.SIGKILL))
+    timer.daemon = True
+    p.killer = timer
+    timer.start()
+
+def disarm(p):
+    """Cancel the SIGKILL that interrupt() may have scheduled for p."""
+    killer = getattr(p, 'killer', None)
+    if killer is not None: killer.cancel()
+
+
+class Task(object):
+    """Work handed to the engine: a command or a function running commands.
+
+    wait() for its result, or cancel() it: the commands it is running are
+    stopped and the task fails with CommandCancelled (CommandTimeout if it
+    ran out of time)."""
+    def __init__(self, name, func, timeout=None):
+        self.name = name
+        self.func = func
+        self.timeout = timeout
+        self.result = None
+        self.error = None
+        self.cancelled = False
+        self.timed_out = False
+        self.started = None
+        self.finished = None
+        self._children = []
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+
+    def done(self):
+        return self._done.isSet()
+
+    def wait(self, timeout=None):
+        """Wait for the task, and return its result or raise its error.
+
+        Waiting is interruptible: if this thread gets an exception meanwhile,
+        such as KeyboardInterrupt, or the wait times out, the task is cancelled."""
+        deadline = timeout is not None and time.time() + timeout or None
+        try:
+            while not self._done.isSet():
+                # wait in slices, so signals are still delivered to this thread
+                if deadline is not None:
+                    if time.time() >= deadline:
+                        raise CommandTimeout("Timed out waiting for '%s'" % self.name)
+                    self._done.wait(min(1, deadline - time.time()))
+                else:
+                    self._done.wait(1)
+        except BaseException:
+            self.cancel()
+            raise
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+    def cancel(self):
+        """Stop the task, or keep it from starting."""
+        with self._lock:
+            self.cancelled = True
+            children = list(self._children)
+        for p in children:
+            interrupt(p)
+
+    def _expire(self):
+        self.timed_out = True
+        self.cancel()
+
+    def _adopt(self, p):
+        """Track a process started by the task. Stop it at once if the task is cancelled."""
+        with self._lock:
+            self._children.append(p)
+            cancelled = self.cancelled
+        if cancelled: interrupt(p)
+
+    def _release(self, p):
+        with self._lock:
+            self._children.remove(p)
+
+    def _check(self):
+        """Raise if the task has been cancelled."""
+        if self.timed_out:
+            raise CommandTimeout("'%s' ran for more than %s sec" % (self.name, self.timeout))
+        if self.cancelled:
+            raise CommandCancelled("'%s' was cancelled" % self.name)
+
+    def _run(self):
+        self.started = time.time()
+        timer = None
+        if self.timeout:
+            timer = threading.Timer(self.timeout, self._expire)
+            timer.daemon = True
+            timer.start()
+        try:
+            self._check()
+            self.result = self.func()
+        except BaseException as e:
+            self.error = e
+        finally:
+            if timer is not None: timer.cancel()
+            self.finished = time.time()
+            self._done.set()
+
+
+class CommandEngine(object):
+    """Run commands and functions running commands, without blocking the caller.
+
+    run() runs a command right away in the calling thread; submit() and
+    spawn() queue a command or a function call for one of at most workers
+    background threads, and return its Task. Commands started by a task,
+    through run() or popen(), are stopped when the task is cancelled or times
+    out. Tasks submitted from a worker run inline, so they never wait for a
+    worker that is waiting for them."""
+    def __init__(self, workers=DEFAULT_WORKERS):
+        self.workers = max(1, workers)
+        self._queue = Queue.Queue()
+        self._threads = []
+        self._local = threading.local()
+        self._tasks = set()
+        self._lock = threading.Lock()
+
+    def current_task(self):
+        """Return the task running in this thread, or None."""
+        return getattr(self._local, 'task', None)
+
+    def popen(self, args, **kwargs):
+        """Start a command with subprocess.Popen, tracked by the current task."""
+        try:
+            p = subprocess.Popen(args, **kwargs)
+        except OSError:
+            raise Exception("%s not found. Cannot execute '%s'" % (args[0], ' '.join(args)))
+        task = self.current_task()
+        if task is not None: task._adopt(p)
+        return p
+
+    def reap(self, p, grace=DEFAULT_GRACE):
+        """Stop and reap a command started with popen(), and stop tracking it."""
+        try:
+            return stop(p, grace)
+        finally:
+            self.release(p)
+
+    def release(self, p):
+        """Stop tracking a completed command started with popen()."""
+        disarm(p)
+        task = self.current_task()
+        if task is not None and p in task._children: task._release(p)
+
+    def run(self, args, stdout=False, stderr=False, timeout=None):
+        """Run a command in this thread, capturing its output and error if asked.
+
+        Return (returncode, stdout, stderr). Raise CommandTimeout if it runs
+        longer than timeout seconds, CommandCancelled if the current task is
+        cancelled meanwhile."""
+        p = self.popen(args, stdout=stdout and subprocess.PIPE or None, stderr=stderr and subprocess.PIPE or None)
+        expired = []
+        timer = None
+        if timeout:
+            timer = threading.Timer(timeout, lambda: (expired.append(True), interrupt(p)))
+            timer.daemon = True
+            timer.start()
+        try:
+            out, err = p.communicate()
+        except BaseException:
+            self.reap(p)
+            raise
+        finally:
+            if timer is not None: timer.cancel()
+        self.release(p)
+        if expired:
+            raise CommandTimeout("'%s' ran for more than %s sec" % (' '.join(args), timeout))
+        task = self.current_task()
+        if task is not None: task._check()
+        return p.returncode, out or '', err or ''
+
+    def submit(self, args, stdout=False, stderr=False, timeout=None):
+        """Run a command in the background. Return its Task, whose result is (returncode, stdout, stderr)."""
+        return self._queue_task(Task(' '.join(args), lambda: self.run(args, stdout, stderr), timeout))
+
+    def spawn(self, func, *args, **kwargs):
+        """Call func(*args, **kwargs) in the background. Return its Task."""
+        name = getattr(func, '__name__', str(func))
+        return self._queue_task(Task(name, lambda: func(*args, **kwargs)))
+
+    def _queue_task(self, task):
+        if self.current_task() is not None:
+            self._execute(task)
+            return task
+        with self._lock:
+            self._tasks.add(task)
+            if len(self._threads) < min(self.workers, len(self._tasks)):
+                t = threading.Thread(target=self._worker)
+                t.daemon = True
+                t.start()
+                self._threads.append(t)
+        self._queue.put(task)
+        return task
+
+    def _execute(self, task):
+        outer = self.current_task()
+        self._local.task = task
+        try:
+            task._run()
+        finally:
+            self._local.task = outer
+
+    def _worker(self):
+        while True:
+            task = self._queue.get()
+            self._execute(task)
+            with self._lock:
+                self._tasks.discard(task)
+
+    def cancel_all(self):
+        """Cancel every task queued or running."""
+        with self._lock:
+            tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+
+    def wait_all(self, tasks):
+        """Wait for all tasks and return their results, or raise the first
+        error among them once all are done. If waiting is interrupted, all are cancelled."""
+        errors = []
+        try:
+            for task in tasks:
+                try:
+                    task.wait()
+                except Exception as e:
+                    errors.append(e)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+        if errors:
+            raise errors[0]
+        return [task.result for task in tasks]
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+def get_engine():
+    """Return the engine shared by the whole run."""
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = CommandEngine()
+        return _engine
+
+def configure(workers=DEFAULT_WORKERS):
+    """Set the number of background workers of the shared engine."""
+    get_engine().workers = max(1, workers)
@@ -0,0 +1,179 @@
+#
+# Copyright (c) 2010, Mij <mij@sshguard.net>
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and
+#   the following disclaimer in the documentation and/or other materials provided
+#   with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+# 
+
+#
+# See http://mij.oltrelinux.com/devel/zfsbackup/
+# Bitch to mij@sshguard.net
+#
+
+
+# module manifest
+import glob
+import json
+import os
+import time
+from multiprocessing.pool import ThreadPool
+
+import pipeline
+
+MANIFEST_SUFFIX = '.manifest'
+MANIFEST_VERSION = 1
+
+# read size when verifying dump files
+VERIFY_BUFSIZE = 4 * 1024 * 1024
+
+
+class Manifest(object):
+    """Description of a dump file, saved next to it when the dump completes.
+
+    Records the snapshot pair and seqno the dump was made from, its codec and
+    send mode, the size of the send stream and of the file, and the checksums of both computed
+    while the dump was written, so the file can be verified later without the
+    pool at hand."""
+    def __init__(self, output, snap_from=None, snap_to=None, seqno=None, dataset=None, codec='none', command=None, send_mode='plain'):
+        self.output = output
+        self.snap_from = snap_from
+        self.snap_to = snap_to
+        self.seqno = seqno
+        self.dataset = dataset
+        self.codec = codec
+        self.command = command
+        self.send_mode = send_mode
+        self.raw_size = None
+        self.size = None
+        self.raw_digests = {}
+        self.digests = {}
+        self.created = None
+
+    def path(self):
+        return self.output + MANIFEST_SUFFIX
+
+    def save(self):
+        """Atomically write the manifest next to the dump file."""
+        values = dict(self.__dict__)
+        # dump sets get moved around: refer to the file relative to the manifest
+        values['output'] = os.path.basename(self.output)
+        values['version'] = MANIFEST_VERSION
+        if self.created is None: values['created'] = self.created = time.time()
+        tmppath = self.path() + '.tmp'
+        f = open(tmppath, 'w')
+        try:
+            json.dump(values, f, indent=2, sort_keys=True)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        os.rename(tmppath, self.path())
+
+    @classmethod
+    def load(cls, path):
+        f = open(path)
+        try:
+            values = json.load(f)
+        finally:
+            f.close()
+        if values.pop('version', None) != MANIFEST_VERSION:
+            raise ValueError("Unsupported manifest version")
+        values['output'] = os.path.join(os.path.dirname(path), values['output'])
+        manifest = cls(values['output'])
+        manifest.__dict__.update(values)
+        return manifest
+
+    def verify(self, raw=False, bufsize=VERIFY_BUFSIZE):
+        """Check the dump file against the manifest.
+
+        The file is read once, checking its size and checksums; with raw, it is
+        also decompressed to check the checksums of the send stream. Return the
+        list of problems found, empty if the file is intact."""
+        if not os.path.exists(self.output):
+            return ["file '%s' is missing" % self.output]
+        size = os.path.getsize(self.output)
+        if size != self.size:
+            return ["file is %d bytes, expected %d" % (size, self.size)]
+        file_hash = pipeline.HashStage(self.digests.keys())
+        raw_hash = None
+        if raw and self.raw_digests:
+            raw_hash = pipeline.HashStage(self.raw_digests.keys(), raw=True)
+            decompressor = pipeline.get_codec(self.codec).decompressor()
+        f = open(self.output, 'rb')
+        try:
+            while True:
+                data = f.read(bufsize)
+                if not data: break
+                file_hash.process(data)
+                if raw_hash:
+                    data = decompressor.decompress(data)
+                    raw_hash.bytes_in += len(data)
+                    raw_hash.process(data)
+        finally:
+            f.close()
+        problems = []
+        for name, digest in sorted(file_hash.digests().items()):
+            if digest != self.digests[name]:
+                problems.append("%s of file is %s, expected %s" % (name, digest, self.digests[name]))
+        if raw_hash:
+            if raw_hash.bytes_in != self.raw_size:
+                problems.append("stream is %d bytes, expected %d" % (raw_hash.bytes_in, self.raw_size))
+            for name, digest in sorted(raw_hash.digests().items()):
+                if digest != self.raw_digests[name]:
+                    problems.append("%s of stream is %s, expected %s" % (name, digest, self.raw_digests[name]))
+        return problems
+
+
+def list_manifests(directory):
+    """Return the manifests of the dumps in a directory, in name order."""
+    manifests = []
+    for path in sorted(glob.glob(os.path.join(directory, '*' + MANIFEST_SUFFIX))):
+        try:
+            manifests.append(Manifest.load(path))
+        except (IOError, ValueError, KeyError):
+            print "Ignoring unreadable manifest '%s'" % path
+    return manifests
+
+
+def _verify(manifest, raw):
+    try:
+        return manifest.verify(raw=raw)
+    except Exception as e:
+        return [str(e)]
+
+
+def verify_manifests(manifests, workers=4, raw=False):
+    """Verify dump files against their manifests, several at a time.
+
+    Hashing and decompression release the GIL, so threads verify files on
+    different disks, or on an idle array, in parallel. Return a list of
+    (manifest, problems) in the order given."""
+    if workers <= 1 or len(manifests) <= 1:
+        return [(m, _verify(m, raw)) for m in manifests]
+    pool = ThreadPool(min(workers, len(manifests)))
+    try:
+        results = pool.map(lambda m: _verify(m, raw), manifests, chunksize=1)
+    finally:
+        pool.terminate()
+        pool.join()
+    return zip(manifests, results)
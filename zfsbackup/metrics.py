@@ -0,0 +1,214 @@
+#
+# Copyright (c) 2010, Mij <mij@sshguard.net>
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and
+#   the following disclaimer in the documentation and/or other materials provided
+#   with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+# 
+
+#
+# See http://mij.oltrelinux.com/devel/zfsbackup/
+# Bitch to mij@sshguard.net
+#
+
+
+# module metrics
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+class Metrics(object):
+    """Timings and volumes recorded during one run.
+
+    Keeps the time spent in each stage (inventory, snapshot, prune, send, ...)
+    and running each external command, and the bytes moved by each dump."""
+    def __init__(self, labels=None):
+        self.labels = labels or {}
+        self.started = time.time()
+        self.finished = None
+        self.success = None
+        self.stages = {}        # (stage, label items) -> [count, seconds]
+        self.commands = {}      # command -> [count, seconds, failures]
+        self.dumps = []
+        self._lock = threading.Lock()
+
+    def record_stage(self, stage, seconds, **labels):
+        key = (stage, tuple(sorted(labels.items())))
+        self._lock.acquire()
+        try:
+            entry = self.stages.setdefault(key, [0, 0.0])
+            entry[0] += 1
+            entry[1] += seconds
+        finally:
+            self._lock.release()
+
+    def record_command(self, args, seconds, returncode):
+        # 'zfs list', 'zpool iostat', ...: the command without its arguments
+        command = ' '.join(args[:2])
+        self._lock.acquire()
+        try:
+            entry = self.commands.setdefault(command, [0, 0.0, 0])
+            entry[0] += 1
+            entry[1] += seconds
+            if returncode: entry[2] += 1
+        finally:
+            self._lock.release()
+
+    def record_dump(self, dataset, filename, stages, seconds, success=True, pool=None):
+        """Record a dump of a dataset of pool, completed or not, from the stages of its send pipeline."""
+        source, sink = stages[0], stages[-1]
+        bytes_in = source.bytes_out
+        bytes_out = sink.bytes_in
+        dump = {
+            'dataset': dataset or '/',
+            'pool': pool or '',
+            'file': filename,
+            'success': success,
+            'seconds': seconds,
+            'bytes_in': bytes_in,
+            'bytes_out': bytes_out,
+            'ratio': bytes_out and float(bytes_in) / bytes_out or 0.0,
+            'mbps': seconds and bytes_in / seconds / (1024 * 1024) or 0.0,
+            'stages': [dict(s.stats(), name=s.name, seconds=s.elapsed, bytes_in=s.bytes_in, bytes_out=s.bytes_out, returncode=s.returncode) for s in stages],
+        }
+        self._lock.acquire()
+        try:
+            self.dumps.append(dump)
+        finally:
+            self._lock.release()
+        for stage in stages:
+            self.record_stage(stage.name, stage.elapsed, dataset=dump['dataset'], pool=dump['pool'])
+
+    def finish(self, success=True):
+        self.finished = time.time()
+        self.success = success
+
+    def report(self):
+        """Return the metrics as a JSON-serializable dict."""
+        finished = self.finished or time.time()
+        bytes_in = sum([dump['bytes_in'] for dump in self.dumps])
+        bytes_out = sum([dump['bytes_out'] for dump in self.dumps])
+        return {
+            'labels': self.labels,
+            'started': self.started,
+            'seconds': finished - self.started,
+            'success': self.success,
+            'bytes_in': bytes_in,
+            'bytes_out': bytes_out,
+            'ratio': bytes_out and float(bytes_in) / bytes_out or 0.0,
+            'stages': [dict(labels, stage=stage, count=entry[0], seconds=entry[1]) for (stage, labels), entry in sorted(self.stages.items())],
+            'commands': [{'command': command, 'count': entry[0], 'seconds': entry[1], 'failures': entry[2]} for command, entry in sorted(self.commands.items())],
+            'dumps': self.dumps,
+        }
+
+    def write_json(self, path):
+        _write_atomically(path, json.dumps(self.report(), indent=2, sort_keys=True) + '\n')
+
+    def write_prometheus(self, path):
+        """Write the metrics in the format of the node exporter textfile collector."""
+        report = self.report()
+        lines = []
+        def metric(name, help, samples):
+            lines.append('# HELP zfsbackup_%s %s' % (name, help))
+            lines.append('# TYPE zfsbackup_%s gauge' % name)
+            for labels, value in samples:
+                labels = dict(self.labels, **labels)
+                labelstr = ','.join(['%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in sorted(labels.items())])
+                lines.append('zfsbackup_%s{%s} %s' % (name, labelstr, repr(float(value))))
+        metric('run_start_timestamp_seconds', 'Start time of the last run.', [({}, report['started'])])
+        metric('run_seconds', 'Duration of the last run.', [({}, report['seconds'])])
+        metric('run_success', 'Whether the last run completed successfully.', [({}, report['success'] and 1 or 0)])
+        metric('stage_seconds', 'Time spent in each stage during the last run.',
+                [(dict([(k, v) for k, v in stage.items() if k not in ('count', 'seconds')]), stage['seconds']) for stage in report['stages']])
+        metric('command_runs', 'External commands run during the last run.', [({'command': c['command']}, c['count']) for c in report['commands']])
+        metric('command_seconds', 'Time spent running external commands during the last run.', [({'command': c['command']}, c['seconds']) for c in report['commands']])
+        metric('command_failures', 'External commands which exited with an error during the last run.', [({'command': c['command']}, c['failures']) for c in report['commands']])
+        metric('dump_bytes_in', 'Bytes of send stream dumped in the last run.', [({'dataset': d['dataset'], 'pool': d['pool']}, d['bytes_in']) for d in report['dumps']])
+        metric('dump_bytes_out', 'Bytes written by the dumps of the last run.', [({'dataset': d['dataset'], 'pool': d['pool']}, d['bytes_out']) for d in report['dumps']])
+        metric('dump_compression_ratio', 'Stream bytes per written byte in the last run.', [({'dataset': d['dataset'], 'pool': d['pool']}, d['ratio']) for d in report['dumps']])
+        metric('dump_throughput_mbytes_per_second', 'Stream MB/s of the dumps of the last run.', [({'dataset': d['dataset'], 'pool': d['pool']}, d['mbps']) for d in report['dumps']])
+        metric('dump_seconds', 'Duration of the dumps of the last run.', [({'dataset': d['dataset'], 'pool': d['pool']}, d['seconds']) for d in report['dumps']])
+        metric('dump_success', 'Whether the dumps of the last run completed.', [({'dataset': d['dataset'], 'pool': d['pool']}, d['success'] and 1 or 0) for d in report['dumps']])
+        buffers = [(d, s) for d in report['dumps'] for s in d['stages'] if 'producer_stalled' in s]
+        if buffers:
+            metric('dump_buffer_stalled_seconds', 'Time each side of the dump buffer waited for the other in the last run.',
+                    [({'dataset': d['dataset'], 'pool': d['pool'], 'side': side}, s[side + '_stalled']) for d, s in buffers for side in ('producer', 'consumer')])
+        _write_atomically(path, '\n'.join(lines) + '\n')
+
+
+def _write_atomically(path, content):
+    """Write a file so that readers never see it half written."""
+    tmppath = '%s.%d.tmp' % (path, os.getpid())
+    f = open(tmppath, 'w')
+    try:
+        f.write(content)
+    finally:
+        f.close()
+    os.rename(tmppath, path)
+
+
+# metrics of the current run
+_metrics = Metrics()
+
+
+def get_metrics():
+    return _metrics
+
+
+def reset(labels=None):
+    """Start recording a new run."""
+    global _metrics
+    _metrics = Metrics(labels)
+    return _metrics
+
+
+def record_command(args, seconds, returncode):
+    _metrics.record_command(args, seconds, returncode)
+
+
+def record_stage(stage, seconds, **labels):
+    _metrics.record_stage(stage, seconds, **labels)
+
+
+@contextmanager
+def timed(stage, **labels):
+    """Account the time spent in the with block to a stage."""
+    started = time.time()
+    try:
+        yield
+    finally:
+        _metrics.record_stage(stage, time.time() - started, **labels)
+
+
+def stage(name):
+    """Decorator accounting the time spent in a function to a stage."""
+    def _decorator(f):
+        def _timed(*args, **kwargs):
+            with timed(name):
+                return f(*args, **kwargs)
+        _timed.__name__ = f.__name__
+        _timed.__doc__ = f.__doc__
+        return _timed
+    return _decorator
@@ -0,0 +1,905 @@
+#
+# Copyright (c) 2010, Mij <mij@sshguard.net>
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and
+#   the following disclaimer in the documentation and/or other materials provided
+#   with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+# 
+
+#
+# See http://mij.oltrelinux.com/devel/zfsbackup/
+# Bitch to mij@sshguard.net
+#
+
+
+# module pipeline
+import collections
+import hashlib
+import io
+import os
+import subprocess
+import threading
+import time
+import zlib
+from multiprocessing.pool import ThreadPool
+
+import engine
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+# size of the buffer zfs send output is read into
+DEFAULT_BUFSIZE = 1024 * 1024
+
+# size of the blocks compressed independently by parallel compression
+DEFAULT_BLOCKSIZE = 4 * 1024 * 1024
+
+# fill levels (percent) at which a stalled ring buffer side resumes
+DEFAULT_LOW_WATERMARK = 10
+DEFAULT_HIGH_WATERMARK = 90
+
+
+### CODECS
+
+class Codec(object):
+    """A compression format dump files can be written in."""
+    name = 'none'
+    suffix = ''
+
+    def available(self):
+        """Return whether the codec can be used on this system."""
+        return True
+
+    def compressor(self):
+        """Return a new object with compress(data) and flush() methods."""
+        raise NotImplementedError
+
+    def decompressor(self):
+        """Return a new object with a decompress(data) method reading the whole
+        file, made of one or more members/frames."""
+        return _NullDecompressor()
+
+
+class _NullDecompressor(object):
+    def decompress(self, data):
+        return data
+
+
+class _MultiMemberDecompressor(object):
+    """Decompress concatenated members/frames, each needing a decompressor of its own."""
+    def __init__(self, factory):
+        self._factory = factory
+        self._decompressor = factory()
+
+    def decompress(self, data):
+        out = []
+        while data:
+            out.append(self._decompressor.decompress(data))
+            # what follows the end of a member is the start of the next one
+            data = self._decompressor.unused_data
+            if data: self._decompressor = self._factory()
+        return ''.join(out)
+
+
+class GzipCodec(Codec):
+    name = 'gzip'
+    suffix = '.gz'
+
+    def __init__(self, level=2):
+        self.level = level
+
+    def compressor(self):
+        # wbits 31 = gzip header and trailer, readable by gzip(1)
+        return zlib.compressobj(self.level, zlib.DEFLATED, 31)
+
+    def decompressor(self):
+        return _MultiMemberDecompressor(lambda: zlib.decompressobj(31))
+
+
+class ZstdCodec(Codec):
+    name = 'zstd'
+    suffix = '.zst'
+
+    def __init__(self, level=3):
+        self.level = level
+
+    def available(self):
+        return zstandard is not None
+
+    def compressor(self):
+        return zstandard.ZstdCompressor(level=self.level).compressobj()
+
+    def decompressor(self):
+        return _MultiMemberDecompressor(lambda: zstandard.ZstdDecompressor().decompressobj())
+
+
+class _Lz4Compressor(object):
+    """Adapt the lz4 frame compressor to the compress()/flush() interface."""
+    def __init__(self):
+        self._lz4 = lz4.frame.LZ4FrameCompressor()
+        self._header = self._lz4.begin()
+
+    def compress(self, data):
+        out = self._header + self._lz4.compress(data)
+        self._header = ''
+        return out
+
+    def flush(self):
+        return self._header + self._lz4.flush()
+
+
+class Lz4Codec(Codec):
+    name = 'lz4'
+    suffix = '.lz4'
+
+    def available(self):
+        return lz4 is not None
+
+    def compressor(self):
+        return _Lz4Compressor()
+
+    def decompressor(self):
+        return _MultiMemberDecompressor(lz4.frame.LZ4FrameDecompressor)
+
+
+CODECS = {
+    'none': Codec,
+    'gzip': GzipCodec,
+    'zstd': ZstdCodec,
+    'lz4': Lz4Codec,
+}
+
+
+def get_codec(name):
+    """Return the codec with the given name, checking it can be used here."""
+    if name not in CODECS:
+        raise Exception("Unknown compression codec '%s'. Choose among: %s" % (name, ', '.join(sorted(CODECS.keys()))))
+    codec = CODECS[name]()
+    if not codec.available():
+        raise Exception("Codec '%s' needs a python module which is not installed" % name)
+    return codec
+
+
+### CHECKSUMS
+
+HASHES = {
+    'sha256': hashlib.sha256,
+}
+if xxhash is not None:
+    HASHES['xxh64'] = xxhash.xxh64
+    if hasattr(xxhash, 'xxh3_64'):
+        HASHES['xxh3'] = xxhash.xxh3_64
+
+
+def get_hashes(names):
+    """Return the list of checksum names in a comma separated string, checking
+    they can be computed here. 'none' means no checksums."""
+    names = [name.strip() for name in names.split(',') if name.strip() and name.strip() != 'none']
+    for name in names:
+        if name not in HASHES:
+            raise Exception("Checksum '%s' is unknown or needs a python module which is not installed. Choose among: %s" % (name, ', '.join(sorted(HASHES.keys()))))
+    return names
+
+
+### STAGES
+
+class Stage(object):
+    """A step of the send pipeline, keeping track of the data flowing through it.
+
+    Stages get the data of the stream in process() and return what to pass on
+    to the next stage; finish() returns whatever is left when the stream ends.
+    The data passed in is only valid during the call."""
+    name = 'stage'
+
+    def __init__(self):
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.elapsed = 0.0
+        self.returncode = None
+
+    def process(self, data):
+        return data
+
+    def finish(self):
+        return ''
+
+    def sync(self):
+        """Make everything received so far independent of what follows.
+
+        Return the data to pass on. Once every stage has synced, the output up
+        to this point is a valid prefix the stream can be resumed after."""
+        return ''
+
+    def skipped(self, data):
+        """Receive raw data that a resumed dump skips, not to be passed on."""
+        pass
+
+    def close(self):
+        """Release resources. Called on success and failure alike."""
+        pass
+
+    def stats(self):
+        """Return a dict of figures the stage reports besides bytes and time."""
+        return {}
+
+    def throughput(self):
+        """Return the MB/s the stage handled while busy."""
+        if not self.elapsed: return 0.0
+        return max(self.bytes_in, self.bytes_out) / self.elapsed / (1024 * 1024)
+
+    def report(self):
+        status = self.returncode
+        if status is None: status = '-'
+        return "%s: exit %s, %d bytes in, %d bytes out, %.1f sec, %.1f MB/s" % (self.name, status, self.bytes_in, self.bytes_out, self.elapsed, self.throughput())
+
+
+class CodecStage(Stage):
+    """Compress the stream with a codec."""
+    def __init__(self, codec):
+        Stage.__init__(self)
+        self.codec = codec
+        self.name = codec.name
+        self._compressor = codec.compressor()
+
+    def process(self, data):
+        return self._compressor.compress(data)
+
+    def finish(self):
+        return self._compressor.flush()
+
+    def sync(self):
+        # end the current member/frame and start a new one
+        out = self._compressor.flush()
+        self._compressor = self.codec.compressor()
+        return out
+
+
+class HashStage(Stage):
+    """Compute checksums of the data passing through, leaving it untouched.
+
+    Placed before the codecs, a raw stage hashes the send stream, including the
+    data a resumed dump skips; placed after them, it hashes the bytes written
+    to the file, and prime_file() accounts for what an interrupted dump already
+    wrote there."""
+    def __init__(self, hashes, raw=False):
+        Stage.__init__(self)
+        self.raw = raw
+        self.name = '%s %s' % (raw and 'hash raw' or 'hash', '+'.join(hashes))
+        self._hashes = [(name, HASHES[name]()) for name in hashes]
+
+    def _update(self, data):
+        for name, h in self._hashes:
+            h.update(data)
+
+    def process(self, data):
+        self._update(data)
+        return data
+
+    def skipped(self, data):
+        if self.raw: self._update(data)
+
+    def prime_file(self, path, length, bufsize=DEFAULT_BUFSIZE):
+        """Hash the first length bytes of a file."""
+        f = open(path, 'rb')
+        try:
+            while length > 0:
+                data = f.read(min(bufsize, length))
+                if not data:
+                    raise Exception("File '%s' is shorter than expected" % path)
+                self._update(data)
+                length -= len(data)
+        finally:
+            f.close()
+
+    def digests(self):
+        """Return {checksum name: hex digest} of the data seen so far."""
+        return dict([(name, h.hexdigest()) for name, h in self._hashes])
+
+
+def _compress_block(codec, data):
+    """Compress a block into a self-contained gzip member or zstd/lz4 frame."""
+    compressor = codec.compressor()
+    return compressor.compress(data) + compressor.flush()
+
+
+class ParallelCodecStage(Stage):
+    """Compress the stream on several cores.
+
+    The stream is cut into fixed-size blocks, each compressed on a thread pool
+    into a member (gzip) or frame (zstd, lz4) of its own. Blocks are written in
+    order, and the concatenation is a regular multi-member file that the stock
+    decompressors read like any other. The codecs release the GIL while
+    compressing, so threads scale with cores."""
+    def __init__(self, codec, workers, blocksize=DEFAULT_BLOCKSIZE):
+        Stage.__init__(self)
+        self.codec = codec
+        self.name = '%s x%d' % (codec.name, workers)
+        self.workers = workers
+        self.blocksize = blocksize
+        self._pool = ThreadPool(workers)
+        self._pending = collections.deque()
+        self._partial = []
+        self._partial_len = 0
+
+    def _submit(self, block):
+        self._pending.append(self._pool.apply_async(_compress_block, (self.codec, block)))
+
+    def _collect(self, wait_all=False):
+        """Return the compressed blocks completed so far, in stream order.
+
+        Wait for the oldest blocks as long as too many are in flight, so memory
+        stays bounded to a couple of blocks per worker."""
+        out = []
+        while self._pending:
+            if not wait_all and len(self._pending) <= 2 * self.workers and not self._pending[0].ready():
+                break
+            out.append(self._pending.popleft().get())
+        return ''.join(out)
+
+    def process(self, data):
+        # data is only valid during this call: keep a copy
+        self._partial.append(str(data))
+        self._partial_len += len(data)
+        if self._partial_len >= self.blocksize:
+            pending = ''.join(self._partial)
+            cut = len(pending) - len(pending) % self.blocksize
+            for offset in xrange(0, cut, self.blocksize):
+                self._submit(pending[offset:offset + self.blocksize])
+            self._partial = [pending[cut:]]
+            self._partial_len = len(pending) - cut
+        return self._collect()
+
+    def finish(self):
+        if self._partial_len:
+            self._submit(''.join(self._partial))
+            self._partial, self._partial_len = [], 0
+        return self._collect(wait_all=True)
+
+    def sync(self):
+        return self.finish()
+
+    def close(self):
+        self._pool.terminate()
+        self._pool.join()
+
+
+class BufferStage(Stage):
+    """Decouple the stages before from the stages after it, like mbuffer.
+
+    Data is copied into a ring buffer of fixed size and handed to the
+    following stages by a thread of their own, so a bursty producer and a
+    bursty consumer each run at their own pace as long as the buffer absorbs
+    the difference. A producer stalled on a full buffer resumes once it
+    drains to the high watermark; a consumer stalled on an empty buffer
+    resumes once it fills to the low watermark. The time each side spends
+    stalled tells which one is the bottleneck. With max_stall, a producer
+    stalled longer than that many seconds at once gets an exception, and so
+    does a drain during which the consumer passes nothing on for that long."""
+    def __init__(self, size, low=DEFAULT_LOW_WATERMARK, high=DEFAULT_HIGH_WATERMARK, max_stall=None):
+        Stage.__init__(self)
+        self.name = 'buffer %dMB' % (size / (1024 * 1024))
+        self.size = size
+        self.max_stall = max_stall
+        self.low = size * low / 100
+        self.high = size * high / 100
+        self.producer_stalled = 0.0
+        self.consumer_stalled = 0.0
+        self.max_fill = 0
+        self._ring = bytearray(size)
+        self._start = 0         # where the data to consume begins
+        self._fill = 0          # how much data there is
+        self._busy = False      # whether the consumer is passing data on
+        self._ending = False    # whether no more data comes until the consumer is idle
+        self._stopped = False
+        self._error = None
+        self._downstream = None
+        self._thread = None
+        self._cond = threading.Condition()
+
+    def start(self, downstream):
+        """Start passing the data on by calling downstream(data) from a thread."""
+        self._downstream = downstream
+        self._thread = threading.Thread(target=self._consume)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _check(self):
+        if self._error is not None:
+            raise self._error
+
+    def process(self, data):
+        offset = 0
+        while offset < len(data):
+            self._cond.acquire()
+            try:
+                self._check()
+                if self._fill == self.size:
+                    started = time.time()
+                    while self._fill > self.high and self._error is None:
+                        if self.max_stall is None:
+                            self._cond.wait()
+                            continue
+                        waited = time.time() - started
+                        if waited >= self.max_stall:
+                            self.producer_stalled += waited
+                            raise Exception("Output stalled the stream for %.1f sec" % waited)
+                        self._cond.wait(self.max_stall - waited)
+                    self.producer_stalled += time.time() - started
+                    self._check()
+                end = (self._start + self._fill) % self.size
+                count = min(len(data) - offset, self.size - self._fill, self.size - end)
+            finally:
+                self._cond.release()
+            # only the producer writes into free space: copy without the lock
+            self._ring[end:end + count] = buffer(data, offset, count)
+            offset += count
+            self._cond.acquire()
+            try:
+                self._fill += count
+                self.max_fill = max(self.max_fill, self._fill)
+                self._cond.notify_all()
+            finally:
+                self._cond.release()
+        return ''
+
+    def _consume(self):
+        while True:
+            self._cond.acquire()
+            try:
+                self._busy = False
+                self._cond.notify_all()
+                if not self._fill:
+                    started = time.time()
+                    while not self._stopped and not (self._fill and (self._ending or self._fill >= self.low)):
+                        self._cond.wait()
+                    self.consumer_stalled += time.time() - started
+                if self._stopped: return
+                self._busy = True
+                start, count = self._start, min(self._fill, self.size - self._start)
+            finally:
+                self._cond.release()
+            try:
+                self._downstream(buffer(self._ring, start, count))
+            except BaseException as e:
+                self._cond.acquire()
+                self._error = e
+                self._busy = False
+                self._cond.notify_all()
+                self._cond.release()
+                return
+            self._cond.acquire()
+            try:
+                self.bytes_out += count
+                self._start = (self._start + count) % self.size
+                self._fill -= count
+            finally:
+                self._cond.release()
+
+    def _drain(self):
+        """Wait until the consumer passed on all the data."""
+        self._cond.acquire()
+        try:
+            self._ending = True
+            self._cond.notify_all()
+            started, fill = time.time(), self._fill
+            while (self._fill or self._busy) and self._error is None:
+                if self.max_stall is None:
+                    self._cond.wait()
+                    continue
+                if self._fill != fill:
+                    started, fill = time.time(), self._fill
+                waited = time.time() - started
+                if waited >= self.max_stall:
+                    raise Exception("Output stalled the stream for %.1f sec" % waited)
+                self._cond.wait(self.max_stall - waited)
+            self._ending = False
+            self._check()
+        finally:
+            self._cond.release()
+
+    def sync(self):
+        self._drain()
+        return ''
+
+    def finish(self):
+        self._drain()
+        return ''
+
+    def stop(self):
+        """Have the consumer stop passing data on, once done with the data at hand."""
+        self._cond.acquire()
+        self._stopped = True
+        self._cond.notify_all()
+        self._cond.release()
+
+    def close(self):
+        self.stop()
+        if self._thread is not None:
+            self._thread.join()
+
+    def stats(self):
+        return {'producer_stalled': self.producer_stalled, 'consumer_stalled': self.consumer_stalled, 'max_fill': self.max_fill}
+
+    def report(self):
+        if self.producer_stalled > self.consumer_stalled:
+            bottleneck = 'after the buffer'
+        else:
+            bottleneck = 'before the buffer'
+        return "%s, producer stalled %.1f sec, consumer stalled %.1f sec, peak fill %d%% (bottleneck %s)" % (Stage.report(self),
+                self.producer_stalled, self.consumer_stalled, self.max_fill * 100 / self.size, bottleneck)
+
+
+class FileSink(Stage):
+    """Write the stream into a file.
+
+    If offset is given, the file is truncated there and written on from that point."""
+    name = 'write'
+
+    def __init__(self, path, offset=None):
+        Stage.__init__(self)
+        self.path = path
+        if offset is None:
+            self.start_offset = 0
+            self._file = open(path, 'wb')
+        else:
+            self.start_offset = offset
+            self._file = open(path, 'r+b')
+            self._file.truncate(offset)
+            self._file.seek(offset)
+
+    def fileno(self):
+        return self._file.fileno()
+
+    def offset(self):
+        """Return the position in the file written so far."""
+        return self.start_offset + self.bytes_in
+
+    def sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        return ''
+
+    def process(self, data):
+        self._file.write(data)
+        return ''
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+
+
+### FAN-OUT
+
+class Branch(object):
+    """One of the outputs of a TeeSink: its own stages and sink.
+
+    With a buffer size, the branch is fed through a BufferStage of its own and
+    runs at its own pace; with max_stall as well, a branch holding the stream
+    back longer than that many seconds fails. A failed branch that is required
+    fails the whole stream; otherwise it is dropped and the others go on."""
+    def __init__(self, name, stages, sink, buffer=0, required=True, max_stall=None):
+        self.name = name
+        self.stages = stages
+        self.sink = sink
+        self.required = required
+        self.error = None
+        self.closed = False
+        self.buffer = None
+        if buffer:
+            self.buffer = BufferStage(buffer, max_stall=max_stall)
+            self.buffer.start(self._feed)
+
+    def all_stages(self):
+        return (self.buffer and [self.buffer] or []) + self.stages + [self.sink]
+
+    def _feed(self, data, first=0):
+        """Pass data through the stages of the branch from the given position to its sink."""
+        for stage in self.stages[first:] + [self.sink]:
+            if not data: return
+            stage.bytes_in += len(data)
+            started = time.time()
+            data = stage.process(data)
+            stage.elapsed += time.time() - started
+            stage.bytes_out += len(data)
+
+    def process(self, data):
+        if self.buffer is None:
+            return self._feed(data)
+        self.buffer.bytes_in += len(data)
+        started = time.time()
+        self.buffer.process(data)
+        self.buffer.elapsed += time.time() - started
+
+    def finish(self):
+        if self.buffer is not None: self.buffer.finish()
+        for i, stage in enumerate(self.stages):
+            started = time.time()
+            data = stage.finish()
+            stage.elapsed += time.time() - started
+            stage.bytes_out += len(data)
+            self._feed(data, i + 1)
+        self.sink.finish()
+        for stage in self.all_stages():
+            if stage.returncode is None: stage.returncode = 0
+
+    def close(self):
+        if self.closed: return
+        self.closed = True
+        if self.buffer is not None: self.buffer.stop()
+        # a sink stuck delivering holds the buffer thread: close it first
+        self.sink.close()
+        for stage in self.all_stages()[:-1]:
+            stage.close()
+
+
+class TeeSink(Stage):
+    """Fan the stream out to several branches, so it is read once for all of them.
+
+    Each branch has its own stages (its codec, its checksums), its own sink
+    and, if it has a buffer, its own thread: a slow branch holds the others
+    back only once its buffer is full. Not resumable."""
+    name = 'tee'
+
+    def __init__(self, branches):
+        Stage.__init__(self)
+        self.branches = branches
+
+    def live(self):
+        """Return the branches that did not fail."""
+        return [branch for branch in self.branches if branch.error is None]
+
+    def _fail(self, branch, error):
+        branch.error = error
+        if branch.sink.returncode is None: branch.sink.returncode = 1
+        if branch.required:
+            raise
+        print "Output %s failed, dropped: %s" % (branch.name, error)
+        branch.close()
+
+    def process(self, data):
+        for branch in self.live():
+            try:
+                branch.process(data)
+            except Exception as e:
+                self._fail(branch, e)
+        return ''
+
+    def finish(self):
+        for branch in self.live():
+            try:
+                branch.finish()
+            except Exception as e:
+                self._fail(branch, e)
+        return ''
+
+    def close(self):
+        for branch in self.branches:
+            branch.close()
+
+    def stats(self):
+        return {'outputs': len(self.branches), 'failed': [branch.name for branch in self.branches if branch.error is not None]}
+
+    def report(self):
+        lines = [Stage.report(self)]
+        for branch in self.branches:
+            status = branch.error is None and 'ok' or 'failed: %s' % branch.error
+            lines.append("  %s (%s)" % (branch.name, status))
+            lines.extend(["    %s" % stage.report() for stage in branch.all_stages()])
+        return '\n'.join(lines)
+
+
+### PIPELINE
+
+class SendPipeline(object):
+    """Run a command and stream its output through stages into a sink.
+
+    Data is read from the command through one reusable buffer. When no stage
+    needs to see the data and the sink is a file, the command writes into the
+    file directly and no data is copied through this process.
+
+    If a checkpoint function is given, every checkpoint_interval bytes of the
+    stream all stages are synced and checkpoint(raw_offset, raw_crc, file_offset)
+    is called: the output up to there is durable and the stream can be resumed later by
+    running the same command with skip=raw_offset and skip_crc=raw_crc.
+
+    A priority object, if given, has its preexec() run in the command before
+    it starts and its apply(pid) called once it runs."""
+    def __init__(self, args, sink, stages=None, bufsize=DEFAULT_BUFSIZE, checkpoint=None, checkpoint_interval=None, skip=0, skip_crc=None, priority=None):
+        self.args = args
+        self.priority = priority
+        self.sink = sink
+        self.stages = stages or []
+        self.bufsize = bufsize
+        self.source = Stage()
+        self.source.name = args[0] + ' ' + args[1]
+        self.checkpoint = checkpoint
+        self.checkpoint_interval = checkpoint_interval
+        self.skip = skip
+        self.skip_crc = skip_crc
+        # offset and crc32 of the raw stream read so far, including skipped data
+        self.raw_offset = 0
+        self.raw_crc = 0
+        # how deep each thread is in _feed: buffer stages feed from threads of their own
+        self._local = threading.local()
+
+    def all_stages(self):
+        return [self.source] + self.stages + [self.sink]
+
+    def _start_buffers(self):
+        """Have buffer stages pass their data on to the stages following them."""
+        for i, stage in enumerate(self.stages):
+            if isinstance(stage, BufferStage):
+                stage.start(lambda data, first=i + 1: self._feed(data, first))
+
+    def _feed(self, data, first=0):
+        """Pass data through the stages from the given position to the sink."""
+        self._local.depth = self._feeding() + 1
+        try:
+            for stage in self.stages[first:] + [self.sink]:
+                if not data: return
+                stage.bytes_in += len(data)
+                started = time.time()
+                data = stage.process(data)
+                stage.elapsed += time.time() - started
+                # a buffer counts what its own thread passes on
+                if not isinstance(stage, BufferStage): stage.bytes_out += len(data)
+        finally:
+            self._local.depth -= 1
+
+    def _feeding(self):
+        """Return how many feeds the calling thread is in the middle of."""
+        return getattr(self._local, 'depth', 0)
+
+    def _sync(self):
+        """Sync all stages and record a checkpoint."""
+        for i, stage in enumerate(self.stages):
+            data = stage.sync()
+            stage.bytes_out += len(data)
+            self._feed(data, i + 1)
+        self.sink.sync()
+        self.checkpoint(self.raw_offset, self.raw_crc, self.sink.offset())
+
+    def run(self):
+        """Run the pipeline to completion. Return the list of stages."""
+        try:
+            if not self.stages and not self.checkpoint and not self.skip and hasattr(self.sink, 'fileno'):
+                self._run_direct()
+            else:
+                self._start_buffers()
+                self._run_buffered()
+            # flush what is left in each stage down the pipeline
+            for i, stage in enumerate(self.stages):
+                started = time.time()
+                data = stage.finish()
+                stage.elapsed += time.time() - started
+                stage.bytes_out += len(data)
+                self._feed(data, i + 1)
+            # let the sink complete the delivery, unless the stream is broken
+            if not self.source.returncode: self.sink.finish()
+        finally:
+            for stage in self.stages + [self.sink]:
+                stage.close()
+        for stage in self.stages + [self.sink]:
+            if stage.returncode is None: stage.returncode = 0
+        if self.source.returncode:
+            raise Exception("Error executing '%s': %d" % (' '.join(self.args), self.source.returncode))
+        return self.all_stages()
+
+    def _spawn(self, stdout):
+        # started on the command engine, so the task running the pipeline can cancel it
+        if self.priority is None:
+            return engine.get_engine().popen(self.args, stdout=stdout)
+        p = engine.get_engine().popen(self.args, stdout=stdout, preexec_fn=self.priority.preexec)
+        self.priority.apply(p.pid)
+        return p
+
+    def _wait(self, p):
+        """Wait for the command, killing it if we are interrupted meanwhile."""
+        try:
+            p.wait()
+        except BaseException:
+            terminate(p)
+            raise
+        engine.get_engine().release(p)
+        self.source.returncode = p.returncode
+        # stopped by a cancelled task: not a failure of the command itself
+        task = engine.get_engine().current_task()
+        if task is not None: task._check()
+
+    def _run_direct(self):
+        started = time.time()
+        p = self._spawn(stdout=self.sink.fileno())
+        self._wait(p)
+        self.source.elapsed = self.sink.elapsed = time.time() - started
+        size = os.fstat(self.sink.fileno()).st_size
+        self.source.bytes_out = self.sink.bytes_in = size
+
+    def _run_buffered(self):
+        p = self._spawn(stdout=subprocess.PIPE)
+        try:
+            reader = io.open(p.stdout.fileno(), 'rb', buffering=0, closefd=False)
+            buf = bytearray(self.bufsize)
+            last_checkpoint = self.skip
+            while True:
+                started = time.time()
+                n = reader.readinto(buf)
+                self.source.elapsed += time.time() - started
+                if not n: break
+                self.source.bytes_out += n
+                data = buffer(buf, 0, n)
+                if self.raw_offset < self.skip:
+                    data = self._skip(data)
+                    if not data: continue
+                if self.checkpoint:
+                    self.raw_crc = zlib.crc32(data, self.raw_crc)
+                self.raw_offset += len(data)
+                self._feed(data)
+                if self.checkpoint and self.raw_offset - last_checkpoint >= self.checkpoint_interval:
+                    self._sync()
+                    last_checkpoint = self.raw_offset
+            if self.raw_offset < self.skip:
+                raise ResumeError("Stream of '%s' ended before the resume point" % ' '.join(self.args))
+        except BaseException:
+            terminate(p)
+            if self.checkpoint and not self._feeding() and self.raw_offset > self.skip:
+                # interrupted between two chunks: what we have is consistent
+                try:
+                    self._sync()
+                except Exception:
+                    pass
+            raise
+        p.stdout.close()
+        self._wait(p)
+
+
+    def _skip(self, data):
+        """Discard data already written by an earlier run. Return what is left of data."""
+        count = min(len(data), self.skip - self.raw_offset)
+        self.raw_crc = zlib.crc32(buffer(data, 0, count), self.raw_crc)
+        for stage in self.stages:
+            stage.skipped(buffer(data, 0, count))
+        self.raw_offset += count
+        if self.raw_offset == self.skip and self.skip_crc is not None and self.raw_crc != self.skip_crc:
+            raise ResumeError("Stream of '%s' differs from the interrupted one" % ' '.join(self.args))
+        return buffer(data, count)
+
+
+class ResumeError(Exception):
+    """The stream cannot be resumed from a checkpoint."""
+    pass
+
+
+def terminate(p):
+    """Stop a child process and reap it, killing it if it does not exit on SIGTERM."""
+    engine.get_engine().reap(p)
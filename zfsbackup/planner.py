@@ -0,0 +1,155 @@
+#
+# Copyright (c) 2010, Mij <mij@sshguard.net>
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and
+#   the following disclaimer in the documentation and/or other materials provided
+#   with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+# 
+
+#
+# See http://mij.oltrelinux.com/devel/zfsbackup/
+# Bitch to mij@sshguard.net
+#
+
+
+# module planner
+import engine
+import metrics
+import zfs
+
+# user property recording on a snapshot how many dumps restoring it takes after a full
+DEPTH_PROPERTY = 'zfsbackup:depth'
+
+# throughput assumed to estimate dump durations, in MB/s
+DEFAULT_RATE = 100
+
+# how many base snapshots to evaluate, most recent first
+DEFAULT_CANDIDATES = 3
+
+
+class DumpOption(object):
+    """A way to dump a snapshot: full (base None) or incremental from base."""
+    def __init__(self, base, depth, size):
+        self.base = base
+        self.depth = depth
+        self.size = size
+
+    def describe(self):
+        if self.base is None: return 'full'
+        return 'incremental from %s' % self.base
+
+
+class DumpPlan(object):
+    """The options evaluated to dump a snapshot, and the one chosen."""
+    def __init__(self, snapname, dataset, options, chosen, rate=DEFAULT_RATE):
+        self.snapname = snapname
+        self.dataset = dataset
+        self.options = options
+        self.chosen = chosen
+        self.rate = rate
+
+    def estimated_seconds(self, option):
+        if option.size is None: return None
+        return option.size / (self.rate * 1024.0 * 1024.0)
+
+    def report(self):
+        """Return a printable table of the plan."""
+        lines = ["Dump plan for '%s%s':" % (self.dataset or '/', '@' + self.snapname)]
+        for option in self.options:
+            if option.size is None:
+                estimate = 'size unknown'
+            else:
+                estimate = '%.1f MB, ~%.0f sec' % (option.size / (1024.0 * 1024.0), self.estimated_seconds(option))
+            mark = (option is self.chosen) and '*' or ' '
+            lines.append(' %s %-60s chain %d, %s' % (mark, option.describe(), option.depth + 1, estimate))
+        return '\n'.join(lines)
+
+
+def positional_depth(index, alternate=False):
+    """Return the chain depth of the index-th snapshot of a series under the fixed schemes."""
+    if not alternate:
+        return index
+    # 0, 0-1, 0-2, 1-3, 2-4, ...
+    depth = 0
+    while index > 0:
+        depth += 1
+        index -= 2
+    return depth
+
+
+def get_depths(previous_snaps, dataset='', alternate=False, zpool=None):
+    """Return the chain depth of each previous snapshot.
+
+    Depths recorded on the snapshots by earlier planned dumps win; the others
+    follow from their position in the series."""
+    recorded = zfs.get_snapshot_property(previous_snaps, DEPTH_PROPERTY, dataset, zpool=zpool)
+    depths = {}
+    for i, snap in enumerate(previous_snaps):
+        if recorded.get(snap, '').isdigit():
+            depths[snap] = int(recorded[snap])
+        else:
+            depths[snap] = positional_depth(i, alternate)
+    return depths
+
+
+def _estimate(snapname, base, dataset, recursive, zpool):
+    """Return the predicted stream size of a full (base None) or incremental dump, or None."""
+    size = zfs.estimate_send_size(zfs.send_command(snapname, dataset, snapname_from=base, recursive=recursive, zpool=zpool))
+    if size is None and base is not None:
+        size = zfs.get_written(snapname, base, dataset, recursive=recursive, zpool=zpool)
+    return size
+
+
+@metrics.stage('plan')
+def plan_dump(snapname, previous_snaps, dataset='', recursive=True, max_chain=None, rate=DEFAULT_RATE,
+        candidates=DEFAULT_CANDIDATES, alternate=False, zpool=None):
+    """Choose how to dump a snapshot sending the fewest bytes.
+
+    Candidates are a full dump and incrementals from the most recent previous
+    snapshots whose chain stays within max_chain dumps (None = no limit). The
+    size of each is predicted with a 'zfs send' dry run, falling back to the
+    written@ property of the base. The dry runs of all candidates run
+    concurrently on the command engine."""
+    zpool = zpool or zfs.get_default_pool()
+    depths = get_depths(previous_snaps, dataset, alternate, zpool=zpool)
+    bases = [None]
+    for base in reversed(previous_snaps):
+        if len(bases) > candidates: break
+        if max_chain is not None and depths[base] + 2 > max_chain: continue
+        bases.append(base)
+    cmdengine = engine.get_engine()
+    estimates = cmdengine.wait_all([cmdengine.spawn(_estimate, snapname, base, dataset, recursive, zpool) for base in bases])
+    options = [DumpOption(None, 0, estimates[0])]
+    for base, size in zip(bases[1:], estimates[1:]):
+        options.append(DumpOption(base, depths[base] + 1, size))
+    known = [option for option in options if option.size is not None]
+    if known:
+        chosen = min(known, key=lambda option: (option.size, option.depth))
+    else:
+        # no estimate at all: the incremental from the most recent base, if any, has the shortest stream and chain
+        chosen = len(options) > 1 and options[1] or options[0]
+    return DumpPlan(snapname, dataset, options, chosen, rate)
+
+
+def record_depth(plan, zpool=None):
+    """Remember on the dumped snapshot the chain depth of the chosen option."""
+    zfs.set_snapshot_property(plan.snapname, DEPTH_PROPERTY, plan.chosen.depth, plan.dataset, zpool=zpool)
@@ -0,0 +1,357 @@
+#
+# Copyright (c) 2010, Mij <mij@sshguard.net>
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and
+#   the following disclaimer in the documentation and/or other materials provided
+#   with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+# 
+
+#
+# See http://mij.oltrelinux.com/devel/zfsbackup/
+# Bitch to mij@sshguard.net
+#
+
+
+# module restore
+import glob
+import heapq
+import os
+import Queue
+import re
+import subprocess
+import threading
+import time
+
+import checkpoint
+import engine
+import manifest
+import metrics
+import pipeline
+import zfs
+import zsnapman
+
+# size of the reads from dump files
+DEFAULT_BUFSIZE = 1024 * 1024
+
+# decompressed data kept ready for 'zfs receive', in bytes
+DEFAULT_PREFETCH = 256 * 1024 * 1024
+
+# backup-<host>-<tag>-<seqno>-<time>-<dataset>.zfsdump<mode suffix><codec suffix>, as zfsbackup names dumps
+_DUMP_FILENAME = re.compile(r'^backup-(?P<host>[^-]+)-(?P<tag>.+)-(?P<seqno>\d+)-(?P<time>\d\d_\d\d_\d{4}__\d\d_\d\d_\d\d)-(?P<dataset>.+)\.zfsdump(?P<suffix>.*)$')
+
+
+class DumpFile(object):
+    """A dump file, and what it takes to receive it.
+
+    node identifies what receiving the dump restores, base what must have been
+    received before (None for full dumps). They are the snapshot names when the
+    dump has a manifest; otherwise they are worked out from the file names.
+    send_mode tells how 'zfs send' wrote the stream, as zfs.SEND_MODE_FLAGS."""
+    def __init__(self, path, host, tag, seqno, time, dataset, codec, size=None, send_mode='plain'):
+        self.path = path
+        self.host = host
+        self.tag = tag
+        self.seqno = seqno
+        self.time = time
+        self.dataset = dataset
+        self.codec = codec
+        self.send_mode = send_mode
+        if size is None: size = os.path.getsize(path)
+        self.size = size
+        self.manifest = None
+        self.node = None
+        self.base = None
+
+    def taken(self):
+        """Return when the dump was taken, as seconds since the epoch."""
+        return time.mktime(time.strptime(self.time, zsnapman.DEFAULT_TIMESTRFORMAT))
+
+    def __repr__(self):
+        return os.path.basename(self.path)
+
+
+def _split_suffix(suffix):
+    """Split the suffix of a dump file name into its send mode and its codec suffix."""
+    for mode, modesuffix in zfs.SEND_MODE_SUFFIXES.items():
+        if modesuffix and suffix.startswith(modesuffix):
+            return mode, suffix[len(modesuffix):]
+    return 'plain', suffix
+
+
+def dump_send_mode(path):
+    """Return the send mode of a dump from its file name."""
+    match = _DUMP_FILENAME.match(os.path.basename(path))
+    if not match: return 'plain'
+    return _split_suffix(match.group('suffix'))[0]
+
+
+def parse_dump_filename(path):
+    """Return a DumpFile for a file named as zfsbackup names dumps, or None."""
+    match = _DUMP_FILENAME.match(os.path.basename(path))
+    if not match: return None
+    send_mode, suffix = _split_suffix(match.group('suffix'))
+    codec = None
+    for name, codeccls in pipeline.CODECS.items():
+        if codeccls.suffix == suffix: codec = name
+    if codec is None: return None
+    return DumpFile(path, match.group('host'), match.group('tag'), int(match.group('seqno')),
+            match.group('time'), match.group('dataset'), codec, send_mode=send_mode)
+
+
+def scan_dumps(directory):
+    """Return the complete dumps in a directory, with their manifests, in the order they were taken."""
+    dumps = []
+    for path in glob.glob(os.path.join(directory, 'backup-*.zfsdump*')):
+        if path.endswith(manifest.MANIFEST_SUFFIX) or path.endswith(checkpoint.CHECKPOINT_SUFFIX): continue
+        if os.path.exists(path + checkpoint.CHECKPOINT_SUFFIX):
+            # interrupted, not restorable (yet)
+            continue
+        dump = parse_dump_filename(path)
+        if dump is None: continue
+        if os.path.exists(path + manifest.MANIFEST_SUFFIX):
+            dump.manifest = manifest.Manifest.load(path + manifest.MANIFEST_SUFFIX)
+            dump.codec = dump.manifest.codec
+            dump.send_mode = dump.manifest.send_mode
+        dumps.append(dump)
+    dumps.sort(key=lambda d: (d.taken(), d.seqno))
+    return dumps
+
+
+def _link_by_names(dumps, alternate):
+    """Link dumps by the scheme that produced them.
+
+    A full dump (seqno 0) starts a series. Each incremental dump is based on
+    the previous dump of the series (sequential scheme), or on the one before
+    it (alternate scheme: 0, 0-1, 0-2, 1-3, ...). While seqnos grow along the
+    series they number its dumps, and a gap means a dump is missing; pruning
+    with a backlog makes them repeat, and then only the order counts."""
+    serieslist = []
+    for dump in dumps:
+        dump.node = '#' + os.path.basename(dump.path)
+        if dump.seqno == 0:
+            serieslist.append([dump])
+        elif serieslist:
+            serieslist[-1].append(dump)
+        else:
+            # the full dump of this series is gone
+            dump.base = '#missing'
+    for series in serieslist:
+        numbered = all([series[i].seqno < series[i + 1].seqno for i in xrange(len(series) - 1)])
+        byseqno = dict([(dump.seqno, dump) for dump in series])
+        for i, dump in enumerate(series):
+            if i == 0:
+                dump.base = None
+                continue
+            if alternate:
+                baseseqno, baseindex = max(0, dump.seqno - 2), max(0, i - 2)
+            else:
+                baseseqno, baseindex = dump.seqno - 1, i - 1
+            if numbered:
+                base = byseqno.get(baseseqno)
+            else:
+                base = series[baseindex]
+            dump.base = base and base.node or '#missing'
+
+
+def link_dumps(dumps, alternate=False):
+    """Set what each dump restores and is based on.
+
+    Dumps, in the order they were taken, are linked together by their
+    manifests if all have one, else by their names, which only tell in what
+    order dumps were taken and which are full."""
+    if dumps and all([d.manifest for d in dumps]):
+        for dump in dumps:
+            dump.node = dump.manifest.snap_to
+            dump.base = dump.manifest.snap_from
+    else:
+        if [d for d in dumps if d.manifest]:
+            print "Some dumps have no manifest: working out the chain from file names."
+        _link_by_names(dumps, alternate)
+
+
+def resolve_chain(dumps, target=None):
+    """Return the shortest list of dumps to receive, in order, to restore target.
+
+    dumps must be linked already. target is a snapshot name, or None for what
+    the latest dump restores. Among chains of the same length, the one with
+    the fewest bytes to read wins."""
+    if not dumps:
+        raise Exception("No dumps to restore from")
+    if target is None:
+        target = dumps[-1].node
+    elif target.startswith('#') or not [d for d in dumps if d.node == target]:
+        raise Exception("No dump restores snapshot '%s'" % target)
+    # shortest path from "nothing" (None) to target, dumps being the edges
+    costs = {None: (0, 0)}
+    chains = {None: []}
+    heap = [((0, 0), None)]
+    while heap:
+        cost, node = heapq.heappop(heap)
+        if cost > costs[node]: continue
+        if node == target:
+            return chains[node]
+        for dump in dumps:
+            if dump.base != node: continue
+            newcost = (cost[0] + 1, cost[1] + dump.size)
+            if dump.node not in costs or newcost < costs[dump.node]:
+                costs[dump.node] = newcost
+                chains[dump.node] = chains[node] + [dump]
+                heapq.heappush(heap, (newcost, dump.node))
+    raise Exception("No complete chain of dumps restores '%s': a full or incremental dump is missing" % target.lstrip('#'))
+
+
+### RECEIVING
+
+# marks the end of a dump file in the prefetch queue
+_END_OF_DUMP = None
+
+
+class Prefetcher(threading.Thread):
+    """Read and decompress dump files ahead of 'zfs receive'.
+
+    Decompressed data goes into a queue holding up to prefetch bytes however
+    large the chunks come out, file after file, so the next dump is read
+    while the current one is being received. Files with a
+    manifest are checked against it before their end is queued, so a corrupt
+    dump makes its receive abort rather than complete."""
+    def __init__(self, dumps, bufsize=DEFAULT_BUFSIZE, prefetch=DEFAULT_PREFETCH):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.dumps = dumps
+        self.bufsize = bufsize
+        self.prefetch = prefetch
+        self.queue = Queue.Queue()
+        self.buffered = 0       # bytes of data in the queue
+        self.elapsed = 0.0
+        self._stopped = threading.Event()
+        self._cond = threading.Condition()
+
+    def _put(self, item):
+        size = isinstance(item, str) and len(item) or 0
+        self._cond.acquire()
+        try:
+            # a chunk larger than the whole prefetch still goes, once the queue is empty
+            while self.buffered and self.buffered + size > self.prefetch and not self._stopped.is_set():
+                self._cond.wait(0.5)
+            if self._stopped.is_set(): return False
+            self.buffered += size
+        finally:
+            self._cond.release()
+        self.queue.put(item)
+        return True
+
+    def _read(self, dump):
+        decompressor = pipeline.get_codec(dump.codec).decompressor()
+        file_hash = dump.manifest and dump.manifest.digests and pipeline.HashStage(dump.manifest.digests.keys())
+        f = open(dump.path, 'rb')
+        try:
+            while True:
+                started = time.time()
+                data = f.read(self.bufsize)
+                if not data: break
+                if file_hash: file_hash.process(data)
+                data = decompressor.decompress(data)
+                self.elapsed += time.time() - started
+                if data and not self._put(data): return False
+        finally:
+            f.close()
+        if file_hash and file_hash.digests() != dump.manifest.digests:
+            raise Exception("Dump %s does not match its manifest" % dump.path)
+        return self._put(_END_OF_DUMP)
+
+    def run(self):
+        try:
+            for dump in self.dumps:
+                if not self._read(dump): return
+        except Exception as e:
+            self._put(e)
+
+    def get(self):
+        """Return the next chunk of data, _END_OF_DUMP, or raise what went wrong reading."""
+        item = self.queue.get()
+        if isinstance(item, Exception): raise item
+        if isinstance(item, str):
+            self._cond.acquire()
+            self.buffered -= len(item)
+            self._cond.notify_all()
+            self._cond.release()
+        return item
+
+    def stop(self):
+        self._stopped.set()
+        self._cond.acquire()
+        self._cond.notify_all()
+        self._cond.release()
+
+
+def _receive(dump, args, prefetcher):
+    """Feed one dump from the prefetcher into a 'zfs receive' command.
+
+    Return the seconds spent waiting for data."""
+    waited = 0.0
+    # started on the command engine, so the task running the restore can cancel it
+    p = engine.get_engine().popen(args, stdin=subprocess.PIPE)
+    try:
+        while True:
+            started = time.time()
+            data = prefetcher.get()
+            waited += time.time() - started
+            if data is _END_OF_DUMP: break
+            p.stdin.write(data)
+        p.stdin.close()
+    except BaseException:
+        # the partially received stream is discarded by zfs
+        pipeline.terminate(p)
+        raise
+    p.wait()
+    engine.get_engine().release(p)
+    # stopped by a cancelled task: not a failure of the command itself
+    task = engine.get_engine().current_task()
+    if task is not None: task._check()
+    if p.returncode:
+        raise Exception("Error executing '%s' < %s: %d" % (' '.join(args), dump.path, p.returncode))
+    return waited
+
+
+@metrics.stage('restore')
+def restore_chain(chain, target, force=False, bufsize=DEFAULT_BUFSIZE, prefetch=DEFAULT_PREFETCH):
+    """Receive a chain of dumps under the target dataset, in order."""
+    prefetcher = Prefetcher(chain, bufsize, prefetch)
+    prefetcher.start()
+    try:
+        for dump in chain:
+            args = zfs.receive_command(target, force=force)
+            print "Exec '%s' < %s" % (' '.join(args), dump.path)
+            started = time.time()
+            try:
+                waited = _receive(dump, args, prefetcher)
+            except BaseException:
+                metrics.record_command(args, time.time() - started, -1)
+                raise
+            elapsed = time.time() - started
+            metrics.record_command(args, elapsed, 0)
+            print "  received %d bytes in %.1f sec, %.1f sec waiting for data" % (dump.size, elapsed, waited)
+    finally:
+        prefetcher.stop()
+        zfs.invalidate_topology()
+        zfs.invalidate_snapshot_inventory()
+    print "  read and decompressed in %.1f sec" % prefetcher.elapsed
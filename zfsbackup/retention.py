@@ -0,0 +1,173 @@
+#
+# Copyright (c) 2010, Mij <mij@sshguard.net>
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and
+#   the following disclaimer in the documentation and/or other materials provided
+#   with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+# 
+
+#
+# See http://mij.oltrelinux.com/devel/zfsbackup/
+# Bitch to mij@sshguard.net
+#
+
+
+# module retention
+import calendar
+import time
+from datetime import date, datetime
+
+# the timestamp format parsed by slicing rather than strptime
+FAST_TIMESTRFORMAT = '%d_%m_%Y__%H_%M_%S'
+
+_EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+# retention periods of the grandfather-father-son levels, in seconds
+HOUR = 3600
+DAY = 24 * HOUR
+
+
+class Snapshot(object):
+    """A managed snapshot, its name parsed once.
+
+    stamp counts the seconds of the name's local time as if it were UTC, so
+    hours and days are plain divisions of it; month counts months since year 0."""
+    __slots__ = ('name', 'context', 'stamp', 'month')
+
+    def __init__(self, name, context, stamp, month):
+        self.name = name
+        self.context = context
+        self.stamp = stamp
+        self.month = month
+
+    def __repr__(self):
+        return 'Snapshot(%r)' % self.name
+
+    @property
+    def time(self):
+        """Return the naive local datetime in the name."""
+        return datetime.utcfromtimestamp(self.stamp)
+
+
+def _parse_time(timestr, timeformat):
+    """Return (stamp, month) for a name time string, or None if it does not parse."""
+    if timeformat == FAST_TIMESTRFORMAT:
+        if len(timestr) != 20 or timestr[2] != '_' or timestr[5] != '_' or timestr[10:12] != '__': return None
+        try:
+            day, month, year = int(timestr[0:2]), int(timestr[3:5]), int(timestr[6:10])
+            hour, minute, second = int(timestr[12:14]), int(timestr[15:17]), int(timestr[18:20])
+            days = date(year, month, day).toordinal() - _EPOCH_ORDINAL
+        except ValueError:
+            return None
+        if hour > 23 or minute > 59 or second > 61: return None
+        return days * DAY + hour * HOUR + minute * 60 + second, year * 12 + month - 1
+    try:
+        parsed = time.strptime(timestr, timeformat)
+    except ValueError:
+        return None
+    return calendar.timegm(parsed), parsed.tm_year * 12 + parsed.tm_mon - 1
+
+def parse_snapshot(snapname, prefix, timeformat):
+    """Return the Snapshot for a name like prefix-context-time, or None if not one of ours."""
+    fields = snapname.split('-')
+    if len(fields) < 3 or fields[0] != prefix: return None
+    parsed = _parse_time(fields[2], timeformat)
+    if parsed is None: return None
+    return Snapshot(snapname, fields[1], parsed[0], parsed[1])
+
+def local_stamp(when=None):
+    """Return the stamp of a unix time (now by default), comparable to Snapshot.stamp."""
+    if when is None: when = time.time()
+    return calendar.timegm(time.localtime(when))
+
+
+class Policy(object):
+    """Which snapshots of a context to keep.
+
+    last and minutes keep the snapshots that are both among the last ones and
+    younger than so many minutes, as --backlog and --maxage always did; 0 last
+    means no limit. hourly, daily, weekly and monthly keep the newest snapshot
+    of each of that many most recent hours, days, weeks (from Monday) and
+    months that have one. A snapshot is kept if any rule keeps it; with no
+    rule at all, all are."""
+    def __init__(self, last=None, minutes=None, hourly=0, daily=0, weekly=0, monthly=0):
+        self.last = last
+        self.minutes = minutes
+        self.hourly = hourly or 0
+        self.daily = daily or 0
+        self.weekly = weekly or 0
+        self.monthly = monthly or 0
+
+    def limited(self):
+        """Return whether the policy can drop anything."""
+        return self.last is not None or self.minutes is not None or self.is_gfs()
+
+    def is_gfs(self):
+        return bool(self.hourly or self.daily or self.weekly or self.monthly)
+
+    def evaluate(self, snapshots, now=None):
+        """Split snapshots, sorted oldest first, into (kept, dropped) lists.
+
+        One pass over the snapshots from the newest, with a counter and the
+        last seen period for each level. now is a local stamp, default now."""
+        if not self.limited():
+            return list(snapshots), []
+        base = self.last is not None or self.minutes is not None
+        last = self.last or len(snapshots)
+        if self.minutes is not None:
+            if now is None: now = local_stamp()
+            oldest = now - self.minutes * 60
+        else:
+            oldest = None
+        hourly, daily, weekly, monthly = self.hourly, self.daily, self.weekly, self.monthly
+        hour = day = week = month = None
+        kept = []
+        dropped = []
+        position = 0
+        for snap in reversed(snapshots):
+            keep = base and position < last and (oldest is None or snap.stamp > oldest)
+            position += 1
+            stamp = snap.stamp
+            if hourly and stamp // HOUR != hour:
+                hour = stamp // HOUR
+                hourly -= 1
+                keep = True
+            if daily and stamp // DAY != day:
+                day = stamp // DAY
+                daily -= 1
+                keep = True
+            # day 0 was a Thursday
+            if weekly and (stamp // DAY + 3) // 7 != week:
+                week = (stamp // DAY + 3) // 7
+                weekly -= 1
+                keep = True
+            if monthly and snap.month != month:
+                month = snap.month
+                monthly -= 1
+                keep = True
+            if keep:
+                kept.append(snap)
+            else:
+                dropped.append(snap)
+        kept.reverse()
+        dropped.reverse()
+        return kept, dropped
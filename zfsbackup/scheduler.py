@@ -0,0 +1,135 @@
+#
+# Copyright (c) 2010, Mij <mij@sshguard.net>
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and
+#   the following disclaimer in the documentation and/or other materials provided
+#   with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+# 
+
+#
+# See http://mij.oltrelinux.com/devel/zfsbackup/
+# Bitch to mij@sshguard.net
+#
+
+
+# module scheduler
+import threading
+import traceback
+
+
+class DumpJob(object):
+    """A dump to run: func(*args, **kwargs) with what the scheduler needs to know about it."""
+    def __init__(self, func, args=(), kwargs=None, name=None, pool=None, device=None, size=0):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.name = name
+        self.pool = pool
+        self.device = device
+        self.size = size
+        self.result = None
+        self.error = None
+
+    def run(self):
+        self.result = self.func(*self.args, **self.kwargs)
+        return self.result
+
+
+class DumpScheduler(object):
+    """Run dump jobs concurrently on a bounded number of workers.
+
+    Jobs are started largest first, so the run ends close to the time taken by
+    its largest job. At most per_pool jobs read from the same pool and at most
+    per_device jobs write to the same output device at any time (None means
+    only the number of workers limits them)."""
+    def __init__(self, workers=1, per_pool=None, per_device=None):
+        self.workers = max(1, workers)
+        self.per_pool = per_pool
+        self.per_device = per_device
+        self.jobs = []
+        self._queue = []
+        self._running = {}          # ('pool'|'device', key) -> running jobs
+        self._cond = threading.Condition()
+
+    def add(self, job):
+        self.jobs.append(job)
+
+    def _can_start(self, job):
+        if self.per_pool and self._running.get(('pool', job.pool), 0) >= self.per_pool:
+            return False
+        if self.per_device and self._running.get(('device', job.device), 0) >= self.per_device:
+            return False
+        return True
+
+    def _acquire(self, job, delta):
+        for key in (('pool', job.pool), ('device', job.device)):
+            self._running[key] = self._running.get(key, 0) + delta
+
+    def _next_job(self):
+        """Wait for a job allowed to start and return it, or None when all are taken."""
+        self._cond.acquire()
+        try:
+            while self._queue:
+                for job in self._queue:
+                    if self._can_start(job):
+                        self._queue.remove(job)
+                        self._acquire(job, 1)
+                        return job
+                self._cond.wait()
+            return None
+        finally:
+            self._cond.release()
+
+    def _worker(self):
+        while True:
+            job = self._next_job()
+            if job is None: return
+            try:
+                job.run()
+            except Exception as e:
+                job.error = e
+                traceback.print_exc()
+            self._cond.acquire()
+            self._acquire(job, -1)
+            self._cond.notifyAll()
+            self._cond.release()
+
+    def run(self):
+        """Run all jobs. Return them with their results; raise if any failed."""
+        self._queue = sorted(self.jobs, key=lambda job: job.size, reverse=True)
+        if self.workers == 1 or len(self._queue) == 1:
+            # no concurrency asked: run right here, failing at the first error
+            for job in self._queue:
+                job.run()
+            return self.jobs
+        threads = [threading.Thread(target=self._worker) for i in range(min(self.workers, len(self._queue)))]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            # join with a timeout, so signals are still delivered to this thread
+            while t.isAlive():
+                t.join(1)
+        failed = [job for job in self.jobs if job.error is not None]
+        if failed:
+            raise Exception("%d of %d dumps failed: %s" % (len(failed), len(self.jobs), ', '.join([str(job.name) for job in failed])))
+        return self.jobs
@@ -0,0 +1,518 @@
+#
+# Copyright (c) 2010, Mij <mij@sshguard.net>
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and
+#   the following disclaimer in the documentation and/or other materials provided
+#   with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+# 
+
+#
+# See http://mij.oltrelinux.com/devel/zfsbackup/
+# Bitch to mij@sshguard.net
+#
+
+
+# module sendstream
+import array
+import json
+import os
+import struct
+import sys
+from multiprocessing import Pool
+
+import pipeline
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# record types of the send stream (dmu_replay_record_t)
+DRR_BEGIN = 0
+DRR_OBJECT = 1
+DRR_FREEOBJECTS = 2
+DRR_WRITE = 3
+DRR_FREE = 4
+DRR_END = 5
+DRR_WRITE_BYREF = 6
+DRR_SPILL = 7
+DRR_WRITE_EMBEDDED = 8
+DRR_OBJECT_RANGE = 9
+DRR_REDACT = 10
+RECORD_NAMES = ['BEGIN', 'OBJECT', 'FREEOBJECTS', 'WRITE', 'FREE', 'END', 'WRITE_BYREF', 'SPILL',
+        'WRITE_EMBEDDED', 'OBJECT_RANGE', 'REDACT']
+
+# every record has a header of this size, ending with the checksum of the stream up to it
+RECORD_SIZE = 312
+CHECKSUM_OFFSET = RECORD_SIZE - 32
+
+DMU_BACKUP_MAGIC = 0x2F5BACBAC
+# stream header types in the low bits of drr_versioninfo
+DMU_SUBSTREAM = 1
+DMU_COMPOUNDSTREAM = 2
+
+INDEX_SUFFIX = '.index'
+INDEX_VERSION = 1
+
+# a seek mark is recorded in the index every this many bytes of stream
+MARK_INTERVAL = 64 * 1024 * 1024
+
+# read size when indexing dump files
+INDEX_BUFSIZE = 1024 * 1024
+
+# words checksummed at once with numpy
+NUMPY_SLICE = 1024 * 1024
+
+_MASK64 = (1 << 64) - 1
+
+
+### FLETCHER-4
+
+def _fletcher4_words(words):
+    """Return the Fletcher-4 sums of a sequence of 32-bit words, from zero, modulo 2^64."""
+    if numpy is not None:
+        sums = (0, 0, 0, 0)
+        # in slices small enough that the weights of the sums of d fit in 64 bits
+        for start in xrange(0, len(words), NUMPY_SLICE):
+            w = numpy.asarray(words[start:start + NUMPY_SLICE], dtype=numpy.uint64)
+            # counting from the end of the slice, word k adds to b k times, to c k(k+1)/2 times, to d k(k+1)(k+2)/6 times
+            k = numpy.arange(len(w), 0, -1, dtype=numpy.uint64)
+            k2 = k * (k + 1) // 2
+            k3 = k2 * (k + 2) // 3
+            sums = fletcher4_combine(sums, (int(w.sum()), int((w * k).sum()), int((w * k2).sum()), int((w * k3).sum())), len(w))
+        return sums
+    a = b = c = d = 0
+    for word in words:
+        a += word
+        b += a
+        c += b
+        d += c
+    return a & _MASK64, b & _MASK64, c & _MASK64, d & _MASK64
+
+
+def fletcher4_combine(state, block, count):
+    """Return the Fletcher-4 state after a block of count words, given the state
+    before it and the sums of the block alone."""
+    a, b, c, d = state
+    ba, bb, bc, bd = block
+    n2 = count * (count + 1) // 2
+    n3 = count * (count + 1) * (count + 2) // 6
+    return ((a + ba) & _MASK64,
+            (b + count * a + bb) & _MASK64,
+            (c + count * b + n2 * a + bc) & _MASK64,
+            (d + count * c + n2 * b + n3 * a + bd) & _MASK64)
+
+
+class Fletcher4(object):
+    """Incremental Fletcher-4, the checksum of send streams, over data given in pieces of any size.
+
+    The words are 32 bits, in the byte order of the stream."""
+    def __init__(self, bigendian=False):
+        self.bigendian = bigendian
+        self.state = (0, 0, 0, 0)
+        self._pending = ''
+
+    def update(self, data):
+        if self._pending:
+            data = self._pending + str(data)
+            self._pending = ''
+        usable = len(data) & ~3
+        if usable != len(data):
+            self._pending = str(buffer(data, usable))
+        if not usable: return
+        if numpy is not None:
+            words = numpy.frombuffer(buffer(data, 0, usable), dtype=self.bigendian and '>u4' or '<u4')
+        else:
+            words = array.array('I')
+            words.fromstring(buffer(data, 0, usable))
+            if self.bigendian != (sys.byteorder == 'big'): words.byteswap()
+        self.state = fletcher4_combine(self.state, _fletcher4_words(words), usable // 4)
+
+
+### STREAM PARSING
+
+def _round8(n):
+    return (n + 7) & ~7
+
+
+class StreamIndexer(object):
+    """Parse a send stream given in pieces of any size into an index, in constant memory.
+
+    Records are read from their headers; payloads are only checksummed (if
+    verify) and skipped. The index lists the streams found, with the offsets
+    of their BEGIN and END records, the number of records of each type, the
+    objects they touch as ranges, and marks of (offset, object) to seek near
+    an object without reading what precedes it. Streams of 'zfs send -R' are
+    compound: a BEGIN carrying the list of datasets, then one stream per
+    dataset, and a closing END."""
+    def __init__(self, verify=True, mark_interval=MARK_INTERVAL):
+        self.verify = verify
+        self.mark_interval = mark_interval
+        self.offset = 0
+        self.bigendian = False
+        self.streams = []
+        self.errors = []
+        self.complete = False
+        self.compound = None
+        self._current = None
+        self._header = ''
+        self._payload = 0
+        self._checksum = None
+        self._last_mark = -mark_interval
+        self._failed = False
+        self._fmt = {}
+
+    def _error(self, message):
+        if len(self.errors) < 100:
+            self.errors.append(message)
+
+    def _unpack(self, fmt, data, offset):
+        """Unpack fields of a header in the byte order of the stream."""
+        key = (fmt, self.bigendian)
+        if key not in self._fmt:
+            self._fmt[key] = struct.Struct((self.bigendian and '>' or '<') + fmt)
+        return self._fmt[key].unpack_from(data, offset)
+
+    def feed(self, data):
+        pos = 0
+        while pos < len(data) and not self._failed:
+            if self._payload:
+                count = min(self._payload, len(data) - pos)
+                if self._checksum is not None:
+                    self._checksum.update(buffer(data, pos, count))
+                self._payload -= count
+                self.offset += count
+                pos += count
+                continue
+            count = min(RECORD_SIZE - len(self._header), len(data) - pos)
+            self._header += str(buffer(data, pos, count))
+            pos += count
+            if len(self._header) == RECORD_SIZE:
+                header, self._header = self._header, ''
+                self._record(header)
+                self.offset += RECORD_SIZE
+
+    def _record(self, header):
+        if self._current is None:
+            # the stream is in the byte order of the sending host, told by the magic of its BEGIN record
+            if struct.unpack_from('>Q', header, 8)[0] == DMU_BACKUP_MAGIC:
+                self.bigendian = True
+            elif struct.unpack_from('<Q', header, 8)[0] == DMU_BACKUP_MAGIC:
+                self.bigendian = False
+        rectype, payloadlen = self._unpack('II', header, 0)
+        if rectype == DRR_BEGIN:
+            self._begin(header, payloadlen)
+            return
+        if rectype >= len(RECORD_NAMES):
+            self._error("unknown record type %d at offset %d" % (rectype, self.offset))
+            self._failed = True
+            return
+        if self._checksum is not None:
+            self._check(header, rectype)
+        stream = self._current
+        if stream is None:
+            if rectype == DRR_END and self.compound and not self.complete:
+                # the END closing a compound stream: not checksummed
+                self.complete = True
+            else:
+                self._error("%s record outside of a stream at offset %d" % (RECORD_NAMES[rectype], self.offset))
+            return
+        stream['records'][RECORD_NAMES[rectype]] = stream['records'].get(RECORD_NAMES[rectype], 0) + 1
+        if rectype == DRR_END:
+            stream['end'] = self.offset + RECORD_SIZE
+            self._current = None
+            self._checksum = None
+            # a plain stream ends here; a compound one goes on with its datasets
+            self.complete = not self.compound
+            return
+        self._payload = self._payload_size(header, rectype)
+        stream['payload_bytes'] += self._payload
+        if rectype == DRR_FREEOBJECTS:
+            first, count = self._unpack('QQ', header, 8)
+            if count: _add_range(stream['freed_objects'], first, first + count - 1)
+        elif rectype in (DRR_OBJECT, DRR_WRITE, DRR_FREE, DRR_WRITE_BYREF, DRR_SPILL, DRR_WRITE_EMBEDDED):
+            obj = self._unpack('Q', header, 8)[0]
+            _add_range(stream['objects'], obj, obj)
+            if self.offset - self._last_mark >= self.mark_interval:
+                stream['marks'].append([self.offset, obj])
+                self._last_mark = self.offset
+
+    def _payload_size(self, header, rectype):
+        if rectype == DRR_OBJECT:
+            bonuslen, = self._unpack('I', header, 8 + 20)
+            raw_bonuslen, = self._unpack('I', header, 8 + 28)
+            return raw_bonuslen or _round8(bonuslen)
+        if rectype == DRR_WRITE:
+            logical_size, = self._unpack('Q', header, 8 + 24)
+            compression = ord(header[8 + 42])
+            compressed_size, = self._unpack('Q', header, 8 + 88)
+            return compression and compressed_size or logical_size
+        if rectype == DRR_SPILL:
+            length, = self._unpack('Q', header, 8 + 8)
+            compressed_size, = self._unpack('Q', header, 8 + 32)
+            return compressed_size or length
+        if rectype == DRR_WRITE_EMBEDDED:
+            psize, = self._unpack('I', header, 8 + 44)
+            return _round8(psize)
+        return 0
+
+    def _begin(self, header, payloadlen):
+        magic, versioninfo, creation, objset_type, flags, toguid, fromguid = self._unpack('QQQIIQQ', header, 8)
+        if magic != DMU_BACKUP_MAGIC:
+            self._error("bad magic in BEGIN record at offset %d" % self.offset)
+            self._failed = True
+            return
+        if self._current is not None:
+            self._error("stream '%s' has no END record" % self._current['toname'])
+        toname = header[56:RECORD_SIZE].split('\0')[0]
+        hdrtype = versioninfo & 3
+        stream = {
+            'toname': toname, 'toguid': toguid, 'fromguid': fromguid, 'creation_time': creation,
+            'objset_type': objset_type, 'flags': flags, 'features': (versioninfo >> 2) & 0x3fffffff,
+            'compound': hdrtype == DMU_COMPOUNDSTREAM, 'offset': self.offset, 'end': None,
+            'records': {'BEGIN': 1}, 'payload_bytes': payloadlen, 'checksum_ok': self.verify or None, 'objects': [], 'freed_objects': [], 'marks': [],
+        }
+        if self.compound is None:
+            self.compound = stream['compound']
+        self.streams.append(stream)
+        self._current = stream
+        self._checksum = self.verify and Fletcher4(self.bigendian) or None
+        if self._checksum is not None:
+            self._checksum.update(buffer(header, 0, CHECKSUM_OFFSET))
+            self._checksum.update(buffer(header, CHECKSUM_OFFSET))
+        self._payload = payloadlen
+
+    def _check(self, header, rectype):
+        """Check the checksum a record carries against the stream read so far, and add the record to it.
+
+        The checksums are running ones: past a mismatch, every record would
+        mismatch, so the rest of the stream is no longer checked."""
+        before = self._checksum.state
+        self._checksum.update(buffer(header, 0, CHECKSUM_OFFSET))
+        recorded = self._unpack('QQQQ', header, CHECKSUM_OFFSET)
+        problem = None
+        # zero means not checksummed
+        if recorded != (0, 0, 0, 0) and recorded != self._checksum.state:
+            problem = "checksum mismatch in %s record at offset %d" % (RECORD_NAMES[rectype], self.offset)
+        elif rectype == DRR_END:
+            # the END record also carries the checksum of the stream before it
+            end_checksum = self._unpack('QQQQ', header, 8)
+            if end_checksum != (0, 0, 0, 0) and end_checksum != before:
+                problem = "checksum mismatch of stream ending at offset %d" % self.offset
+        if problem:
+            self._error("%s: %s" % (self._current['toname'], problem))
+            self._current['checksum_ok'] = False
+            self._checksum = None
+            return
+        self._checksum.update(buffer(header, CHECKSUM_OFFSET))
+
+    def finish(self):
+        """Return the index of the stream fed."""
+        if not self._failed:
+            if self._header or self._payload:
+                self._error("stream truncated at offset %d" % (self.offset + len(self._header)))
+            elif not self.complete:
+                self._error("stream ends at offset %d before its END record" % self.offset)
+        for stream in self.streams:
+            _merge_ranges(stream['objects'])
+            _merge_ranges(stream['freed_objects'])
+        return {
+            'version': INDEX_VERSION, 'stream_size': self.offset + len(self._header), 'bigendian': self.bigendian,
+            'verified': self.verify, 'complete': self.complete and not self._failed, 'errors': self.errors,
+            'streams': self.streams,
+        }
+
+
+def _add_range(ranges, first, last):
+    """Add objects first to last to a list of ranges, merging with the latest if they touch."""
+    if ranges and ranges[-1][0] <= first <= ranges[-1][1] + 1:
+        if last > ranges[-1][1]: ranges[-1][1] = last
+    else:
+        ranges.append([first, last])
+
+
+def _merge_ranges(ranges):
+    """Sort and merge a list of ranges in place."""
+    ranges.sort()
+    merged = []
+    for first, last in ranges:
+        _add_range(merged, first, last)
+    ranges[:] = merged
+
+
+class IndexStage(pipeline.Stage):
+    """Index the send stream as it passes, so dumps are indexed without reading them back.
+
+    Parsing alone costs next to nothing, but checksumming in Python is far
+    slower than zfs send: unless asked to, the stage does not verify."""
+    name = 'index'
+
+    def __init__(self, verify=False):
+        pipeline.Stage.__init__(self)
+        self.indexer = StreamIndexer(verify=verify)
+
+    def process(self, data):
+        self.indexer.feed(data)
+        return data
+
+    def skipped(self, data):
+        # a resumed dump: the stream is indexed from its start all the same
+        self.indexer.feed(data)
+
+    def index(self):
+        return self.indexer.finish()
+
+
+### INDEX FILES
+
+def index_path(path):
+    """Return the name of the index of a dump file."""
+    return path + INDEX_SUFFIX
+
+
+def save_index(path, index):
+    """Atomically write the index of a dump file next to it."""
+    index = dict(index, output=os.path.basename(path), size=os.path.getsize(path))
+    tmppath = index_path(path) + '.tmp'
+    f = open(tmppath, 'w')
+    try:
+        json.dump(index, f, separators=(',', ':'), sort_keys=True)
+    finally:
+        f.close()
+    os.rename(tmppath, index_path(path))
+
+
+def load_index(path):
+    """Return the index of a dump file, or None if it has none that is up to date."""
+    try:
+        f = open(index_path(path))
+        try:
+            index = json.load(f)
+        finally:
+            f.close()
+    except (IOError, ValueError):
+        return None
+    if index.get('version') != INDEX_VERSION or not os.path.exists(path) or index.get('size') != os.path.getsize(path):
+        return None
+    return index
+
+
+def index_dump(path, codec, verify=True, bufsize=INDEX_BUFSIZE):
+    """Read a dump file compressed with codec, save its index and return it."""
+    indexer = StreamIndexer(verify=verify)
+    decompressor = pipeline.get_codec(codec).decompressor()
+    f = open(path, 'rb')
+    try:
+        while True:
+            data = f.read(bufsize)
+            if not data: break
+            indexer.feed(decompressor.decompress(data))
+    finally:
+        f.close()
+    index = indexer.finish()
+    save_index(path, index)
+    return index
+
+
+def _index_job(job):
+    path, codec, verify = job
+    try:
+        return path, index_dump(path, codec, verify), None
+    except Exception as e:
+        return path, None, str(e)
+
+
+def index_dumps(jobs, workers=4, verify=True):
+    """Index dump files, given as (path, codec), several at a time.
+
+    Parsing and checksumming the stream is Python code holding the GIL, so
+    the files are shared out to processes rather than threads. Return a list
+    of (path, index, error) in the order given."""
+    jobs = [(path, codec, verify) for path, codec in jobs]
+    if workers <= 1 or len(jobs) <= 1:
+        return [_index_job(job) for job in jobs]
+    pool = Pool(min(workers, len(jobs)))
+    try:
+        results = pool.map(_index_job, jobs, chunksize=1)
+    finally:
+        pool.terminate()
+        pool.join()
+    return results
+
+
+### LOOKUPS
+
+def dataset_of(stream):
+    """Return the dataset a stream of an index restores."""
+    return stream['toname'].split('@')[0]
+
+
+def _in_ranges(ranges, obj):
+    for first, last in ranges:
+        if first <= obj <= last: return True
+        if first > obj: break
+    return False
+
+
+def find_object(index, obj, dataset=None):
+    """Return the streams of an index touching an object, as (stream, how, mark).
+
+    how is 'written' if the stream has records of the object, 'freed' if it
+    frees it along with others; mark is the stream offset of the closest
+    mark before the object, where reading its records can start."""
+    found = []
+    for stream in index['streams']:
+        if dataset is not None and dataset_of(stream) != dataset: continue
+        if _in_ranges(stream['objects'], obj):
+            how = 'written'
+        elif _in_ranges(stream['freed_objects'], obj):
+            how = 'freed'
+        else:
+            continue
+        mark = stream['offset']
+        for offset, markobj in stream['marks']:
+            if markobj > obj: break
+            mark = offset
+        found.append((stream, how, mark))
+    return found
+
+
+def chain_problems(indexes):
+    """Check that the streams of a chain of dumps, as (name, index) in receive order, follow each other.
+
+    Each incremental stream must start from a snapshot that an earlier stream
+    of the chain, for the same dataset, restores. Return the problems found."""
+    problems = []
+    restored = {}
+    for name, index in indexes:
+        if not index['complete']:
+            problems.append("%s: incomplete stream" % name)
+        for error in index['errors']:
+            problems.append("%s: %s" % (name, error))
+        for stream in index['streams']:
+            if stream['compound']: continue
+            dataset = dataset_of(stream)
+            if stream['fromguid'] and stream['fromguid'] not in restored.get(dataset, ()):
+                problems.append("%s: %s is incremental from a snapshot (guid %x) no earlier dump restores" %
+                        (name, stream['toname'], stream['fromguid']))
+            restored.setdefault(dataset, set()).add(stream['toguid'])
+    return problems
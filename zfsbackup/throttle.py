@@ -0,0 +1,278 @@
+#
+# Copyright (c) 2010, Mij <mij@sshguard.net>
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and
+#   the following disclaimer in the documentation and/or other materials provided
+#   with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+# 
+
+#
+# See http://mij.oltrelinux.com/devel/zfsbackup/
+# Bitch to mij@sshguard.net
+#
+
+
+# module throttle
+import os
+import threading
+import time
+from datetime import datetime
+
+import engine
+import metrics
+import pipeline
+import zfs
+
+# how often pool latency is sampled, in seconds
+DEFAULT_LATENCY_INTERVAL = 5
+
+# never back off below this fraction of the allowed rate
+MIN_BACKOFF = 0.05
+
+IONICE_CLASSES = {'realtime': 1, 'best-effort': 2, 'idle': 3}
+
+# seconds ionice has to set the I/O priority of a command
+IONICE_TIMEOUT = 10
+
+
+class TokenBucket(object):
+    """Allow rate bytes per second on average, in bursts of up to burst bytes."""
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or rate
+        self.tokens = 0
+        self.updated = time.time()
+
+    def set_rate(self, rate):
+        self._refill()
+        self.rate = rate
+
+    def _refill(self):
+        now = time.time()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def consume(self, count):
+        """Take count tokens, waiting for them as needed. Return the seconds waited."""
+        self._refill()
+        # going into debt lets chunks bigger than the burst through
+        self.tokens -= count
+        if self.tokens >= 0:
+            return 0.0
+        wait = -self.tokens / self.rate
+        time.sleep(wait)
+        return wait
+
+
+class Schedule(object):
+    """Rate limits by time of day.
+
+    Given as comma separated HH:MM-HH:MM=MB/S ranges, like
+    '08:00-20:00=50,20:00-08:00=200'; ranges may wrap around midnight, and 0
+    means unlimited."""
+    def __init__(self, spec):
+        self.ranges = []
+        for item in spec.split(','):
+            try:
+                times, rate = item.strip().split('=')
+                start, end = [self._minutes(t) for t in times.split('-')]
+                self.ranges.append((start, end, float(rate)))
+            except ValueError:
+                raise Exception("Bad rate schedule '%s': expected HH:MM-HH:MM=MB/S[,...]" % item)
+
+    def _minutes(self, hhmm):
+        hours, minutes = hhmm.strip().split(':')
+        if not (0 <= int(hours) <= 24 and 0 <= int(minutes) < 60): raise ValueError(hhmm)
+        return int(hours) * 60 + int(minutes)
+
+    def rate_at(self, when=None):
+        """Return the MB/s allowed at a time (default now), 0 if unlimited, None outside of all ranges."""
+        if when is None: when = datetime.now()
+        now = when.hour * 60 + when.minute
+        for start, end, rate in self.ranges:
+            if (start <= end and start <= now < end) or (start > end and (now >= start or now < end)):
+                return rate
+        return None
+
+
+class LatencyMonitor(threading.Thread):
+    """Keep sampling the I/O latency of a pool in the background, until stopped."""
+    def __init__(self, zpool, interval=DEFAULT_LATENCY_INTERVAL):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.zpool = zpool
+        self.interval = interval
+        self.latency = None
+        self.samples = 0
+        self.users = 0          # sends sharing the monitor, counted by get_latency_monitor()
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.is_set():
+            started = time.time()
+            # None when there is no way to tell: then sends are not held back
+            self.latency = zfs.get_pool_latency(interval=self.interval, zpool=self.zpool)
+            self.samples += 1
+            self._stopped.wait(max(0, started + self.interval - time.time()))
+
+    def stop(self):
+        """Stop sampling, once the sample at hand is taken."""
+        self._stopped.set()
+
+
+_monitors = {}
+_monitors_lock = threading.Lock()
+
+def get_latency_monitor(zpool, interval=DEFAULT_LATENCY_INTERVAL):
+    """Return the running latency monitor of a pool, shared by all the sends from it.
+
+    Each send getting the monitor must give it back with release_latency_monitor()."""
+    with _monitors_lock:
+        if zpool not in _monitors:
+            _monitors[zpool] = LatencyMonitor(zpool, interval)
+            _monitors[zpool].start()
+        _monitors[zpool].users += 1
+        return _monitors[zpool]
+
+def release_latency_monitor(monitor):
+    """Give back a monitor got from get_latency_monitor(), stopping it once no send uses it."""
+    with _monitors_lock:
+        monitor.users -= 1
+        if monitor.users > 0: return
+        monitor.stop()
+        if _monitors.get(monitor.zpool) is monitor: del _monitors[monitor.zpool]
+
+
+class ThrottleStage(pipeline.Stage):
+    """Limit the rate the stream is read from zfs send.
+
+    The limit is the rate given, or the one the schedule sets for the time of
+    day. With a latency monitor, the limit backs off while the pool latency is
+    above the threshold, halving at each sample, and recovers in steps of a
+    tenth when it is back below; when there is no other limit, backing off
+    starts from the rate measured so far. The stage gives the monitor back
+    when it is closed."""
+    name = 'throttle'
+
+    def __init__(self, rate=None, schedule=None, monitor=None, threshold=None):
+        pipeline.Stage.__init__(self)
+        self.rate = rate
+        self.schedule = schedule
+        self.monitor = monitor
+        self.threshold = threshold
+        self.factor = 1.0
+        self.min_factor = 1.0
+        self.backoffs = 0
+        self.throttled = 0.0
+        self._bucket = None
+        self._sample = 0
+        self._started = time.time()
+
+    def _limit(self):
+        """Return the bytes per second allowed now, None if unlimited."""
+        limit = self.rate
+        if self.schedule is not None and self.schedule.rate_at() is not None: limit = self.schedule.rate_at()
+        if limit: limit *= 1024 * 1024
+        if self.monitor is not None and self.monitor.samples != self._sample:
+            # one adjustment per latency sample
+            self._sample = self.monitor.samples
+            if self.monitor.latency is not None and self.monitor.latency > self.threshold:
+                self.factor = max(MIN_BACKOFF, self.factor / 2)
+                self.backoffs += 1
+                self.min_factor = min(self.min_factor, self.factor)
+            else:
+                self.factor = min(1.0, self.factor + 0.1)
+        if self.factor < 1.0:
+            if not limit:
+                # back off from what we have been doing
+                limit = self.bytes_in / max(time.time() - self._started - self.throttled, 0.001)
+            limit *= self.factor
+        return limit
+
+    def process(self, data):
+        limit = self._limit()
+        if limit:
+            if self._bucket is None:
+                self._bucket = TokenBucket(limit)
+            else:
+                self._bucket.set_rate(limit)
+            self.throttled += self._bucket.consume(len(data))
+        else:
+            self._bucket = None
+        return data
+
+    def close(self):
+        if self.monitor is not None:
+            release_latency_monitor(self.monitor)
+            self.monitor = None
+
+    def stats(self):
+        return {'throttled': self.throttled, 'backoffs': self.backoffs, 'min_factor': self.min_factor}
+
+    def report(self):
+        return "%s, throttled %.1f sec, backed off %d times (down to %d%%)" % (pipeline.Stage.report(self),
+                self.throttled, self.backoffs, self.min_factor * 100)
+
+
+class Priority(object):
+    """CPU and I/O priority to run a command with."""
+    def __init__(self, nice=None, ioclass=None, iolevel=None):
+        self.nice = nice
+        self.ioclass = ioclass
+        self.iolevel = iolevel
+
+    @classmethod
+    def parse(cls, nice=None, ionice=None):
+        """Return the priority from --nice and --ionice CLASS[:LEVEL] option values."""
+        ioclass = iolevel = None
+        if ionice:
+            name, sep, level = ionice.partition(':')
+            if name not in IONICE_CLASSES:
+                raise Exception("Unknown I/O class '%s'. Choose among: %s" % (name, ', '.join(sorted(IONICE_CLASSES.keys()))))
+            ioclass = IONICE_CLASSES[name]
+            if level: iolevel = int(level)
+        return cls(nice, ioclass, iolevel)
+
+    def preexec(self):
+        """Lower the priority of the current process: run in the child before exec."""
+        if self.nice: os.nice(self.nice)
+
+    def apply(self, pid):
+        """Set the I/O priority of a running process, with ionice run on the command engine."""
+        if self.ioclass is None: return
+        args = ['ionice', '-c', str(self.ioclass)]
+        if self.iolevel is not None: args.extend(['-n', str(self.iolevel)])
+        args.extend(['-p', str(pid)])
+        started = time.time()
+        try:
+            returncode = engine.get_engine().run(args, timeout=IONICE_TIMEOUT)[0]
+        except engine.CommandTimeout:
+            returncode = -1
+        except engine.CommandCancelled:
+            raise
+        except Exception:
+            # what the engine raises when the command is missing
+            print "ionice not found: cannot set I/O priority"
+            return
+        metrics.record_command(args, time.time() - started, returncode)
+        if returncode:
+            print "Cannot set I/O priority with '%s'" % ' '.join(args)
@@ -0,0 +1,344 @@
+#
+# Copyright (c) 2010, Mij <mij@sshguard.net>
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and
+#   the following disclaimer in the documentation and/or other materials provided
+#   with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+# 
+
+#
+# See http://mij.oltrelinux.com/devel/zfsbackup/
+# Bitch to mij@sshguard.net
+#
+
+
+# module transport
+import json
+import os
+import pipes
+import socket
+import struct
+import subprocess
+import time
+import urlparse
+
+import catalog
+import engine
+import manifest
+import pipeline
+import restore
+import zfs
+
+# socket buffers of the native stream transport, large enough to keep a fast,
+# long-distance link busy
+DEFAULT_SOCKBUF = 4 * 1024 * 1024
+
+STREAM_VERSION = 1
+
+# commands decompressing, on the receiving side, what a codec compressed
+DECOMPRESS_COMMANDS = {
+    'gzip': 'gzip -dc',
+    'zstd': 'zstd -dc',
+    'lz4': 'lz4 -dc',
+}
+
+# the stream is sent in chunks prefixed by their length; an empty one ends it
+_CHUNK_HEADER = struct.Struct('>I')
+
+
+class TransportSink(pipeline.Stage):
+    """A sink delivering the stream somewhere else than a local file.
+
+    Besides what stages report, transports report their sustained
+    throughput: bytes delivered over the time from connection to completed
+    delivery."""
+    def __init__(self):
+        pipeline.Stage.__init__(self)
+        self.started = time.time()
+        self.completed = None
+
+    def sustained(self):
+        """Return the MB/s delivered from start to completion."""
+        seconds = (self.completed or time.time()) - self.started
+        if not seconds: return 0.0
+        return self.bytes_in / seconds / (1024 * 1024)
+
+    def report(self):
+        return "%s, sustained %.1f MB/s" % (pipeline.Stage.report(self), self.sustained())
+
+
+class CommandSink(TransportSink):
+    """Feed the stream to a command, like 'ssh host zfs receive'."""
+    def __init__(self, args, name=None):
+        TransportSink.__init__(self)
+        self.args = args
+        self.name = name or args[0]
+        # started on the command engine, so the task running the dump can cancel it
+        self._p = engine.get_engine().popen(args, stdin=subprocess.PIPE)
+
+    def process(self, data):
+        self._p.stdin.write(data)
+        return ''
+
+    def finish(self):
+        self._p.stdin.close()
+        self._p.wait()
+        engine.get_engine().release(self._p)
+        # stopped by a cancelled task: not a failure of the command itself
+        task = engine.get_engine().current_task()
+        if task is not None: task._check()
+        self.returncode = self._p.returncode
+        self.completed = time.time()
+        if self.returncode:
+            raise Exception("Error executing '%s': %d" % (' '.join(self.args), self.returncode))
+        return ''
+
+    def close(self):
+        # the command did not get the whole stream: do not let it complete
+        pipeline.terminate(self._p)
+
+
+class SocketSink(TransportSink):
+    """Stream to a zfsbackup --listen over TCP.
+
+    The stream is preceded by a header naming the dump and its codec, and
+    sent in length-prefixed chunks ending with an empty one, so the receiver
+    tells a complete stream from a broken connection. Delivery is complete
+    once the receiver acknowledges it. With a timeout, a receiver taking
+    longer than that many seconds to take data or to acknowledge fails it."""
+    name = 'tcp'
+
+    def __init__(self, host, port, header, sockbuf=DEFAULT_SOCKBUF, timeout=None):
+        TransportSink.__init__(self)
+        self.address = (host, port)
+        self._socket = socket.create_connection(self.address, timeout)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, sockbuf)
+        header = dict(header, version=STREAM_VERSION)
+        self._socket.sendall(json.dumps(header) + '\n')
+
+    def process(self, data):
+        self._socket.sendall(_CHUNK_HEADER.pack(len(data)))
+        self._socket.sendall(data)
+        return ''
+
+    def finish(self):
+        self._socket.sendall(_CHUNK_HEADER.pack(0))
+        self._socket.shutdown(socket.SHUT_WR)
+        reply = self._socket.makefile('rb').readline()
+        self.completed = time.time()
+        try:
+            reply = json.loads(reply)
+        except ValueError:
+            reply = {'ok': False, 'error': 'connection lost'}
+        if reply.get('ok'):
+            self.returncode = 0
+        else:
+            self.returncode = 1
+            raise Exception("Receiver at %s:%d failed: %s" % (self.address[0], self.address[1], reply.get('error')))
+        return ''
+
+    def close(self):
+        # also wakes up a thread stuck sending
+        try:
+            self._socket.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self._socket.close()
+
+
+def ssh_receive_command(host, target, codec=None, force=False, user=None, port=None):
+    """Return the command line receiving a stream under target on a host over ssh."""
+    # run by the remote shell: quote what comes from the URL
+    remote = ' '.join([pipes.quote(arg) for arg in zfs.receive_command(target, force=force)])
+    if codec and codec.name != 'none':
+        remote = '%s | %s' % (DECOMPRESS_COMMANDS[codec.name], remote)
+    args = ['ssh', '-T']
+    if port: args.extend(['-p', str(port)])
+    if user: host = '%s@%s' % (user, host)
+    return args + [host, remote]
+
+
+def open_sink(url, name, codec, force=False, sockbuf=DEFAULT_SOCKBUF, timeout=None, dumpmanifest=None):
+    """Return the sink delivering the dump called name, compressed with codec, to url.
+
+    url is ssh://[user@]host[:port]/dataset, to receive the stream under
+    dataset on the host with zfs receive, or tcp://host:port, to stream it to
+    a zfsbackup --listen, failing if it stalls for timeout seconds. With the
+    manifest of the dump, the listener describes the file it writes alike."""
+    parsed = urlparse.urlsplit(url)
+    if parsed.scheme == 'ssh':
+        target = parsed.path.strip('/')
+        if not parsed.hostname or not target:
+            raise Exception("Bad ssh destination '%s': expected ssh://[user@]host[:port]/dataset" % url)
+        args = ssh_receive_command(parsed.hostname, target, codec, force=force, user=parsed.username, port=parsed.port)
+        return CommandSink(args, name='ssh %s' % parsed.hostname)
+    elif parsed.scheme == 'tcp':
+        if not parsed.hostname or not parsed.port:
+            raise Exception("Bad tcp destination '%s': expected tcp://host:port" % url)
+        header = {'name': name, 'codec': codec.name}
+        if dumpmanifest is not None:
+            m = dumpmanifest
+            header['dump'] = {'snap_from': m.snap_from, 'snap_to': m.snap_to, 'seqno': m.seqno, 'dataset': m.dataset,
+                    'command': m.command, 'send_mode': m.send_mode}
+        return SocketSink(parsed.hostname, parsed.port, header, sockbuf=sockbuf, timeout=timeout)
+    raise Exception("Unknown transport in '%s': use ssh:// or tcp://" % url)
+
+
+### RECEIVING SIDE
+
+class StreamServer(object):
+    """Receive streams sent with SocketSink, one connection at a time.
+
+    Streams go into 'zfs receive' under receive_into, decompressed on the way,
+    or else into files of the directory, as they were sent. A stream that is
+    not complete is discarded: the receive is aborted, the file removed.
+    Files received are checksummed with hashes as they arrive and added to
+    the catalog of the directory, with a manifest if the sender described
+    the dump.
+
+    Connections are neither authenticated nor encrypted: whoever reaches the
+    address can write dumps, or receive streams into the pool."""
+    def __init__(self, address, directory=None, receive_into=None, force=False, sockbuf=DEFAULT_SOCKBUF, bufsize=pipeline.DEFAULT_BUFSIZE, hashes=None):
+        self.directory = directory
+        self.receive_into = receive_into
+        self.force = force
+        self.hashes = hashes or []
+        self.bufsize = bufsize
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        # must be set before listening to apply to the TCP window of accepted connections
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, sockbuf)
+        self._socket.bind(address)
+        self._socket.listen(1)
+        self.address = self._socket.getsockname()
+
+    def serve(self, once=False):
+        """Handle connections, forever or just one. Return whether the last stream was received."""
+        while True:
+            conn, peer = self._socket.accept()
+            try:
+                ok = self._handle(conn, peer)
+            finally:
+                conn.close()
+            if once: return ok
+
+    def close(self):
+        self._socket.close()
+
+    def _recv_exactly(self, conn, buf, count):
+        """Receive count bytes into the start of buf."""
+        view = memoryview(buf)
+        got = 0
+        while got < count:
+            n = conn.recv_into(view[got:count], count - got)
+            if not n: raise EOFError("connection lost")
+            got += n
+
+    def _open(self, header):
+        """Return (write function, complete function, abort function) for where the stream goes."""
+        if self.receive_into:
+            args = zfs.receive_command(self.receive_into, force=self.force)
+            print "Exec '%s' < %s" % (' '.join(args), header['name'])
+            p = engine.get_engine().popen(args, stdin=subprocess.PIPE)
+            decompressor = pipeline.get_codec(header['codec']).decompressor()
+            def write(data):
+                p.stdin.write(decompressor.decompress(data))
+            def complete():
+                p.stdin.close()
+                p.wait()
+                engine.get_engine().release(p)
+                if p.returncode:
+                    raise Exception("Error executing '%s': %d" % (' '.join(args), p.returncode))
+                zfs.invalidate_topology()
+                zfs.invalidate_snapshot_inventory()
+            return write, complete, lambda: pipeline.terminate(p)
+        path = os.path.join(self.directory, os.path.basename(header['name']))
+        print "Writing %s" % path
+        f = open(path, 'wb')
+        file_hash = pipeline.HashStage(self.hashes)
+        def write(data):
+            file_hash.process(data)
+            f.write(data)
+        def complete():
+            f.flush()
+            os.fsync(f.fileno())
+            f.close()
+            self._register(path, header, file_hash)
+        def abort():
+            f.close()
+            os.unlink(path)
+        return write, complete, abort
+
+    def _register(self, path, header, file_hash):
+        """Write the manifest of a received file, if the sender described the dump, and catalog it."""
+        dump = header.get('dump')
+        if dump is not None:
+            m = manifest.Manifest(path, dump['snap_from'], dump['snap_to'], dump['seqno'], dump['dataset'], header['codec'],
+                    dump['command'], dump['send_mode'])
+            m.size = os.path.getsize(path)
+            m.digests = file_hash.digests()
+            if header['codec'] == 'none':
+                # the file is the stream
+                m.raw_size, m.raw_digests = m.size, m.digests
+            m.save()
+        if restore.parse_dump_filename(path) is None:
+            print "Not cataloging %s: not named as a dump" % path
+            return
+        catalog.get_catalog(self.directory).add(path)
+
+    def _handle(self, conn, peer):
+        started = time.time()
+        received = 0
+        reply = {'ok': True}
+        abort = None
+        try:
+            header = json.loads(conn.makefile('rb', 0).readline())
+            if header.get('version') != STREAM_VERSION:
+                raise Exception("unsupported stream version %s" % header.get('version'))
+            print "Receiving '%s' (%s) from %s" % (header['name'], header['codec'], peer[0])
+            write, complete, abort = self._open(header)
+            lengthbuf = bytearray(_CHUNK_HEADER.size)
+            buf = bytearray(self.bufsize)
+            while True:
+                self._recv_exactly(conn, lengthbuf, len(lengthbuf))
+                length = _CHUNK_HEADER.unpack(str(lengthbuf))[0]
+                if not length: break
+                if length > len(buf): buf = bytearray(length)
+                self._recv_exactly(conn, buf, length)
+                write(buffer(buf, 0, length))
+                received += length
+            complete()
+            abort = None
+        except Exception as e:
+            reply = {'ok': False, 'error': str(e)}
+            print "Failed receiving from %s: %s" % (peer[0], e)
+        finally:
+            if abort: abort()
+        elapsed = time.time() - started
+        reply['bytes'] = received
+        try:
+            conn.sendall(json.dumps(reply) + '\n')
+        except socket.error:
+            pass
+        if reply['ok']:
+            print "Received %d bytes in %.1f sec, sustained %.1f MB/s" % (received, elapsed, elapsed and received / elapsed / (1024 * 1024) or 0.0)
+        return reply['ok']
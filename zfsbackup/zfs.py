@@ -32,10 +32,56 @@
 
 # module zfs
 import os
-import subprocess
+import threading
+import time
+
+import engine
+import metrics
 
 ZFS_DEFAULT_SNAPSHOT_DIR='/.zfs/snapshot'
 
+# longest snapshot list passed to a single 'zfs destroy' (one argument is limited to 128k on Linux)
+ZFS_MAX_SNAPLIST_LENGTH = 65536
+
+# seconds a zfs command may run before it is stopped, None for no limit
+COMMAND_TIMEOUT = None
+
+# how 'zfs send' may pass blocks on: decompressed, as compressed on disk, or as stored (encrypted) on disk
+SEND_MODE_FLAGS = {'plain': [], 'compressed': ['-c'], 'raw': ['-w']}
+
+# what dumps of each send mode carry in their filename, before the codec suffix
+SEND_MODE_SUFFIXES = {'plain': '', 'compressed': '.compressed', 'raw': '.raw'}
+
+# pools and datasets on the system, as loaded by get_topology()
+_topology = None
+
+# snapshots on the system, as loaded by get_snapshot_inventory()
+_snapshot_inventory = None
+_snapshot_inventory_generation = 0
+
+# compression and encryption of the datasets of each pool, as loaded by get_storage_properties()
+_storage_properties = {}
+
+# guards the topology and the inventory, shared by the pools run concurrently
+_cache_lock = threading.RLock()
+
+
+def _run(args, stdout=False, stderr=False):
+    """Run a ZFS command, capturing its standard output and error if asked.
+
+    Return (returncode, stdout, stderr). All the commands run by this module go
+    through here, are accounted in the run metrics and are stopped after
+    COMMAND_TIMEOUT seconds. They run on the command engine, so a task
+    running them can be cancelled."""
+    started = time.time()
+    try:
+        returncode, out, err = engine.get_engine().run(args, stdout, stderr, timeout=COMMAND_TIMEOUT)
+    except engine.CommandTimeout:
+        metrics.record_command(args, time.time() - started, -1)
+        raise
+    metrics.record_command(args, time.time() - started, returncode)
+    return returncode, out, err
+
 
 def pass_zfs_pool(f):
     """Decorator to pass the appropriate ZFS pool parameter at runtime, if none specified.
@@ -49,51 +95,121 @@ def pass_zfs_pool(f):
     return _decorator
 
 
+class Dataset(object):
+    """A filesystem or volume in the pool topology."""
+    def __init__(self, name, dstype='filesystem', mountpoint=None, properties=None):
+        self.name = name
+        self.pool, sep, path = name.partition('/')
+        # '/my/dataset' for children and '' for the root dataset
+        self.path = sep + path
+        self.type = dstype
+        self.mountpoint = mountpoint
+        self.properties = properties or {}
+        self.parent = None
+        self.children = []
+
+    def walk(self):
+        """Yield this dataset and all its descendants, parents first."""
+        yield self
+        for child in self.children:
+            for ds in child.walk():
+                yield ds
+
+
+class Topology(object):
+    """The pools of the system and their dataset trees."""
+    # properties loaded for every dataset, besides name and type
+    PROPERTIES = ('used', 'avail', 'refer', 'mountpoint')
+
+    def __init__(self):
+        self.pools = {}         # pool name -> root Dataset
+        self.datasets = {}      # full dataset name -> Dataset
+
+    def load(self):
+        """Load all pools and datasets with a single 'zfs list' call."""
+        command = 'zfs list -t filesystem,volume -H -p -o name,type,%s' % ','.join(self.PROPERTIES)
+        returncode, zfsout, zfserr = _run(command.split(' '), stdout=True)
+        if returncode:
+            raise Exception("Error executing '%s': %d" % (command, returncode))
+        for line in zfsout.split('\n'):
+            if not line: continue
+            fields = line.split('\t')
+            properties = dict(zip(self.PROPERTIES, fields[2:]))
+            for prop in ('used', 'avail', 'refer'):
+                if properties.get(prop, '-').isdigit():
+                    properties[prop] = int(properties[prop])
+            self.add(Dataset(fields[0], fields[1], properties.get('mountpoint'), properties))
+        return self
+
+    def add(self, ds):
+        """Insert a dataset in the tree. Parents must be added first."""
+        self.datasets[ds.name] = ds
+        parentname = ds.name.rpartition('/')[0]
+        if not parentname:
+            self.pools[ds.name] = ds
+        elif parentname in self.datasets:
+            ds.parent = self.datasets[parentname]
+            ds.parent.children.append(ds)
+
+    def get_pools(self):
+        return sorted(self.pools.keys())
+
+    def get_dataset(self, zpool, dataset=''):
+        """Return the Dataset of a pool at a given path, or None."""
+        return self.datasets.get(zpool + dataset)
+
+
+def get_topology():
+    """Return the pool and dataset topology, loading it once per run.
+
+    Operations creating or destroying datasets must call invalidate_topology()."""
+    global _topology
+    with _cache_lock:
+        if _topology is None:
+            _topology = Topology().load()
+        return _topology
+
+
+def invalidate_topology():
+    """Drop the cached topology, forcing a reload on next access."""
+    global _topology
+    _topology = None
+    _storage_properties.clear()
+
+
 def get_pools():
     """Return a list of ZFS pools available on the system"""
-    command = 'zpool list -H'
-    try:
-        p = subprocess.Popen(command.split(' '), stdout=subprocess.PIPE)
-    except OSError:
-        raise Exception('No ZFS tools found!')
-    zpout, zperr = p.communicate()
-    if p.returncode:
-        raise Exception("Error executing '%s': %d" % (command, p.returncode))
-    return [line.split('\t', 1)[0] for line in zpout.split('\n') if line]
+    return get_topology().get_pools()
 
 
 def get_default_pool():
     """Return the primary ZFS pool configured in the system"""
-    return os.environ.get('ZFS_POOL', get_pools()[0])
+    if 'ZFS_POOL' in os.environ:
+        return os.environ['ZFS_POOL']
+    pools = get_pools()
+    if not pools:
+        raise Exception('No ZFS pools found!')
+    return pools[0]
 
 @pass_zfs_pool
 def get_datasets(zpool=None, strip_poolname=True):
     """Return a list of ZFS datasets available in a specific pool, or in all.
     
     The root dataset is returned as an empty string."""
-    if zpool and zpool not in get_pools():
+    topology = get_topology()
+    if zpool and zpool not in topology.pools:
         raise Exception("Pool '%s' is not available on this system!" % zpool)
-    command = 'zfs list -t filesystem -H'
-    try:
-        p = subprocess.Popen(command.split(' '), stdout=subprocess.PIPE)
-    except OSError:
-        raise Exception("zfs not found. Cannot execute '%s'" % command)
-    zfsout, zfserr = p.communicate()
-    if p.returncode:
-        print "Error executing '%s': %d" % (command, p.returncode)
-        return []
     datasets = []
-    for line in zfsout.split('\n'):
-        dsname = line.split('\t', 1)[0]
-        if not dsname: continue
-        dspool, sep, mountpoint = dsname.partition('/')
-        if zpool and dspool != zpool:
+    for dsname in sorted(topology.datasets.keys()):
+        ds = topology.datasets[dsname]
+        if ds.type != 'filesystem': continue
+        if zpool and ds.pool != zpool:
             continue
         if strip_poolname:
             # produce '/my/mountpoint' for children and '' for root dataset
-            datasets.append(sep + mountpoint)
+            datasets.append(ds.path)
         else:
-            datasets.append(dsname)
+            datasets.append(ds.name)
     return datasets
 
 
@@ -111,49 +227,404 @@ def destroy_snapshot(snapname, dataset='', recursive=True, zpool=None):
         command = 'zfs destroy %s' % fullsnapname
     #print "Exec '%s'" % command
     assert command.find('@') != -1     # we are not destroying datasets, only snapshots
-    p = subprocess.Popen(command.split(' '))
-    p.wait()
-    if p.returncode != 0 and p.returncode != 1: # 1 = snapshot did not exist. We can stand that
-        raise Exception("Error executing '%s': %d" % (command, p.returncode))
+    returncode = _run(command.split(' '))[0]
+    if returncode != 0 and returncode != 1: # 1 = snapshot did not exist. We can stand that
+        raise Exception("Error executing '%s': %d" % (command, returncode))
+    _forget_snapshots(zpool + dataset, [snapname], recursive)
+
+
+def _snapshot_runs(dsname, snapnames, recursive):
+    """Group snapshots to destroy into the tokens of a 'zfs destroy' snapshot list.
+
+    Snapshots contiguous in the dataset (and, if recursive, in every descendant)
+    collapse into a 'first%last' range; the others are listed one by one.
+    Return a list of (token, [snapnames]) pairs."""
+    inventory = get_snapshot_inventory()
+    wanted = set(snapnames)
+    ordered = [x[0] for x in inventory.get(dsname, [])]
+    lists = [ordered]
+    if recursive:
+        lists.extend([[x[0] for x in snaps] for ds, snaps in inventory.items() if ds.startswith(dsname + '/')])
+    runs, run = [], []
+    for snap in ordered:
+        if snap in wanted:
+            run.append(snap)
+        elif run:
+            runs.append(run)
+            run = []
+    if run: runs.append(run)
+    known = set(ordered)
+    # snapshots unknown to the inventory are passed through as they are
+    runs.extend([[snap] for snap in snapnames if snap not in known])
+    tokens = []
+    for run in runs:
+        if len(run) > 2 and _is_safe_range(run, lists):
+            tokens.append(('%s%%%s' % (run[0], run[-1]), run))
+        else:
+            tokens.extend([(snap, [snap]) for snap in run])
+    return tokens
+
+
+def _is_safe_range(run, lists):
+    """Return whether a range destroys exactly the given run in every snapshot list."""
+    runset = set(run)
+    for snaps in lists:
+        positions = [i for i, snap in enumerate(snaps) if snap in runset]
+        if not positions: continue
+        if snaps[positions[0]] != run[0] or snaps[positions[-1]] != run[-1]:
+            return False
+        if positions[-1] - positions[0] + 1 != len(positions):
+            return False
+    return True
+
+
+@metrics.stage('prune')
+@pass_zfs_pool
+def destroy_snapshots(snapnames, dataset='', recursive=True, zpool=None):
+    """Remove several snapshots of a dataset with as few 'zfs destroy' calls as possible.
+
+    Snapshots are coalesced into comma-separated lists and 'first%last' ranges, split
+    only when the command line would grow beyond ZFS_MAX_SNAPLIST_LENGTH. If a batch
+    fails, its snapshots are retried one by one. Return a dict mapping each snapshot
+    name to whether it has been destroyed."""
+    results = {}
+    if not snapnames:
+        return results
+    dsname = zpool + dataset
+    batches, batch, batchlen = [], [], 0
+    for token in _snapshot_runs(dsname, snapnames, recursive):
+        if batch and batchlen + len(token[0]) + 1 > ZFS_MAX_SNAPLIST_LENGTH:
+            batches.append(batch)
+            batch, batchlen = [], 0
+        batch.append(token)
+        batchlen += len(token[0]) + 1
+    if batch: batches.append(batch)
+    for batch in batches:
+        batchsnaps = sum([token[1] for token in batch], [])
+        print "Destroying %d snapshots from '%s'" % (len(batchsnaps), dsname)
+        returncode = _destroy_snaplist(dsname, ','.join([token[0] for token in batch]), recursive)
+        if returncode == 0:
+            results.update(dict.fromkeys(batchsnaps, True))
+            continue
+        # find out which ones failed
+        for snap in batchsnaps:
+            returncode = _destroy_snaplist(dsname, snap, recursive)
+            if returncode != 0 and returncode != 1: # 1 = snapshot did not exist. We can stand that
+                raise Exception("Error destroying snapshot '%s@%s': %d" % (dsname, snap, returncode))
+            results[snap] = (returncode == 0)
+            if returncode:
+                print "Could not destroy snapshot '%s@%s'" % (dsname, snap)
+    _forget_snapshots(dsname, [snap for snap in results if results[snap]], recursive)
+    return results
+
+
+def _destroy_snaplist(dsname, snaplist, recursive):
+    """Run 'zfs destroy' on a list of snapshots of a dataset. Return its exit status."""
+    args = ['zfs', 'destroy']
+    if recursive: args.append('-r')
+    args.append('%s@%s' % (dsname, snaplist))
+    return _run(args)[0]
+
+
+def _in_subtree(path, roots):
+    """Return whether a dataset path is one of roots or lies beneath one of them."""
+    for root in roots:
+        if path == root or path.startswith(root + '/') or root == '':
+            return True
+    return False
 
 
+@pass_zfs_pool
+def plan_snapshot(restrictdatasets=None, nodatasets=None, recursive=True, zpool=None):
+    """Compute the datasets to pass to 'zfs snapshot' to cover the wanted datasets.
+
+    Datasets are wanted if they lie under restrictdatasets (all if None) and not
+    under nodatasets. Return a (recursive_roots, single_datasets) pair of lists of
+    full dataset names: whole subtrees that are wanted are covered by their root
+    in recursive_roots, any other wanted dataset appears in single_datasets."""
+    topology = get_topology()
+    if zpool not in topology.pools:
+        raise Exception("Pool '%s' is not available on this system!" % zpool)
+    restrictdatasets = restrictdatasets or ['']
+    nodatasets = nodatasets or []
+    for ds in restrictdatasets:
+        if not topology.get_dataset(zpool, ds):
+            raise Exception("Dataset '%s%s' is not available on this system!" % (zpool, ds))
+    wanted = lambda ds: _in_subtree(ds.path, restrictdatasets) and not _in_subtree(ds.path, nodatasets)
+    if not recursive:
+        return [], [topology.get_dataset(zpool, ds).name for ds in restrictdatasets if not _in_subtree(ds, nodatasets)]
+    # whether a dataset and all its descendants are wanted, computed leaves first
+    complete = {}
+    for ds in reversed(list(topology.pools[zpool].walk())):
+        complete[ds.name] = wanted(ds) and all([complete[child.name] for child in ds.children])
+    roots, singles = [], []
+    pending = [topology.pools[zpool]]
+    while pending:
+        ds = pending.pop(0)
+        if complete[ds.name]:
+            roots.append(ds.name)
+            continue
+        if _in_subtree(ds.path, nodatasets):
+            continue
+        if wanted(ds):
+            singles.append(ds.name)
+        pending.extend(ds.children)
+    return roots, singles
+
+
+@metrics.stage('snapshot')
 @pass_zfs_pool
 def take_snapshot(snapname, restrictdatasets=None, nodatasets=None, recursive=True, zpool=None):
     """Take a recursive snapshot with the given name, possibly excluding some datasets.
     
     restrictdatasets and nodatasets are optional lists of datasets to include or exclude
-    from the recursive snapshot."""
-    # take recursive snapshot of all datasets...
-    fullsnapname = '%s@%s' % (zpool, snapname)
-    print "Taking snapshot '%s'" % fullsnapname
+    from the recursive snapshot. All the datasets are snapshotted atomically by a single
+    'zfs snapshot' call, so nothing has to be destroyed afterwards. snapname may
+    also be a list of names, all taken by that same call."""
+    if isinstance(snapname, basestring):
+        snapnames = [snapname]
+    else:
+        snapnames = snapname
+    print "Taking snapshot %s" % ', '.join(["'%s@%s'" % (zpool, name) for name in snapnames])
     if restrictdatasets:
         restrictdatasets = [ds.rstrip('/') for ds in restrictdatasets]
     print "Restricting to:", str(restrictdatasets)
     print "Excluding:", str(nodatasets)
-    if recursive:
-        command = 'zfs snapshot -r %s' % fullsnapname
+    roots, singles = plan_snapshot(restrictdatasets, nodatasets, recursive=recursive, zpool=zpool)
+    if not roots and not singles:
+        raise Exception("No datasets left to snapshot in pool '%s'!" % zpool)
+    topology = get_topology()
+    covered = list(singles)
+    for root in roots:
+        covered.extend([ds.name for ds in topology.datasets[root].walk()])
+    if not singles:
+        # whole subtrees only
+        args = ['zfs', 'snapshot', '-r'] + ['%s@%s' % (ds, name) for name in snapnames for ds in roots]
     else:
-        command = 'zfs snapshot %s' % fullsnapname
-    #print "Exec '%s'" % command
-    p = subprocess.Popen(command.split(' '))
-    p.wait()
-    if p.returncode:
-        raise Exception("Error executing '%s': %d" % (command, p.returncode))
-    # ... then prune away undesired datasets if necessary
-    if restrictdatasets:
-        # remove whatever is not required, under ours
-        for ds in get_datasets():
-            # do not remove /usr/foo if there is any wanted dataset starting with /usr
-            if not filter(lambda x: ds.startswith(x), restrictdatasets):
-                destroy_snapshot(snapname, ds, recursive=False)
-    if nodatasets:
-        # remove whatever is explicitly excluded
-        for ds in get_datasets():
-            if ds in nodatasets:
-                destroy_snapshot(snapname, dataset=ds, recursive=True)
-
-def get_snapshots(dataset=''):
-    """Return the list of snapshots order by increasing timestamp"""
-    # filter my tags
-    return os.listdir(dataset + ZFS_DEFAULT_SNAPSHOT_DIR)
+        # -r applies to every argument: spell out the subtrees too
+        args = ['zfs', 'snapshot'] + ['%s@%s' % (ds, name) for name in snapnames for ds in covered]
+    #print "Exec '%s'" % ' '.join(args)
+    returncode = _run(args)[0]
+    if returncode:
+        raise Exception("Error executing '%s': %d" % (' '.join(args), returncode))
+    _remember_snapshots(covered, snapnames)
+
+@pass_zfs_pool
+def send_command(snapname, dataset='', snapname_from=None, recursive=True, mode='plain', zpool=None):
+    """Return the 'zfs send' command line dumping a snapshot, as a list of arguments.
+
+    If snapname_from is given, the stream is incremental from that snapshot.
+    mode is one of SEND_MODE_FLAGS."""
+    args = ['zfs', 'send'] + SEND_MODE_FLAGS[mode]
+    if recursive: args.append('-R')
+    if snapname_from: args.extend(['-i', '@%s' % snapname_from])
+    args.append('%s%s@%s' % (zpool, dataset, snapname))
+    return args
+
+
+def receive_command(target, force=False):
+    """Return the 'zfs receive' command line restoring a stream under target, as a list of arguments.
+
+    The received datasets keep the names they were sent with, minus the pool
+    name, and are left unmounted. With force, target is rolled back to the most
+    recent snapshot before receiving an incremental stream."""
+    args = ['zfs', 'receive', '-u']
+    if force: args.append('-F')
+    args.extend(['-d', target])
+    return args
+
+
+def estimate_send_size(sendargs):
+    """Return the size in bytes of the stream a 'zfs send' command line would produce.
+
+    Uses a dry run ('zfs send -nvP'). Return None if zfs cannot tell."""
+    args = sendargs[:2] + ['-n', '-v', '-P'] + sendargs[2:]
+    returncode, zfsout, zfserr = _run(args, stdout=True, stderr=True)
+    if returncode:
+        return None
+    # the summary goes to stdout or stderr depending on the zfs version
+    for line in (zfsout + zfserr).split('\n'):
+        fields = line.split('\t')
+        if fields[0] == 'size' and len(fields) > 1 and fields[1].isdigit():
+            return int(fields[1])
+    return None
+
+
+@pass_zfs_pool
+def get_written(snapname, snapname_from, dataset='', recursive=True, zpool=None):
+    """Return the bytes written between two snapshots, in the dataset and its children if recursive."""
+    args = ['zfs', 'get', '-H', '-p', '-o', 'value']
+    if recursive: args.append('-r')
+    args.extend(['written@%s' % snapname_from, '%s%s@%s' % (zpool, dataset, snapname)])
+    returncode, zfsout, zfserr = _run(args, stdout=True)
+    if returncode:
+        return None
+    return sum([int(value) for value in zfsout.split() if value.isdigit()])
+
+
+@pass_zfs_pool
+def get_storage_properties(zpool=None):
+    """Return a dict mapping the datasets of a pool to their (compression, encryption) values.
+
+    Loaded with a single 'zfs get' call per pool and kept for the run. ZFS
+    versions without encryption report it 'off'."""
+    with _cache_lock:
+        if zpool in _storage_properties:
+            return _storage_properties[zpool]
+        properties = {}
+        for props in ('compression,encryption', 'compression'):
+            args = ['zfs', 'get', '-H', '-p', '-r', '-t', 'filesystem,volume', '-o', 'name,property,value', props, zpool]
+            returncode, zfsout, zfserr = _run(args, stdout=True, stderr=True)
+            # without encryption support, asking for it fails: ask for compression alone
+            if returncode == 0: break
+        if returncode:
+            raise Exception("Error executing '%s': %d" % (' '.join(args), returncode))
+        for line in zfsout.split('\n'):
+            fields = line.split('\t')
+            if len(fields) < 3: continue
+            properties.setdefault(fields[0], {})[fields[1]] = fields[2]
+        _storage_properties[zpool] = dict([(name, (values.get('compression', 'off'), values.get('encryption', 'off')))
+                for name, values in properties.items()])
+        return _storage_properties[zpool]
+
+
+@pass_zfs_pool
+def choose_send_mode(dataset='', recursive=True, zpool=None):
+    """Return how to send a dataset, and its children if recursive, with the least work.
+
+    Return (mode, packed): mode is 'raw' if any of the datasets is encrypted,
+    so that its data never leaves the pool decrypted, 'compressed' if any is
+    compressed, 'plain' otherwise; packed tells whether all of them are
+    compressed or encrypted, so that the stream is hardly worth compressing again."""
+    dsname = zpool + dataset
+    sent = [props for name, props in get_storage_properties(zpool=zpool).items()
+            if name == dsname or (recursive and name.startswith(dsname + '/'))]
+    if not sent:
+        return 'plain', False
+    compressed = [compression not in ('off', '-') for compression, encryption in sent]
+    encrypted = [encryption not in ('off', '-') for compression, encryption in sent]
+    packed = not [True for c, e in zip(compressed, encrypted) if not c and not e]
+    if True in encrypted:
+        return 'raw', packed
+    if True in compressed:
+        return 'compressed', packed
+    return 'plain', False
 
+
+@pass_zfs_pool
+def get_snapshot_property(snapnames, prop, dataset='', zpool=None):
+    """Return a dict mapping snapshot names of a dataset to their value of a property.
+
+    Snapshots where the property is not set are left out."""
+    if not snapnames:
+        return {}
+    args = ['zfs', 'get', '-H', '-p', '-o', 'name,value', prop] + ['%s%s@%s' % (zpool, dataset, snap) for snap in snapnames]
+    zfsout = _run(args, stdout=True)[1]
+    values = {}
+    for line in zfsout.split('\n'):
+        fields = line.split('\t')
+        if len(fields) < 2 or fields[1] == '-': continue
+        values[fields[0].partition('@')[2]] = fields[1]
+    return values
+
+
+@pass_zfs_pool
+def set_snapshot_property(snapname, prop, value, dataset='', zpool=None):
+    """Set a (user) property on a snapshot."""
+    command = 'zfs set %s=%s %s%s@%s' % (prop, value, zpool, dataset, snapname)
+    returncode = _run(command.split(' '))[0]
+    if returncode:
+        raise Exception("Error executing '%s': %d" % (command, returncode))
+
+
+@pass_zfs_pool
+def get_pool_latency(interval=1, zpool=None):
+    """Return the average I/O latency of a pool over the next interval seconds, in milliseconds.
+
+    Latency is the worst of the total read and write wait reported by
+    'zpool iostat -l'. Return None if zpool cannot tell."""
+    returncode, zpoolout, zpoolerr = _run(['zpool', 'iostat', '-l', '-H', '-p', zpool, str(interval), '2'], stdout=True)
+    if returncode:
+        return None
+    # the first sample averages since boot: the last one is over the interval
+    lines = [line for line in zpoolout.split('\n') if line.split('\t')[0] == zpool]
+    if not lines:
+        return None
+    waits = []
+    for field in lines[-1].split('\t')[7:9]:
+        if field.isdigit(): waits.append(int(field))
+    if not waits:
+        return None
+    # -p reports nanoseconds
+    return max(waits) / 1000000.0
+
+
+def get_snapshot_inventory():
+    """Return all snapshots on the system, indexed by full dataset name.
+
+    Each dataset maps to a list of (snapname, creation, used) tuples ordered by
+    creation time. The inventory is loaded with a single 'zfs list' call and
+    kept for the rest of the run; operations changing snapshots update it."""
+    global _snapshot_inventory
+    with _cache_lock:
+        if _snapshot_inventory is not None:
+            return _snapshot_inventory
+        command = 'zfs list -t snapshot -H -p -o name,creation,used'
+        with metrics.timed('inventory'):
+            returncode, zfsout, zfserr = _run(command.split(' '), stdout=True)
+        if returncode:
+            raise Exception("Error executing '%s': %d" % (command, returncode))
+        inventory = {}
+        for line in zfsout.split('\n'):
+            if not line: continue
+            fullname, creation, used = line.split('\t')[:3]
+            dsname, sep, snapname = fullname.partition('@')
+            inventory.setdefault(dsname, []).append((snapname, int(creation), int(used)))
+        for snaps in inventory.values():
+            snaps.sort(key=lambda x: x[1])
+        _snapshot_inventory = inventory
+        return _snapshot_inventory
+
+
+def get_snapshot_inventory_generation():
+    """Return a counter increased every time the snapshot inventory changes."""
+    return _snapshot_inventory_generation
+
+
+def invalidate_snapshot_inventory():
+    """Drop the cached snapshot inventory, forcing a reload on next access."""
+    global _snapshot_inventory, _snapshot_inventory_generation
+    with _cache_lock:
+        _snapshot_inventory = None
+        _snapshot_inventory_generation += 1
+
+
+def _remember_snapshots(dsnames, snapnames):
+    """Add snapshots just taken to the cached inventory, if loaded."""
+    global _snapshot_inventory_generation
+    with _cache_lock:
+        if _snapshot_inventory is None:
+            return
+        creation = int(time.time())
+        for ds in dsnames:
+            _snapshot_inventory.setdefault(ds, []).extend([(name, creation, 0) for name in snapnames])
+        _snapshot_inventory_generation += 1
+
+
+def _forget_snapshots(dsname, snapnames, recursive=False):
+    """Remove destroyed snapshots from the cached inventory, if loaded."""
+    global _snapshot_inventory_generation
+    with _cache_lock:
+        if _snapshot_inventory is None:
+            return
+        snapnames = set(snapnames)
+        for ds in _snapshot_inventory.keys():
+            if ds == dsname or (recursive and ds.startswith(dsname + '/')):
+                _snapshot_inventory[ds] = [x for x in _snapshot_inventory[ds] if x[0] not in snapnames]
+        _snapshot_inventory_generation += 1
+
+
+@pass_zfs_pool
+def get_snapshots(dataset='', zpool=None):
+    """Return the list of snapshots of a dataset ordered by increasing creation time"""
+    return [x[0] for x in get_snapshot_inventory().get(zpool + dataset, [])]
@@ -31,20 +31,40 @@
 #
 
 
-import subprocess
+import atexit
 import time
-import signal
 import os
 import sys
+import traceback
 from datetime import datetime
 from optparse import OptionParser
 
 
+import catalog
+import checkpoint
+import daemon
+import dumpsink
+import engine
+import manifest
+import metrics
+import pipeline
+import planner
+import restore
+import scheduler
+import sendstream
+import throttle
+import transport
 import zfs
 import zsnapman
 
 DEFAULT_ZBK_TAG = 'zbk'
 
+# MB of stream buffered for each --tee output and the main one, unless they say otherwise
+DEFAULT_TEE_BUFFER = 64
+
+# seconds an --tee output not failing the dump may hold the others back before it is dropped
+DEFAULT_TEE_STALL = 60
+
 
 ### UTILITY FUNCTIONS
 
@@ -52,84 +72,392 @@ DEFAULT_ZBK_TAG = 'zbk'
 global _opts
 
 
-def _make_backup_filename(seqno, tag=None, dataset=None, path='.', include_hostname=True, suffix=''):
+def _filename_host(host=None):
+    """Return how a host name appears in backup filenames. Default to this host."""
+    if host is None: host = os.uname()[1]
+    return host.replace('-', '_').replace('.', '_')
+
+
+def _filename_dataset(dataset=None, zpool=None):
+    """Return how a dataset of zpool appears in backup filenames. If dataset is None, the root is assumed.
+
+    Datasets of the default pool are named without the pool, as they always were."""
+    default = zfs.get_default_pool()
+    if not dataset:
+        return zpool or default
+    if zpool and zpool != default: dataset = zpool + dataset
+    # translate bad characters to _
+    return dataset.replace('/', '_')
+
+
+def _make_backup_filename(seqno, tag=None, dataset=None, path='.', include_hostname=True, suffix='', zpool=None):
     """Return a suitable backup filename for a given seqno.
 
-    If dataset is None, the root is assumed."""
+    If dataset is None, the root is assumed; if zpool is None, the default pool."""
     global _opts
-    if not dataset:
-        dataset = zfs.get_default_pool()
-    else:
-        # translate bad characters to _
-        dataset = dataset.replace('/', '_')
     if not tag:
         if _opts: tag=_opts.context
         else: tag=DEFAULT_ZBK_TAG
     if path == '.' and _opts: path=_opts.output.rstrip('/')
-    return '%s/backup-%s-%s-%d-%s-%s.zfsdump%s' % (path, os.uname()[1].replace('-', '_').replace('.', '_'), tag, seqno, datetime.now().strftime(zsnapman.DEFAULT_TIMESTRFORMAT), dataset, suffix)
+    return '%s/backup-%s-%s-%d-%s-%s.zfsdump%s' % (path, _filename_host(), tag, seqno, datetime.now().strftime(zsnapman.DEFAULT_TIMESTRFORMAT), _filename_dataset(dataset, zpool), suffix)
+
+
+def _get_codec(compress=False):
+    """Return the codec to write dumps with.
+
+    compress may be True for gzip, the name of a codec, or False to follow the options."""
+    global _opts
+    if compress is True:
+        name = 'gzip'
+    elif compress:
+        name = compress
+    elif _opts and _opts.codec:
+        name = _opts.codec
+    elif _opts and _opts.compress:
+        name = 'gzip'
+    else:
+        name = 'none'
+    return pipeline.get_codec(name)
+
+
+def _send_mode(dataset, recursive, zpool, codec):
+    """Return the send mode to dump dataset with as the options ask, and the codec to compress it with.
+
+    With 'auto', blocks go out as they are stored: raw if encrypted,
+    compressed if compressed. Compressing such a stream again gains little,
+    so the codec is dropped when every dataset sent is compressed or encrypted."""
+    global _opts
+    mode = _opts and _opts.send_mode or 'plain'
+    if mode != 'auto':
+        return mode, codec
+    mode, packed = zfs.choose_send_mode(dataset, recursive=recursive, zpool=zpool)
+    if packed and codec.name != 'none':
+        print "Sending %s blocks, already packed: not compressing with %s" % (mode, codec.name)
+        codec = pipeline.get_codec('none')
+    return mode, codec
+
+
+def _make_throttle(zpool=None):
+    """Return the stage limiting the send rate from zpool as the options ask, or None."""
+    global _opts
+    if not _opts or not (_opts.rate_limit or _opts.rate_schedule or _opts.latency_threshold):
+        return None
+    schedule = _opts.rate_schedule and throttle.Schedule(_opts.rate_schedule) or None
+    monitor = None
+    if _opts.latency_threshold:
+        monitor = throttle.get_latency_monitor(zpool or zfs.get_default_pool(), _opts.latency_interval)
+    return throttle.ThrottleStage(_opts.rate_limit, schedule, monitor, _opts.latency_threshold)
+
+
+def _codec_stage(codec):
+    """Return the stage compressing with codec, in parallel blocks if the options ask."""
+    global _opts
+    if _opts and _opts.compress_workers > 1:
+        return pipeline.ParallelCodecStage(codec, _opts.compress_workers, _opts.compress_blocksize * 1024 * 1024)
+    return pipeline.CodecStage(codec)
+
+
+def _parse_tee(spec):
+    """Parse a --tee output, DEST[,codec=NAME][,buffer=MB][,on-error=abort|continue][,stall=SEC], into a dict."""
+    fields = spec.split(',')
+    tee = {'dest': fields[0], 'codec': None, 'buffer': DEFAULT_TEE_BUFFER, 'required': False, 'stall': None}
+    stall = None
+    for field in fields[1:]:
+        key, value = field.partition('=')[::2]
+        try:
+            if key == 'codec':
+                tee['codec'] = pipeline.get_codec(value).name
+            elif key == 'buffer':
+                tee['buffer'] = int(value)
+            elif key == 'stall':
+                stall = float(value)
+            elif key == 'on-error' and value in ('abort', 'continue'):
+                tee['required'] = value == 'abort'
+            else:
+                raise ValueError(field)
+        except ValueError:
+            tee['dest'] = None
+    if not tee['dest']:
+        raise Exception("Bad --tee output '%s': expected DEST[,codec=NAME][,buffer=MB][,on-error=abort|continue][,stall=SEC]" % spec)
+    # an output that may fail must not hang the others for good; stall=0 is no limit
+    if stall is None and not tee['required']: stall = DEFAULT_TEE_STALL
+    tee['stall'] = stall or None
+    return tee
+
+
+def _tee_branches(args, outfile, codec, hashes, dumpmanifest=None):
+    """Return the --tee outputs of the dump of args into outfile, as (branch, path, codec) tuples.
+
+    Outputs without a codec of their own use codec. Each is named as outfile,
+    with the suffix of its codec; path is None for outputs to a transport,
+    which are told what the dump is from dumpmanifest."""
+    global _opts
+    name = os.path.basename(outfile)
+    if codec.suffix and name.endswith(codec.suffix): name = name[:-len(codec.suffix)]
+    tees = []
+    for spec in _opts.tees:
+        tee = _parse_tee(spec)
+        teecodec = tee['codec'] and pipeline.get_codec(tee['codec']) or codec
+        compressed = teecodec.name != 'none'
+        stages = compressed and [_codec_stage(teecodec)] or []
+        if hashes: stages.append(pipeline.HashStage(hashes, raw=not compressed))
+        if '://' in tee['dest']:
+            path = None
+            title = '%s (%s)' % (tee['dest'], name + teecodec.suffix)
+        else:
+            path = title = os.path.join(tee['dest'].rstrip('/'), name + teecodec.suffix)
+        try:
+            if path is None:
+                sink = transport.open_sink(tee['dest'], name + teecodec.suffix, teecodec, force=_opts.receive_force,
+                        sockbuf=_opts.socket_buffer * 1024 * 1024, timeout=tee['stall'], dumpmanifest=dumpmanifest)
+            else:
+                sink = _file_sink(path, args, compressed)
+        except Exception as e:
+            if tee['required']: raise
+            print "Output %s failed, dropped: %s" % (title, e)
+            continue
+        branch = pipeline.Branch(title, stages, sink, buffer=tee['buffer'] * 1024 * 1024, required=tee['required'], max_stall=tee['stall'])
+        tees.append((branch, path, teecodec))
+    return tees
+
+
+def _file_sink(outfile, args, compressed, offset=None, resumable=False):
+    """Return the sink writing the output of args into outfile, as the options ask."""
+    global _opts
+    if not _opts or not _opts.direct_io:
+        return pipeline.FileSink(outfile, offset=offset)
+    size = None
+    if not compressed and offset is None:
+        # the file will be as large as the stream: reserve that on disk
+        size = zfs.estimate_send_size(args)
+    return dumpsink.DumpSink(outfile, size=size, offset=offset, resumable=resumable)
 
 
-def _run_command(commandstr, outfile, compress=False):
-    """Run command saving stdout into outfile"""
-    if compress:
-        mycommand = '%s | gzip -2 > %s' % (commandstr, outfile)
+def _run_command(args, outfile, codec=None, checkpoint=None, dataset=None, dumpmanifest=None, zpool=None):
+    """Run command saving stdout into outfile, compressed with codec.
+
+    With --remote, the output goes to the remote destination instead, under
+    the name of outfile where the transport has names, and the manifest only
+    tells the destination what the dump is. With a checkpoint, the dump records its progress there, and resumes from
+    it if the checkpoint has some. With a manifest, the sizes and checksums of
+    the dump are filled in and the manifest is saved once the dump is complete.
+
+    Without a checkpoint, the stream also goes to the --tee outputs. Return
+    the files of those completed, each with its manifest (and index) if there
+    is one."""
+    global _opts
+    stages = []
+    remote = _opts and _opts.remote
+    if remote:
+        destination = '%s (%s)' % (_opts.remote, os.path.basename(outfile))
+        sink = transport.open_sink(_opts.remote, os.path.basename(outfile), codec or pipeline.Codec(),
+                force=_opts.receive_force, sockbuf=_opts.socket_buffer * 1024 * 1024, dumpmanifest=dumpmanifest)
     else:
-        mycommand = '%s > %s' % (commandstr, outfile)
-    print "Exec '%s'" % (mycommand)
+        destination = outfile
+        sink = None
+    hashes = dumpmanifest and _opts and not remote and pipeline.get_hashes(_opts.checksum) or []
+    compressed = codec and codec.name != 'none'
+    throttler = _make_throttle(zpool)
+    if throttler:
+        # hold zfs send back before it reads any more from the pool
+        stages.append(throttler)
+    if _opts and _opts.buffer:
+        # absorb the bursts of zfs send before any other work is done on the data
+        stages.append(pipeline.BufferStage(_opts.buffer * 1024 * 1024, low=_opts.buffer_low, high=_opts.buffer_high))
+    # without a codec, the stream and the file are the same bytes: hash them once
+    if hashes and compressed:
+        stages.append(pipeline.HashStage(hashes, raw=True))
+    indexer = None
+    if _opts and _opts.index_dumps and not _opts.remote:
+        # index the stream on its way, rather than reading the dump back for it
+        indexer = sendstream.IndexStage()
+        stages.append(indexer)
+    # the stages so far see the stream for all outputs
+    shared = len(stages)
+    if compressed:
+        stages.append(_codec_stage(codec))
+        print "Exec '%s' (%s) > %s" % (' '.join(args), codec.name, destination)
+    else:
+        print "Exec '%s' > %s" % (' '.join(args), destination)
+    if hashes:
+        file_hash = pipeline.HashStage(hashes, raw=not compressed)
+        # resuming, hash what the file already holds (a raw stage hashes the skipped stream instead)
+        if checkpoint is not None and checkpoint.file_offset and not file_hash.raw:
+            partial = outfile
+            if not os.path.exists(partial): partial = dumpsink.partial_path(outfile)
+            file_hash.prime_file(partial, checkpoint.file_offset)
+        stages.append(file_hash)
+    priority = _opts and throttle.Priority.parse(_opts.nice, _opts.ionice) or None
+    tees = []
+    if checkpoint is None and _opts and _opts.tees:
+        tees = _tee_branches(args, outfile, codec or pipeline.Codec(), hashes, dumpmanifest)
+        for branch, path, teecodec in tees:
+            print "  and (%s) > %s" % (teecodec.name, branch.name)
     pstart = time.time()
-    p = subprocess.Popen(mycommand, shell=True)
+    if checkpoint is None:
+        if sink is None: sink = _file_sink(outfile, args, compressed)
+        if tees:
+            # a branch of its own for the main output, buffered like the others so that a slow
+            # disk under it does not hold them back, and failing the dump if it fails
+            main_branch = pipeline.Branch(destination, stages[shared:], sink, buffer=_opts.tee_main_buffer * 1024 * 1024,
+                    max_stall=_opts.tee_main_stall)
+            stages, sink = stages[:shared], pipeline.TeeSink([main_branch] + [branch for branch, path, teecodec in tees])
+        sendpipe = pipeline.SendPipeline(args, sink, stages, priority=priority)
+    elif checkpoint.raw_offset:
+        print "Resuming at %d bytes of the stream, %d bytes of the file" % (checkpoint.raw_offset, checkpoint.file_offset)
+        sendpipe = pipeline.SendPipeline(args, _file_sink(outfile, args, compressed, checkpoint.file_offset, resumable=True), stages,
+                checkpoint=checkpoint.update, checkpoint_interval=_opts.checkpoint_interval * 1024 * 1024,
+                skip=checkpoint.raw_offset, skip_crc=checkpoint.raw_crc, priority=priority)
+    else:
+        sendpipe = pipeline.SendPipeline(args, _file_sink(outfile, args, compressed, resumable=True), stages,
+                checkpoint=checkpoint.update, checkpoint_interval=_opts.checkpoint_interval * 1024 * 1024, priority=priority)
+    completed = False
     try:
-        sts = os.waitpid(p.pid, 0)[1]
-    except:
-        # kill the child if I'm interrupted here
-        os.kill(p.pid, signal.SIGTERM)
-    if p.returncode:
-        raise Exception("Error executing '%s': %d" % (mycommand, p.returncode))
+        sendpipe.run()
+        completed = True
+    finally:
+        # failed or interrupted dumps are accounted too, -1 standing for no exit status
+        stages = sendpipe.all_stages()
+        returncode = stages[0].returncode
+        if not completed and not returncode: returncode = -1
+        metrics.record_command(args, time.time() - pstart, returncode)
+        metrics.get_metrics().record_dump(dataset, destination, stages, time.time() - pstart, success=completed, pool=zpool)
+    for stage in stages:
+        print "  %s" % stage.report()
     print "Run time: %.1f sec" % (time.time() - pstart)
+    if tees:
+        stages = stages[:-1] + main_branch.stages
+    hashstages = [stage for stage in stages if isinstance(stage, pipeline.HashStage)]
+    if dumpmanifest and not remote:
+        dumpmanifest.raw_size = stages[0].bytes_out
+        dumpmanifest.size = os.path.getsize(outfile)
+        if hashstages:
+            dumpmanifest.raw_digests = hashstages[0].digests()
+            dumpmanifest.digests = hashstages[-1].digests()
+        dumpmanifest.save()
+    written = []
+    for branch, path, teecodec in tees:
+        if branch.error is not None:
+            if path is not None and os.path.exists(path): os.unlink(path)
+            continue
+        if path is None: continue
+        written.append(path)
+        if dumpmanifest and not remote:
+            m = dumpmanifest
+            teemanifest = manifest.Manifest(path, m.snap_from, m.snap_to, m.seqno, m.dataset, teecodec.name, m.command, m.send_mode)
+            teemanifest.raw_size, teemanifest.size = m.raw_size, os.path.getsize(path)
+            teemanifest.raw_digests = m.raw_digests
+            teemanifest.digests = [stage for stage in branch.stages if isinstance(stage, pipeline.HashStage)][-1].digests()
+            teemanifest.save()
+    if indexer:
+        index = indexer.index()
+        if index['errors']:
+            print "Send stream has problems: %s" % '; '.join(index['errors'])
+        for path in [outfile] + written:
+            sendstream.save_index(path, index)
+    return written
+
+
+def _send(args, bkfilename, codec, snap_from, snap_to, dataset, seqno=0, zpool=None, send_mode='plain'):
+    """Dump the output of a send command into a file, resumably if so asked,
+    and write its manifest.
+
+    Return the name of the file written, which is the one of the interrupted
+    dump if this one resumes it."""
+    global _opts
+    if _opts and _opts.remote:
+        # nothing local to resume: the manifest goes along to describe the dump where it is written
+        for path in _run_command(args, bkfilename, codec, dataset=dataset, zpool=zpool,
+                dumpmanifest=manifest.Manifest(bkfilename, snap_from, snap_to, seqno, dataset, codec.name, args, send_mode)):
+            catalog.get_catalog(os.path.dirname(path)).add(path)
+        return bkfilename
+    if not _opts or not _opts.resumable:
+        teefiles = _run_command(args, bkfilename, codec, dataset=dataset, zpool=zpool,
+                dumpmanifest=manifest.Manifest(bkfilename, snap_from, snap_to, seqno, dataset, codec.name, args, send_mode))
+        for path in [bkfilename] + teefiles:
+            catalog.get_catalog(os.path.dirname(path)).add(path)
+        return bkfilename
+    ckpt = checkpoint.find_checkpoint(os.path.dirname(bkfilename), args, codec.name)
+    if ckpt is None:
+        ckpt = checkpoint.Checkpoint(bkfilename, args, snap_from, snap_to, dataset, codec.name)
+        ckpt.save()
+    dumpmanifest = manifest.Manifest(ckpt.output, snap_from, snap_to, seqno, dataset, codec.name, args, send_mode)
+    try:
+        _run_command(args, ckpt.output, codec, ckpt, dataset=dataset, dumpmanifest=dumpmanifest, zpool=zpool)
+    except pipeline.ResumeError as e:
+        print "Cannot resume (%s): starting over" % e
+        ckpt.update(0, 0, 0)
+        _run_command(args, ckpt.output, codec, ckpt, dataset=dataset, dumpmanifest=dumpmanifest, zpool=zpool)
+    ckpt.remove()
+    catalog.get_catalog(os.path.dirname(ckpt.output)).add(ckpt.output)
+    return ckpt.output
+
+
+def _resume_dump(ckpt, zpool=None):
+    """Finish the interrupted dump of a checkpoint with its own command, codec and
+    file, whatever the options say now. Return the name of the file written."""
+    print "Found interrupted dump of '%s' into %s: resuming it." % (ckpt.snap_to, ckpt.output)
+    # the sequence number and send mode are in the name of the file
+    dump = restore.parse_dump_filename(ckpt.output)
+    seqno = dump and dump.seqno or 0
+    bkfilename = _send(ckpt.command, ckpt.output, pipeline.get_codec(ckpt.codec), ckpt.snap_from, ckpt.snap_to, ckpt.dataset,
+            seqno, zpool=zpool, send_mode=restore.dump_send_mode(ckpt.output))
+    print "Done: resumed dump of snapshot '%s' into file %s" % (ckpt.snap_to, bkfilename)
+    return bkfilename
 
 
 ### FULL AND INCREMENTAL BACKUP LOGIC
-def full_send(snapname, dataset=None, recursive=True, compress=False):
-    """Perform a full dump of a snapshot"""
+def full_send(snapname, dataset=None, recursive=True, compress=False, zpool=None):
+    """Perform a full dump of a snapshot of zpool, the default pool if None"""
     global _opts
 
     print "Back up '%s'" % snapname
-    if not compress:
-        if _opts: compress=_opts.compress
-    if compress: suffix = '.gz'
-    else: suffix = ''
-    bkfilename = _make_backup_filename(0, dataset=dataset, suffix=suffix)
+    zpool = zpool or zfs.get_default_pool()
     if not dataset: dataset = ''
-    targetsnap = '%s%s@%s' % (zsnapman.DEFAULT_ZPOOL, dataset, snapname)
-    if recursive:
-        command = 'zfs send -R %s' % targetsnap
-    else:
-        command = 'zfs send %s' % targetsnap
-    _run_command(command, bkfilename, compress)
+    mode, codec = _send_mode(dataset, recursive, zpool, _get_codec(compress))
+    bkfilename = _make_backup_filename(0, dataset=dataset or None, suffix=zfs.SEND_MODE_SUFFIXES[mode] + codec.suffix, zpool=zpool)
+    command = zfs.send_command(snapname, dataset, recursive=recursive, mode=mode, zpool=zpool)
+    bkfilename = _send(command, bkfilename, codec, None, snapname, dataset, zpool=zpool, send_mode=mode)
     print "Done: full dump of snapshot '%s' into file %s" % (snapname, bkfilename)
     return bkfilename
 
-def incremental_send(snapname_from, snapname_to, seqno, dataset=None, recursive=True, compress=False):
-    """Perform an incremental dump between two snapshots"""
+def incremental_send(snapname_from, snapname_to, seqno, dataset=None, recursive=True, compress=False, zpool=None):
+    """Perform an incremental dump between two snapshots of zpool, the default pool if None"""
 
     global _opts
     print "Backing up from '%s' -> '%s' (seqno %d)" % (snapname_from, snapname_to, seqno)
-    if not compress:
-        if _opts: compress=_opts.compress
-    if compress: suffix = '.gz'
-    else: suffix = ''
-    bkfilename = _make_backup_filename(seqno, dataset=dataset, suffix=suffix)
+    zpool = zpool or zfs.get_default_pool()
     if not dataset: dataset = ''
-    targetsnap = '%s%s@%s' % (zsnapman.DEFAULT_ZPOOL, dataset, snapname_to)
-    if recursive:
-        command = 'zfs send -R -i @%s %s' % (snapname_from, targetsnap)
-    else:
-        command = 'zfs send -i @%s %s' % (snapname_from, targetsnap)
-    _run_command(command, bkfilename, compress)
+    mode, codec = _send_mode(dataset, recursive, zpool, _get_codec(compress))
+    bkfilename = _make_backup_filename(seqno, dataset=dataset or None, suffix=zfs.SEND_MODE_SUFFIXES[mode] + codec.suffix, zpool=zpool)
+    command = zfs.send_command(snapname_to, dataset, snapname_from=snapname_from, recursive=recursive, mode=mode, zpool=zpool)
+    bkfilename = _send(command, bkfilename, codec, snapname_from, snapname_to, dataset, seqno, zpool=zpool, send_mode=mode)
     print "Done: incremental dump '%s' -> '%s' into file %s" % (snapname_from, snapname_to, bkfilename)
     return bkfilename
 
-def _handle_alternate_dumps(previous_snaps, current_snapname, individuals, backlog_num=None):
+def _dump_datasets(datasets, dumpfunc, *args, **kwargs):
+    """Call dumpfunc(*args, dataset=ds, zpool=zpool) for each dataset, concurrently as the options allow.
+
+    The datasets are those of the pool given as zpool keyword, the default
+    pool if none. Return the list of dump file names."""
+    global _opts
+    zpool = kwargs.get('zpool') or zfs.get_default_pool()
+    if _opts:
+        sched = scheduler.DumpScheduler(_opts.jobs, per_pool=_opts.jobs_per_pool, per_device=_opts.jobs_per_device)
+        device = os.stat(_opts.output).st_dev
+    else:
+        sched = scheduler.DumpScheduler()
+        device = None
+    topology = zfs.get_topology()
+    for ds in datasets:
+        dataset = topology.get_dataset(zpool, ds)
+        # space used by the dataset and its children: what a full dump would send
+        size = dataset and dataset.properties.get('used') or 0
+        sched.add(scheduler.DumpJob(dumpfunc, args, {'dataset': ds, 'zpool': zpool}, name=zpool + ds, pool=zpool, device=device, size=size))
+    return [job.result for job in sched.run()]
+
+
+def _handle_alternate_dumps(previous_snaps, current_snapname, individuals, backlog_num=None, zpool=None):
     """Dump according to an alternate scheme.
 
     Keep last backlog_num snaps, and dump with this algorithm:
@@ -140,37 +468,63 @@ def _handle_alternate_dumps(previous_snaps, current_snapname, individuals, backl
         step 5) INCR     2-4
         ...
     If a backlog_num is specified, keep that many most-recent snapshots; if 0,
-    infinite; if not specified, remove all but last."""
+    infinite; if not specified, remove all but last. Return the dump file names."""
     num_previous_snaps = len(previous_snaps)
     if backlog_num and len(previous_snaps) >= backlog_num:
         # time to start from scratch
         print "Starting over after %d steps." % len(previous_snaps)
-        for ds in individuals:
-            bkfname = full_send(current_snapname, dataset=ds)
+        bkfnames = _dump_datasets(individuals, full_send, current_snapname, zpool=zpool)
         # prune old serie, if any
         print "Cleaning up snapshots from old series."
-        for snap in previous_snaps:
-            zfs.destroy_snapshot(snap)
-        _done()
+        zfs.destroy_snapshots(previous_snaps, zpool=zpool)
+        return bkfnames
     # go incremental from 2 steps ago
     assert num_previous_snaps > 0
     if num_previous_snaps == 1:
         # backup from base snap
         if not individuals:
-            incremental_send(previous_snaps[0], current_snapname, num_previous_snaps)
+            return [incremental_send(previous_snaps[0], current_snapname, num_previous_snaps, zpool=zpool)]
         else:
-            for ds in individuals:
-                incremental_send(previous_snaps[0], current_snapname, num_previous_snaps, dataset=ds)
+            return _dump_datasets(individuals, incremental_send, previous_snaps[0], current_snapname, num_previous_snaps, zpool=zpool)
     else:
         # backup from 2 steps before
         if not individuals:
-            incremental_send(previous_snaps[-2], current_snapname, num_previous_snaps)
+            return [incremental_send(previous_snaps[-2], current_snapname, num_previous_snaps, zpool=zpool)]
         else:
-            for ds in individuals:
-                incremental_send(previous_snaps[-2], current_snapname, num_previous_snaps, dataset=ds)
+            return _dump_datasets(individuals, incremental_send, previous_snaps[-2], current_snapname, num_previous_snaps, zpool=zpool)
+
 
+def _handle_planned_dumps(previous_snaps, current_snapname, individuals, zpool=None):
+    """Dump choosing for each dataset the cheapest of full and incremental dumps.
 
-def _handle_sequential_dumps(previous_snaps, current_snapname, individuals, backlog_num=None):
+    The planner estimates the stream size of each option and picks the smallest
+    whose restore chain does not exceed --max-chain. All plans are printed
+    before anything is sent. Return the dump file names."""
+    global _opts
+    seqno = len(previous_snaps)
+    plans = {}
+    for ds in individuals or ['']:
+        plans[ds] = planner.plan_dump(current_snapname, previous_snaps, ds, max_chain=_opts.max_chain,
+                rate=_opts.plan_rate, alternate=_opts.alternate_dumps, zpool=zpool)
+        print plans[ds].report()
+    if _opts.plan_only: return []
+
+    def _planned_send(dataset=None, zpool=None):
+        plan = plans[dataset or '']
+        if plan.chosen.base is None:
+            bkfname = full_send(current_snapname, dataset=dataset, zpool=zpool)
+        else:
+            bkfname = incremental_send(plan.chosen.base, current_snapname, seqno, dataset=dataset, zpool=zpool)
+        planner.record_depth(plan, zpool=zpool)
+        return bkfname
+
+    if not individuals:
+        return [_planned_send(zpool=zpool)]
+    else:
+        return _dump_datasets(individuals, _planned_send, zpool=zpool)
+
+
+def _handle_sequential_dumps(previous_snaps, current_snapname, individuals, backlog_num=None, zpool=None):
     """Dump according to a sequential scheme.
 
     Keep last backlog_num snaps, and dump with this algorithm:
@@ -179,20 +533,19 @@ def _handle_sequential_dumps(previous_snaps, current_snapname, individuals, back
         step 3) INCR        1-2
         ..
     If a backlog_num is specified, keep that many most-recent snapshots; if 0,
-    infinite; if not specified, remove all but last."""
+    infinite; if not specified, remove all but last. Return the dump file names."""
     global _opts
     if backlog_num is None and _opts: backlog_num=_opts.backlog_num
     num_previous_snaps = len(previous_snaps)
     if not individuals:
-        incremental_send(previous_snaps[-1], current_snapname, num_previous_snaps)
+        bkfnames = [incremental_send(previous_snaps[-1], current_snapname, num_previous_snaps, zpool=zpool)]
     else:
-        for ds in individuals:
-            incremental_send(previous_snaps[-1], current_snapname, num_previous_snaps, dataset=ds)
+        bkfnames = _dump_datasets(individuals, incremental_send, previous_snaps[-1], current_snapname, num_previous_snaps, zpool=zpool)
     # clean up old serie
-    if backlog_num == 0 or backlog_num > len(previous_snaps): return
+    if backlog_num == 0 or backlog_num > len(previous_snaps): return bkfnames
     if backlog_num is None: backlog_num = 1
-    for snap in previous_snaps[:len(previous_snaps)-backlog_num+1]:
-        zfs.destroy_snapshot(snap)
+    zfs.destroy_snapshots(previous_snaps[:len(previous_snaps)-backlog_num+1], zpool=zpool)
+    return bkfnames
 
 
 def get_option_parser():
@@ -204,119 +557,573 @@ def get_option_parser():
     opars.add_option('-n', '--no-snapshot', action='store_true', dest='nosnap', help="do not take snapshot, operate (and prune) with context's most recent one", default=False)
     opars.add_option('-b', '--backlog', type="int", dest='backlog_num', metavar='NUM', help='avoid self-management: keep this many most-recent snapshots of this tag (0 = infinite)', default=None)
     opars.add_option('-a', '--maxage', type="int", dest='maxminutes', metavar='MINUTES', help='remove snapshots of this tag older than this many minutes', default=None)
+    opars.add_option('--keep-hourly', type="int", dest='keep_hourly', metavar='NUM', help='also keep the newest snapshot of each of the last NUM hours having one', default=0)
+    opars.add_option('--keep-daily', type="int", dest='keep_daily', metavar='NUM', help='also keep the newest snapshot of each of the last NUM days having one', default=0)
+    opars.add_option('--keep-weekly', type="int", dest='keep_weekly', metavar='NUM', help='also keep the newest snapshot of each of the last NUM weeks having one', default=0)
+    opars.add_option('--keep-monthly', type="int", dest='keep_monthly', metavar='NUM', help='also keep the newest snapshot of each of the last NUM months having one', default=0)
     opars.add_option('-x', '--exclude', action='append', dest='exclude_datasets', metavar='DS_MNTPOINT', help='exclude dataset from snapshot (omit zfspool name) [repeatable]', default=None)
     opars.add_option('-d', '--dataset', action='append', dest='only_datasets', metavar='DS_MNTPOINT', help="snapshot & send this daset (recursively), not all (overrides -i) [repeatable]", default=None)
+    opars.add_option('-P', '--pool', action='append', dest='pools', metavar='POOL', help='operate on this pool rather than the default one, independently of the other pools given [repeatable]', default=None)
+    opars.add_option('--all-pools', action='store_true', dest='all_pools', help='operate on every pool of the system, each independently of the others', default=False)
+    opars.add_option('--pool-jobs', type='int', dest='pool_jobs', metavar='NUM', help='with several pools, run at most this many of them concurrently (default all; -J and --jobs-per-* apply within each pool)', default=None)
 
     # dump options
     opars.add_option('-s', '--send', action='store_true', dest='send', help='dump/send snapshot after taking it (full or incremental as appropriate)', default=False)
     opars.add_option('-0', '--fulldump', action='store_true', dest='fulldump', help='perform a full dump regardless of availability of former snaps', default=False)
     opars.add_option('-i', '--dump-individually', action='append', dest='individual_dump_ds', metavar='DS_MNTPOINT', help='no root-recursion; dump this dataset individually [repeatable]', default=None)
-    opars.add_option('-k', '--compress', action='store_true', dest='compress', help='compress (gzip -4) dumped files', default=False)
+    opars.add_option('-k', '--compress', action='store_true', dest='compress', help='compress (gzip -2) dumped files', default=False)
+    opars.add_option('--codec', dest='codec', metavar='CODEC', choices=sorted(pipeline.CODECS.keys()), help='compress dumped files with this codec: %s (overrides -k)' % ', '.join(sorted(pipeline.CODECS.keys())), default=None)
+    opars.add_option('--send-mode', dest='send_mode', metavar='MODE', choices=['auto', 'plain', 'compressed', 'raw'], help="how zfs send passes blocks on: plain (decompressed), compressed (-c), raw (-w, encrypted stays encrypted) or auto, as each dataset is stored, not compressing again what is already packed (default plain)", default='plain')
+    opars.add_option('--compress-workers', type='int', dest='compress_workers', metavar='NUM', help='compress in parallel blocks on this many cores (output stays gzip/zstd/lz4 compatible)', default=1)
+    opars.add_option('--compress-blocksize', type='int', dest='compress_blocksize', metavar='MB', help='size of the blocks compressed in parallel (default 4)', default=4)
+    opars.add_option('-J', '--jobs', type='int', dest='jobs', metavar='NUM', help='dump up to this many datasets given with -d/-i concurrently, largest first', default=1)
+    opars.add_option('--jobs-per-pool', type='int', dest='jobs_per_pool', metavar='NUM', help='run at most this many concurrent dumps from the same pool', default=None)
+    opars.add_option('--jobs-per-device', type='int', dest='jobs_per_device', metavar='NUM', help='run at most this many concurrent dumps into the same output device', default=None)
+    opars.add_option('--buffer', type='int', dest='buffer', metavar='MB', help='buffer this much of the send stream in memory, to smooth out bursts of zfs send and of the output (default 0, none)', default=0)
+    opars.add_option('--buffer-low', type='int', dest='buffer_low', metavar='PCT', help='with --buffer, output waiting on an empty buffer resumes when it is this full (default %d)' % pipeline.DEFAULT_LOW_WATERMARK, default=pipeline.DEFAULT_LOW_WATERMARK)
+    opars.add_option('--buffer-high', type='int', dest='buffer_high', metavar='PCT', help='with --buffer, zfs send waiting on a full buffer resumes when it is down to this full (default %d)' % pipeline.DEFAULT_HIGH_WATERMARK, default=pipeline.DEFAULT_HIGH_WATERMARK)
+    opars.add_option('--rate-limit', type='float', dest='rate_limit', metavar='MB/S', help='read the send stream at most this fast', default=None)
+    opars.add_option('--rate-schedule', dest='rate_schedule', metavar='SCHEDULE', help="rate limits by time of day, like '08:00-20:00=50,20:00-08:00=0' (MB/s, 0 = unlimited; --rate-limit applies outside the ranges)", default=None)
+    opars.add_option('--latency-threshold', type='float', dest='latency_threshold', metavar='MS', help='slow sends down while the pool I/O latency (zpool iostat -l) is above this many milliseconds', default=None)
+    opars.add_option('--latency-interval', type='int', dest='latency_interval', metavar='SEC', help='with --latency-threshold, sample pool latency over this many seconds (default %d)' % throttle.DEFAULT_LATENCY_INTERVAL, default=throttle.DEFAULT_LATENCY_INTERVAL)
+    opars.add_option('--nice', type='int', dest='nice', metavar='NUM', help='run zfs send with this niceness increment', default=None)
+    opars.add_option('--ionice', dest='ionice', metavar='CLASS[:LEVEL]', help='run zfs send in this I/O scheduling class: idle, best-effort or realtime, with an optional level 0-7', default=None)
+    opars.add_option('--tee', action='append', dest='tees', metavar='DEST[,OPTS]', help="also write each dump to DEST, a directory or a --remote URL, from the same zfs send; OPTS are codec=NAME (default as the main output), buffer=MB (default %d), on-error=abort|continue (default continue) and stall=SEC, to drop an output holding the others back that long (default %d with on-error=continue, 0 for no limit) [repeatable]" % (DEFAULT_TEE_BUFFER, DEFAULT_TEE_STALL), default=None)
+    opars.add_option('--tee-main-buffer', type='int', dest='tee_main_buffer', metavar='MB', help='with --tee, buffer this much of the stream for the main output (default %d)' % DEFAULT_TEE_BUFFER, default=DEFAULT_TEE_BUFFER)
+    opars.add_option('--tee-main-stall', type='float', dest='tee_main_stall', metavar='SEC', help='with --tee, fail the dump if the main output holds the others back this long', default=None)
+    opars.add_option('--direct-io', action='store_true', dest='direct_io', help='write dump files around the page cache (O_DIRECT where supported, else flushed and dropped as written), preallocated, and under a .part name until complete', default=False)
+    opars.add_option('--resumable', action='store_true', dest='resumable', help='checkpoint dumps into files as they proceed, and resume interrupted ones instead of starting over', default=False)
+    opars.add_option('--checksum', dest='checksum', metavar='ALGOS', help='checksums to compute while dumping and record in the manifest of each dump, comma separated: %s, or none (default sha256)' % ', '.join(sorted(pipeline.HASHES.keys())), default='sha256')
+    opars.add_option('--index-dumps', action='store_true', dest='index_dumps', help='index the send stream of each dump as it is written, as --index does but without checking its checksums', default=False)
+    opars.add_option('--checkpoint-interval', type='int', dest='checkpoint_interval', metavar='MB', help='make resumable dumps durable every this many MB of stream (default 1024)', default=1024)
     # dump strategies
     opars.add_option('-t', '--alternate', action='store_true', dest='alternate_dumps', help='alternate dumps (0, 0-1, 0-2, 1-3, 2-4, 3-5, ..)', default=False)
+    opars.add_option('--plan', action='store_true', dest='plan', help='estimate stream sizes and dump full or incrementally from whichever base sends the fewest bytes', default=False)
+    opars.add_option('--max-chain', type='int', dest='max_chain', metavar='NUM', help='with --plan, never need more than this many dumps to restore a snapshot', default=None)
+    opars.add_option('--plan-rate', type='int', dest='plan_rate', metavar='MB/S', help='with --plan, throughput assumed to estimate durations (default %d)' % planner.DEFAULT_RATE, default=planner.DEFAULT_RATE)
+    opars.add_option('--plan-only', action='store_true', dest='plan_only', help='with --plan, print the plan for the latest existing snapshot, without taking, pruning or sending anything', default=False)
     opars.add_option('-o', '--output', dest='output', metavar='DIR', help='dump backups into such directory rather than here', default='./')
+    opars.add_option('--remote', dest='remote', metavar='URL', help='send dumps to URL rather than into files: ssh://[USER@]HOST[:PORT]/DATASET receives them under DATASET there, tcp://HOST:PORT streams them to a zfsbackup --listen', default=None)
+    opars.add_option('--receive-force', action='store_true', dest='receive_force', help='with --remote ssh:// or --listen --receive-into, roll back changes made to the received datasets (zfs receive -F)', default=False)
+    opars.add_option('--socket-buffer', type='int', dest='socket_buffer', metavar='MB', help='socket buffers of tcp:// transfers (default %d)' % (transport.DEFAULT_SOCKBUF / (1024 * 1024)), default=transport.DEFAULT_SOCKBUF / (1024 * 1024))
+
+    # command execution
+    opars.add_option('--command-timeout', type='int', dest='command_timeout', metavar='SEC', help='stop zfs commands other than sends running longer than this', default=None)
+    opars.add_option('--command-workers', type='int', dest='command_workers', metavar='NUM', help='run up to this many zfs commands in the background at once, such as the size estimates of --plan (default %d)' % engine.DEFAULT_WORKERS, default=engine.DEFAULT_WORKERS)
+
+    # long-running operation
+    opars.add_option('--daemon', dest='daemon', metavar='CONFIG', help='run the contexts described in CONFIG (an INI file) on schedule, without exiting', default=None)
+    opars.add_option('--daemon-once', action='store_true', dest='daemon_once', help='with --daemon, run every context once now and exit', default=False)
 
+    # reporting
+    opars.add_option('--metrics-json', dest='metrics_json', metavar='FILE', help='write timings and throughput of this run into FILE as JSON', default=None)
+    opars.add_option('--metrics-prom', dest='metrics_prom', metavar='FILE', help='write timings and throughput of this run into FILE for the Prometheus textfile collector', default=None)
 
     # manual snapshot handling options
     opars.add_option('--prune-exceeding', type='int', dest='prune_exceeding_minutes', metavar='MINUTES', help='destroy snapshots older than X minutes', default=None)
 
+    # manual dump handling options
+    opars.add_option('--verify', action='store_true', dest='verify', help='check the dumps given as arguments, or all in the output directory, against their manifests', default=False)
+    opars.add_option('--verify-raw', action='store_true', dest='verify_raw', help='with --verify, also decompress dumps to check the checksums of the send stream', default=False)
+    opars.add_option('--index', action='store_true', dest='index', help='parse the send streams of the dumps given as arguments, or of all in the output directory, checking their checksums, into an index file next to each', default=False)
+    opars.add_option('--find-object', type='int', dest='find_object', metavar='OBJ', help='list the dumps given as arguments, or in the output directory, whose send streams write or free object number OBJ, from their indexes', default=None)
+    opars.add_option('--check-chain', action='store_true', dest='check_chain', help='check from their indexes that the dumps --restore would receive (with --restore-snapshot, --restore-host and -t as there) follow each other', default=False)
+    opars.add_option('--restore', dest='restore_into', metavar='DATASET', help="receive under DATASET the dumps of the context (and of the dataset given with -d/-i) restoring its latest snapshot (without manifests, give -t for alternate dumps)", default=None)
+    opars.add_option('--restore-snapshot', dest='restore_snapshot', metavar='SNAPNAME', help='with --restore, restore this snapshot rather than the latest (needs manifests)', default=None)
+    opars.add_option('--restore-host', dest='restore_host', metavar='HOST', help='with --restore, restore the dumps taken on this host rather than this one', default=None)
+    opars.add_option('--restore-force', action='store_true', dest='restore_force', help='with --restore, roll back changes made to the received datasets (zfs receive -F)', default=False)
+    opars.add_option('--restore-prefetch', type='int', dest='restore_prefetch', metavar='MB', help='with --restore, decompress up to this much data ahead of zfs receive (default 256)', default=256)
+    opars.add_option('--restore-chain-only', action='store_true', dest='restore_chain_only', help='with --restore, print the dumps to receive without receiving them', default=False)
+    opars.add_option('--rebuild-catalog', action='store_true', dest='rebuild_catalog', help='rebuild the catalog of the dumps in the output directory by scanning it', default=False)
+    opars.add_option('--catalog-report', action='store_true', dest='catalog_report', help='summarize the dumps in the catalog of the output directory', default=False)
+    opars.add_option('--prune-dumps', type='int', dest='prune_dumps', metavar='NUM', help='delete the dump files of the context (and of the dataset given with -d/-i) not needed to restore its NUM most recent snapshots', default=None)
+    opars.add_option('--listen', dest='listen', metavar='[ADDR:]PORT', help='receive dumps sent with --remote tcp:// into the output directory, or under the dataset given with --receive-into; on 127.0.0.1 unless ADDR is given. Senders are not authenticated and streams not encrypted: give ADDR only on networks you trust', default=None)
+    opars.add_option('--receive-into', dest='receive_into', metavar='DATASET', help='with --listen, zfs receive the dumps under DATASET', default=None)
+    opars.add_option('--listen-once', action='store_true', dest='listen_once', help='with --listen, exit after the first dump', default=False)
+    opars.add_option('--verify-workers', type='int', dest='verify_workers', metavar='NUM', help='with --verify, check this many dumps in parallel (default 4)', default=4)
+    opars.add_option('--index-workers', type='int', dest='index_workers', metavar='NUM', help='with --index, --find-object and --check-chain, index this many dumps in parallel (default 4)', default=4)
+
     return opars
 
 
+def _write_metrics(success):
+    """Complete the metrics of this run and export them as the options ask."""
+    global _opts
+    runmetrics = metrics.get_metrics()
+    if runmetrics.finished is not None: return
+    runmetrics.finish(success)
+    if _opts.metrics_json: runmetrics.write_json(_opts.metrics_json)
+    if _opts.metrics_prom: runmetrics.write_prometheus(_opts.metrics_prom)
+
 def _done(res=0):
+    _write_metrics(res == 0)
     print "Done."
     sys.exit(res)
 
-def _list_context(context, dataset=''):
+def _retention_counts():
+    """Return the grandfather-father-son keep counts of the options."""
+    global _opts
+    return dict(hourly=_opts.keep_hourly, daily=_opts.keep_daily, weekly=_opts.keep_weekly, monthly=_opts.keep_monthly)
+
+def _list_context(context, dataset='', zpool=None):
     # print snaps for all contexts
     global _opts
     print "* Context '%s':" % context
     print "** Fresh snapshots:"
     snapctx = zsnapman.SnapshotContext(context)
-    for snap in snapctx.get_fresh_snapshots(backlog_num=_opts.backlog_num, backlog_minutes=_opts.maxminutes, dataset=dataset):
+    fresh_snaps = snapctx.get_fresh_snapshots(backlog_num=_opts.backlog_num, backlog_minutes=_opts.maxminutes, dataset=dataset, zpool=zpool, **_retention_counts())
+    for snap in fresh_snaps:
         print snap
     print "\n** Outdated snapshots:"
-    for snap in snapctx.get_outdated_snapshots(backlog_num=_opts.backlog_num, backlog_minutes=_opts.maxminutes, dataset=dataset):
-        print snap
+    fresh_set = set(fresh_snaps)
+    for snap in snapctx.get_snapshots(dataset=dataset, zpool=zpool):
+        if snap not in fresh_set: print snap
 
 
-### MAIN
+def _verify_dumps(paths):
+    """Check dump files against their manifests. Return whether all are intact."""
+    global _opts
+    if paths:
+        manifests = []
+        for path in paths:
+            if not path.endswith(manifest.MANIFEST_SUFFIX): path += manifest.MANIFEST_SUFFIX
+            try:
+                manifests.append(manifest.Manifest.load(path))
+            except (IOError, ValueError, KeyError) as e:
+                print "FAILED %s: no usable manifest (%s)" % (path, e)
+                return False
+    else:
+        manifests = manifest.list_manifests(_opts.output)
+        if not manifests:
+            print "No dump manifests in '%s'." % _opts.output
+    ok = True
+    with metrics.timed('verify'):
+        for dumpmanifest, problems in manifest.verify_manifests(manifests, _opts.verify_workers, raw=_opts.verify_raw):
+            if problems:
+                ok = False
+                print "FAILED %s: %s" % (dumpmanifest.output, '; '.join(problems))
+            else:
+                print "OK %s" % dumpmanifest.output
+    return ok
 
-def main():
-    # get user options
+
+def _dump_files(paths):
+    """Return the dumps given as paths, or all those in the output directory."""
     global _opts
-    _opts, args = get_option_parser().parse_args()
-    # cleanup options
-    if _opts.exclude_datasets: _opts.exclude_datasets = [ds.rstrip('/') for ds in _opts.exclude_datasets]
-    if _opts.only_datasets: _opts.only_datasets = [ds.rstrip('/') for ds in _opts.only_datasets]
-    if _opts.individual_dump_ds: _opts.individual_dump_ds = [ds.rstrip('/') for ds in _opts.individual_dump_ds]
-    # get context
-    snapctx = zsnapman.SnapshotContext(_opts.context)
+    if not paths:
+        dumps = restore.scan_dumps(_opts.output)
+        if not dumps:
+            print "No dumps in '%s'." % _opts.output
+        return dumps
+    dumps = []
+    for path in paths:
+        dump = restore.parse_dump_filename(path)
+        if dump is None:
+            raise Exception("'%s' is not named as a dump file" % path)
+        if os.path.exists(path + manifest.MANIFEST_SUFFIX):
+            dump.codec = manifest.Manifest.load(path + manifest.MANIFEST_SUFFIX).codec
+        dumps.append(dump)
+    return dumps
+
+
+def _index_dumps(paths):
+    """Index the send streams of dump files. Return whether all are intact."""
+    global _opts
+    ok = True
+    with metrics.timed('index'):
+        for path, index, error in sendstream.index_dumps([(d.path, d.codec) for d in _dump_files(paths)], _opts.index_workers):
+            if error is None and not index['complete'] and not index['errors']:
+                error = "incomplete stream"
+            elif error is None and index['errors']:
+                error = '; '.join(index['errors'])
+            if error is not None:
+                ok = False
+                print "FAILED %s: %s" % (path, error)
+            else:
+                print "OK %s: %d streams, %d bytes" % (path, len(index['streams']), index['stream_size'])
+    return ok
+
+
+def _dump_indexes(dumps):
+    """Return the indexes of dumps, indexing first those without an up to date one."""
+    global _opts
+    indexes = dict([(dump.path, sendstream.load_index(dump.path)) for dump in dumps])
+    missing = [dump for dump in dumps if indexes[dump.path] is None]
+    if missing:
+        print "Indexing %d dumps" % len(missing)
+        for path, index, error in sendstream.index_dumps([(d.path, d.codec) for d in missing], _opts.index_workers):
+            if error is not None:
+                raise Exception("Cannot index '%s': %s" % (path, error))
+            indexes[path] = index
+    return [indexes[dump.path] for dump in dumps]
+
+
+def _find_object(obj, paths):
+    """Print the dumps whose streams touch object obj. Return whether there are any."""
+    dumps = _dump_files(paths)
+    found = False
+    for dump, index in zip(dumps, _dump_indexes(dumps)):
+        for stream, how, mark in sendstream.find_object(index, obj):
+            found = True
+            print "%s: %s %s object %d (records from stream offset %d)" % (dump.path, stream['toname'], how, obj, mark)
+    if not found:
+        print "No dump touches object %d" % obj
+    return found
+
 
+def _restore_chain(dataset, zpool=None):
+    """Return the dumps of dataset of zpool in the output directory restoring the snapshot the options say, in order."""
+    global _opts
+    dumps = catalog.get_catalog(_opts.output).dumps(_filename_host(_opts.restore_host), _opts.context, _filename_dataset(dataset, zpool))
+    restore.link_dumps(dumps, alternate=_opts.alternate_dumps)
+    return restore.resolve_chain(dumps, _opts.restore_snapshot)
+
+
+def _check_chain(dataset, zpool=None):
+    """Check from their indexes that the dumps restoring a snapshot follow each other. Return whether they do."""
+    chain = _restore_chain(dataset, zpool)
+    problems = sendstream.chain_problems(zip([dump.path for dump in chain], _dump_indexes(chain)))
+    for problem in problems:
+        print "FAILED %s" % problem
+    if not problems:
+        print "OK chain of %d dumps" % len(chain)
+    return not problems
+
+
+def _restore(dataset, zpool=None):
+    """Restore the dumps of dataset of zpool in the output directory as the options say."""
+    global _opts
+    chain = _restore_chain(dataset, zpool)
+    print "Restore chain (%d dumps, %d bytes):" % (len(chain), sum([dump.size for dump in chain]))
+    for dump in chain:
+        print "  %s" % dump.path
+    if _opts.restore_chain_only: return
+    restore.restore_chain(chain, _opts.restore_into, force=_opts.restore_force, prefetch=_opts.restore_prefetch * 1024 * 1024)
+
+
+def _catalog_report():
+    """Print what the catalog of the output directory holds."""
+    global _opts
+    print "%-16s %-12s %-24s %6s %14s  %-20s  %s" % ('HOST', 'CONTEXT', 'DATASET', 'DUMPS', 'BYTES', 'LATEST FULL', 'LATEST DUMP')
+    for host, context, dataset, count, size, latest_full, latest in catalog.get_catalog(_opts.output).summary():
+        if latest_full is not None: latest_full = datetime.fromtimestamp(latest_full).strftime(zsnapman.DEFAULT_TIMESTRFORMAT)
+        print "%-16s %-12s %-24s %6d %14d  %-20s  %s" % (host, context, dataset, count, size, latest_full or '-', datetime.fromtimestamp(latest).strftime(zsnapman.DEFAULT_TIMESTRFORMAT))
+
+
+def _prune_dumps(dataset, keep, zpool=None):
+    """Delete the dump files of dataset of zpool not needed to restore the keep most recent snapshots."""
+    global _opts
+    dumpcatalog = catalog.get_catalog(_opts.output)
+    obsolete = dumpcatalog.obsolete_dumps(_filename_host(), _opts.context, _filename_dataset(dataset, zpool), keep, alternate=_opts.alternate_dumps)
+    print "Deleting %d dump files" % len(obsolete)
+    for dump in obsolete:
+        print "Deleting %s" % dump.path
+        for path in (dump.path + manifest.MANIFEST_SUFFIX, sendstream.index_path(dump.path), dump.path):
+            if os.path.exists(path): os.unlink(path)
+        dumpcatalog.remove(dump.path)
+
+
+def _listen(address):
+    """Receive dumps streamed from other hosts, as the options say."""
+    global _opts
+    host, sep, port = address.rpartition(':')
+    # nothing authenticates the senders: listen on this host only unless told otherwise
+    server = transport.StreamServer((host or '127.0.0.1', int(port)), directory=_opts.output, receive_into=_opts.receive_into,
+            force=_opts.receive_force, sockbuf=_opts.socket_buffer * 1024 * 1024, hashes=pipeline.get_hashes(_opts.checksum))
+    print "Listening on %s:%d" % server.address
+    try:
+        return server.serve(once=_opts.listen_once)
+    finally:
+        server.close()
+
+
+def _cleanup_options(opts):
+    if opts.exclude_datasets: opts.exclude_datasets = [ds.rstrip('/') for ds in opts.exclude_datasets]
+    if opts.only_datasets: opts.only_datasets = [ds.rstrip('/') for ds in opts.only_datasets]
+    if opts.individual_dump_ds: opts.individual_dump_ds = [ds.rstrip('/') for ds in opts.individual_dump_ds]
+
+
+def _operating_dataset():
+    """Return the dataset whose snapshots stand for those of the context."""
+    global _opts
     if _opts.individual_dump_ds:
         # pick the first as representative
-        operating_dataset = _opts.individual_dump_ds[0]
-    else:
-        # default to root
-        operating_dataset = ''
+        return _opts.individual_dump_ds[0]
+    # default to root
+    return ''
 
-    # some manual handling?
-    if _opts.list_snapshots:
-        if _opts.context == '*':
-            print "Contexts available:"
-            for c in zsnapman.existing_contexts(): print c
-            for ctx in zsnapman.existing_contexts():
-                _list_context(ctx, operating_dataset)
-        else:
-            _list_context(_opts.context, operating_dataset)
-        _done()
-    elif _opts.prune_exceeding_minutes is not None:
-        print "Pruning '%s' snapshots older than '%d' minutes" % (_opts.context, _opts.prune_exceeding_minutes)
-        for snap in snapctx.get_outdated_snapshots(backlog_minutes=_opts.prune_exceeding_minutes, dataset=operating_dataset):
-            zfs.destroy_snapshot(snap)
-        _done()
 
-    ## done with manual handling
+def _selected_pools():
+    """Return the pools to operate on one by one, None for just the default pool."""
+    global _opts
+    if _opts.all_pools:
+        return zfs.get_pools()
+    return _opts.pools
 
-    # kill outdated snapshots
-    for snap in snapctx.get_outdated_snapshots(backlog_num=_opts.backlog_num, backlog_minutes=_opts.maxminutes, dataset=operating_dataset):
-        zfs.destroy_snapshot(snap)
-    # get survived snaps in this context
-    previous_snaps = snapctx.get_snapshots(dataset=operating_dataset)
-    # take new snapshot
-    # what dataset take individually?
+
+def _dataset_selection():
+    """Return the datasets to snapshot and dump individually, None for the whole pool."""
+    global _opts
     if _opts.only_datasets:
-        ids = _opts.only_datasets
+        return _opts.only_datasets
     elif _opts.individual_dump_ds:
         # these
-        ids = _opts.individual_dump_ds
-    else:
-        # none specific, dump once root recursively
-        ids = None
+        return _opts.individual_dump_ds
+    # none specific, dump once root recursively
+    return None
+
+
+def run_backup(snapctx, operating_dataset, snapname=None, zpool=None):
+    """Prune, snapshot and dump a context in zpool (the default pool if None)
+    as the options say. Return the dump file names.
+
+    If snapname is given, the snapshot of this session was taken already,
+    possibly along with those of other contexts, and is not counted among the
+    previous ones."""
+    global _opts
+    zpool = zpool or zfs.get_default_pool()
+    ignore = snapname and [snapname] or None
+    # kill outdated snapshots before dumping: a full 'zfs send -R' takes along those still there
+    outdated = snapctx.get_outdated_snapshots(backlog_num=_opts.backlog_num, backlog_minutes=_opts.maxminutes, dataset=operating_dataset, ignore=ignore, zpool=zpool, **_retention_counts())
+    if _opts.plan and _opts.plan_only:
+        # only printing the plan: leave the pool as it is
+        return _snapshot_and_dump(snapctx, operating_dataset, snapname, zpool, (ignore or []) + outdated)
+    try:
+        zfs.destroy_snapshots(outdated, zpool=zpool)
+    except engine.CommandCancelled:
+        raise
+    except Exception as e:
+        # the dump does not need them gone: the next run prunes them again
+        print "Cannot prune outdated snapshots of '%s', going on: %s" % (zpool, e)
+    return _snapshot_and_dump(snapctx, operating_dataset, snapname, zpool, (ignore or []) + outdated)
+
+
+def _snapshot_and_dump(snapctx, operating_dataset, snapname, zpool, ignore):
+    """Snapshot and dump a context in zpool for run_backup(), leaving out the snapshots in ignore."""
+    global _opts
+    # get survived snaps in this context
+    previous_snaps = snapctx.get_snapshots(dataset=operating_dataset, ignore=ignore, zpool=zpool)
+    # take new snapshot
+    # what dataset take individually?
+    ids = _dataset_selection()
+    # only printing the plan: plan a dump of the latest snapshot, taking none
+    nosnap = _opts.nosnap or (_opts.plan and _opts.plan_only)
+    # finish the interrupted dumps of the latest snapshot before moving on, as they were started
+    if _opts.send and _opts.resumable and not nosnap and not snapname and previous_snaps:
+        interrupted = [ckpt for ckpt in checkpoint.list_checkpoints(_opts.output)
+                if ckpt.snap_to == previous_snaps[-1] and '%s%s@%s' % (zpool, ckpt.dataset, ckpt.snap_to) in ckpt.command]
+        if interrupted:
+            return [_resume_dump(ckpt, zpool=zpool) for ckpt in interrupted]
     # proceed taking the snapshot for the current session
-    if not _opts.nosnap:
+    if snapname:
+        current_snapname = snapname
+    elif not nosnap:
         current_snapname = snapctx.make_snap_name()
-        zfs.take_snapshot(current_snapname, restrictdatasets=ids, nodatasets=_opts.exclude_datasets)
+        zfs.take_snapshot(current_snapname, restrictdatasets=ids, nodatasets=_opts.exclude_datasets, zpool=zpool)
     else:
         if not previous_snaps:
             print "No existing snapshots in '%s'. Cannot proceed." % _opts.context
         current_snapname = previous_snaps.pop()
 
-    if not _opts.send: _done()
+    if not _opts.send: return []
     # dump is required
+    if _opts.plan and not _opts.fulldump and previous_snaps:
+        return _handle_planned_dumps(previous_snaps, current_snapname, individuals=ids, zpool=zpool)
+    if _opts.plan and _opts.plan_only:
+        print "Nothing to plan for '%s': it is dumped in full" % current_snapname
+        return []
     if _opts.fulldump or len(previous_snaps) == 0 or (_opts.backlog_num is not None and len(previous_snaps) >= _opts.backlog_num):
         # full dump
         if not ids:
-            bkfname = full_send(current_snapname)
+            return [full_send(current_snapname, zpool=zpool)]
         else:
-            for ds in ids:
-                bkfname = full_send(current_snapname, dataset=ds)
-        _done()
+            return _dump_datasets(ids, full_send, current_snapname, zpool=zpool)
     # look for what incremental algorithm the user wants
     if _opts.alternate_dumps:
-        _handle_alternate_dumps(previous_snaps, current_snapname, individuals=ids)
+        return _handle_alternate_dumps(previous_snaps, current_snapname, individuals=ids, zpool=zpool)
     else:
-        _handle_sequential_dumps(previous_snaps, current_snapname, individuals=ids)
+        return _handle_sequential_dumps(previous_snaps, current_snapname, individuals=ids, zpool=zpool)
+
+
+def _run_pool(snapctx, operating_dataset, snapname, zpool):
+    """Run the backup of a context in one pool, as one of several.
+
+    Return (dump file names, seconds taken, the exception if it failed)."""
+    started = time.time()
+    try:
+        return run_backup(snapctx, operating_dataset, snapname, zpool=zpool), time.time() - started, None
+    except Exception as e:
+        traceback.print_exc()
+        return [], time.time() - started, e
+
+
+def run_pools(snapctx, operating_dataset, zpools, snapname=None):
+    """Run the backup of a context in each of zpools, independently and concurrently.
+
+    Pools do not contend for disks, so up to --pool-jobs of them run at once,
+    largest first; a pool failing does not stop the others. Print what each
+    pool did at the end, and return whether all succeeded."""
+    global _opts
+    # load what the pools share before they race for it
+    topology = zfs.get_topology()
+    zfs.get_snapshot_inventory()
+    sched = scheduler.DumpScheduler(_opts.pool_jobs or len(zpools))
+    for zpool in zpools:
+        root = topology.get_dataset(zpool)
+        size = root and root.properties.get('used') or 0
+        sched.add(scheduler.DumpJob(_run_pool, (snapctx, operating_dataset, snapname, zpool), name=zpool, pool=zpool, size=size))
+    ok = True
+    print "Pool results for context '%s':" % snapctx.tag
+    for job in sched.run():
+        bkfnames, seconds, error = job.result
+        if error is None:
+            print "  %-16s OK      %3d dumps  %8.1f sec" % (job.name, len(bkfnames), seconds)
+        else:
+            ok = False
+            print "  %-16s FAILED %3d dumps  %8.1f sec  %s" % (job.name, len(bkfnames), seconds, error)
+        for bkfname in bkfnames:
+            print "    %s" % bkfname
+    return ok
+
+
+def _check_send_options():
+    """Fail on unusable codecs, checksums and other dump options, before any snapshot is taken."""
+    global _opts
+    _get_codec()
+    pipeline.get_hashes(_opts.checksum)
+    throttle.Priority.parse(_opts.nice, _opts.ionice)
+    if _opts.rate_schedule: throttle.Schedule(_opts.rate_schedule)
+    for spec in _opts.tees or []: _parse_tee(spec)
+    if _opts.tees and _opts.resumable:
+        raise Exception("--tee cannot be combined with --resumable")
+    if _opts.remote and _opts.resumable:
+        # checkpoints resume dump files: a remote receive keeps no partial output to resume into
+        raise Exception("--remote cannot be combined with --resumable")
+
+
+def _run_daemon(path):
+    """Run the contexts of a configuration file on schedule, or once with --daemon-once."""
+    global _opts
+    settings, contexts = daemon.load_config(path, get_option_parser())
+    daemon_opts = _opts
+    for context in contexts:
+        _cleanup_options(context.opts)
+        if not context.opts.send: continue
+        _opts = context.opts
+        try:
+            _check_send_options()
+        except Exception as e:
+            raise Exception("Context '%s': %s" % (context.name, e))
+    _opts = daemon_opts
+
+    def snapshot(group):
+        # contexts taking no snapshot of their own run on their latest one
+        taking = [context for context in group if not context.opts.nosnap and not (context.opts.plan and context.opts.plan_only)]
+        snapnames = dict([(context.name, zsnapman.SnapshotContext(context.name).make_snap_name()) for context in taking])
+        if taking:
+            opts = taking[0].opts
+            for zpool in opts.all_pools and zfs.get_pools() or opts.pools or [None]:
+                zfs.take_snapshot([snapnames[context.name] for context in taking], restrictdatasets=opts.only_datasets or opts.individual_dump_ds,
+                        nodatasets=opts.exclude_datasets, zpool=zpool)
+        return [snapnames.get(context.name) for context in group]
+
+    def run(context, snapname):
+        global _opts
+        _opts = context.opts
+        metrics.reset({'host': os.uname()[1], 'context': context.name})
+        if snapname:
+            print "Running context '%s' on snapshot '%s'" % (context.name, snapname)
+        else:
+            print "Running context '%s' on its latest snapshot" % context.name
+        snapctx = zsnapman.SnapshotContext(context.name)
+        try:
+            zpools = _selected_pools()
+            if zpools:
+                success = run_pools(snapctx, _operating_dataset(), zpools, snapname)
+            else:
+                run_backup(snapctx, _operating_dataset(), snapname)
+                success = True
+        except BaseException:
+            _write_metrics(False)
+            raise
+        _write_metrics(success)
+
+    runner = daemon.Daemon(contexts, snapshot, run, tick=settings['tick'], refresh=settings['refresh'])
+    if _opts.daemon_once:
+        runner.start()
+        runner.fire(contexts)
+        runner.queue.join()
+    else:
+        runner.serve()
+
+
+### MAIN
+
+def main():
+    # get user options
+    global _opts
+    _opts, args = get_option_parser().parse_args()
+    _cleanup_options(_opts)
+    metrics.reset({'host': os.uname()[1], 'context': _opts.context})
+    # if we die before _done(), still report a failed run
+    atexit.register(_write_metrics, False)
+    zfs.COMMAND_TIMEOUT = _opts.command_timeout
+    engine.configure(_opts.command_workers)
+    # fail early on unusable codecs and checksums, before taking any snapshot
+    if _opts.send: _check_send_options()
+    # get context
+    snapctx = zsnapman.SnapshotContext(_opts.context)
+    operating_dataset = _operating_dataset()
+    zpools = _selected_pools()
+
+    # some manual handling?
+    if _opts.daemon:
+        _run_daemon(_opts.daemon)
+        _done()
+    elif _opts.list_snapshots:
+        for zpool in zpools or [None]:
+            if zpools: print "Pool '%s':" % zpool
+            if _opts.context == '*':
+                print "Contexts available:"
+                contexts = sorted(zsnapman.existing_contexts(operating_dataset, zpool))
+                for c in contexts: print c
+                for ctx in contexts:
+                    _list_context(ctx, operating_dataset, zpool)
+            else:
+                _list_context(_opts.context, operating_dataset, zpool)
+        _done()
+    elif _opts.prune_exceeding_minutes is not None:
+        print "Pruning '%s' snapshots older than '%d' minutes" % (_opts.context, _opts.prune_exceeding_minutes)
+        for zpool in zpools or [None]:
+            zfs.destroy_snapshots(snapctx.get_outdated_snapshots(backlog_minutes=_opts.prune_exceeding_minutes, dataset=operating_dataset, zpool=zpool), zpool=zpool)
+        _done()
+    elif _opts.verify:
+        _done(not _verify_dumps(args) and 1 or 0)
+    elif _opts.index:
+        _done(not _index_dumps(args) and 1 or 0)
+    elif _opts.find_object is not None:
+        _done(not _find_object(_opts.find_object, args) and 1 or 0)
+    elif _opts.listen:
+        _done(not _listen(_opts.listen) and 1 or 0)
+    elif _opts.rebuild_catalog:
+        print "Cataloged %d dumps" % catalog.get_catalog(_opts.output).rebuild()
+        _done()
+    elif _opts.catalog_report:
+        _catalog_report()
+        _done()
+    elif _opts.prune_dumps is not None:
+        _prune_dumps(_opts.only_datasets and _opts.only_datasets[0] or operating_dataset, _opts.prune_dumps, zpools and zpools[0] or None)
+        _done()
+    elif _opts.check_chain:
+        _done(not _check_chain(_opts.only_datasets and _opts.only_datasets[0] or operating_dataset, zpools and zpools[0] or None) and 1 or 0)
+    elif _opts.restore_into:
+        _restore(_opts.only_datasets and _opts.only_datasets[0] or operating_dataset, zpools and zpools[0] or None)
+        _done()
+
+    ## done with manual handling
+    if zpools:
+        _done(not run_pools(snapctx, operating_dataset, zpools) and 1 or 0)
+    run_backup(snapctx, operating_dataset)
     _done()
 
 
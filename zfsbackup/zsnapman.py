@@ -33,11 +33,14 @@
 import sys
 import os, subprocess
 import calendar
+import time
 from datetime import datetime, timedelta
 
 import sys
 from optparse import OptionParser
 
+import metrics
+import retention
 import zfs
 
 ### Primary settings
@@ -49,10 +52,6 @@ exclude_datasets = [
         '/usr/src'
         ]
 
-
-# name of the zpool to take snapshots from
-DEFAULT_ZPOOL = 'zroot'
-
 # how many snapshots to keep, or None for no limit (see SNAPS_BACKLOG_MAXDAYS)
 SNAPS_BACKLOG_NUMBER=None
 
@@ -103,38 +102,70 @@ class SnapshotContext:
             timestamp = datetime.now()
         return "%s-%s-%s" % (DEFAULT_SNAP_PREFIX, self.tag, self._timestamp_to_snaptimestr(timestamp))
     
-    def get_snapshots(self, dataset=''):
+    def _get_timed_snapshots(self, dataset='', ignore=None, zpool=None):
+        """Return the retention.Snapshot records of this context, oldest first.
+
+        Snapshots named in ignore are left out."""
+        timed = get_context_index(dataset, zpool).get(self.tag, [])
+        if ignore:
+            timed = [x for x in timed if x.name not in ignore]
+        return timed
+
+    def get_snapshots(self, dataset='', ignore=None, zpool=None):
         """Return snapshots belonging to this context."""
-        # get all snapshots
-        allsnaps = zfs.get_snapshots(dataset)
-        # sort out those in my context
-        my_snapshots = filter(lambda x: x.startswith('%s-%s-' % (DEFAULT_SNAP_PREFIX, self.tag)), allsnaps)
-        # sort them oldest to newest
-        return sorted(my_snapshots, key=lambda x: self._get_snap_time(x))
-
-    def get_fresh_snapshots(self, backlog_num=None, backlog_minutes=None, dataset=''):
-        """Return the list of snapshots fresh wrt an age or a sequence size."""
-        all_snaps = self.get_snapshots(dataset)
-        if backlog_num is not None:
-            # remove the exceeding oldest
-            all_snaps = all_snaps[-backlog_num:]
-        if backlog_minutes is not None:
-            timelimit = datetime.now() - timedelta(minutes=backlog_minutes)
-            all_snaps = filter(lambda x: self._get_snap_time(x) > timelimit, all_snaps)
-        return all_snaps
-
-    def get_outdated_snapshots(self, backlog_num=None, backlog_minutes=None, dataset=''):
-        """Return the list of snapshots outdated wrt an age or a sequence size."""
-        return filter(lambda x: x not in self.get_fresh_snapshots(backlog_num, backlog_minutes, dataset=dataset), self.get_snapshots(dataset))
-        
+        return [snap.name for snap in self._get_timed_snapshots(dataset, ignore, zpool)]
+
+    def get_fresh_snapshots(self, backlog_num=None, backlog_minutes=None, dataset='', ignore=None, hourly=0, daily=0, weekly=0, monthly=0, zpool=None):
+        """Return the list of snapshots fresh wrt an age or a sequence size,
+        or kept by the hourly, daily, weekly and monthly counts (see retention.Policy)."""
+        policy = retention.Policy(backlog_num, backlog_minutes, hourly, daily, weekly, monthly)
+        kept, dropped = policy.evaluate(self._get_timed_snapshots(dataset, ignore, zpool))
+        return [snap.name for snap in kept]
+
+    def get_outdated_snapshots(self, backlog_num=None, backlog_minutes=None, dataset='', ignore=None, hourly=0, daily=0, weekly=0, monthly=0, zpool=None):
+        """Return the list of snapshots outdated wrt an age or a sequence size,
+        and not kept by the hourly, daily, weekly and monthly counts."""
+        policy = retention.Policy(backlog_num, backlog_minutes, hourly, daily, weekly, monthly)
+        kept, dropped = policy.evaluate(self._get_timed_snapshots(dataset, ignore, zpool))
+        return [snap.name for snap in dropped]
+
+
+# per-dataset index of snapshots by context: (pool, dataset) -> (inventory generation, index)
+_context_index = {}
+
+def get_context_index(dataset='', zpool=None):
+    """Return the snapshots managed by this tool in a dataset, indexed by context.
+
+    Each context maps to a list of retention.Snapshot records sorted oldest
+    to newest. The index is built from the zfs snapshot inventory and rebuilt only
+    when that changes, so each snapshot name is parsed once. The dataset is
+    looked up in zpool, the default pool if None."""
+    zpool = zpool or zfs.get_default_pool()
+    generation = zfs.get_snapshot_inventory_generation()
+    cached = _context_index.get((zpool, dataset))
+    if cached and cached[0] == generation:
+        return cached[1]
+    snapnames = zfs.get_snapshots(dataset, zpool=zpool)
+    started = time.time()
+    index = {}
+    for snapname in snapnames:
+        snap = retention.parse_snapshot(snapname, DEFAULT_SNAP_PREFIX, DEFAULT_TIMESTRFORMAT)
+        # not a name we generated
+        if snap is None: continue
+        index.setdefault(snap.context, []).append(snap)
+    for snaps in index.values():
+        snaps.sort(key=lambda snap: (snap.stamp, snap.name))
+    _context_index[(zpool, dataset)] = (generation, index)
+    metrics.record_stage('index', time.time() - started)
+    return index
 
 def is_snapman_snapshot(snapname):
     """Return whether a snapshot name is managed by this tool."""
     return snapname.startswith(DEFAULT_SNAP_PREFIX + '-')
 
-def existing_contexts(dataset=''):
+def existing_contexts(dataset='', zpool=None):
     """Return the set of existing contexts found on the system"""
-    return set([x.split('-')[1] for x in zfs.get_snapshots(dataset) if is_snapman_snapshot(x)])
+    return set(get_context_index(dataset, zpool).keys())
 
 
 if __name__ == '__main__':